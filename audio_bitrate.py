@@ -0,0 +1,77 @@
+import logging
+from pathlib import Path
+
+from media_probe import MediaInfo
+from process_runner import ANALYSIS, get_runner
+
+EXACT = "exact"
+SAMPLED = "sampled"
+
+
+def _window_intervals(duration: float, windows: int, window_seconds: float):
+    """Evenly spaced `start%+length` read intervals for ffprobe -read_intervals"""
+    step = duration / windows
+    starts = [step * i + max(0.0, (step - window_seconds) / 2) for i in range(windows)]
+    return ",".join(f"{start:.3f}%+{window_seconds}" for start in starts)
+
+
+def parse_packets(output: str):
+    """Sum packet sizes and durations per stream from `-of compact=p=0` packet output
+
+    Returns {stream_index: (total_bytes, total_seconds)}.
+    """
+    totals = {}
+    for line in output.splitlines():
+        fields = dict(field.split("=", 1) for field in line.strip().split("|") if "=" in field)
+        if "stream_index" not in fields or "size" not in fields:
+            continue
+        try:
+            index = int(fields["stream_index"])
+            size = int(fields["size"])
+        except ValueError:
+            continue
+        try:
+            seconds = float(fields.get("duration_time", "N/A"))
+        except ValueError:
+            seconds = 0.0
+        total_bytes, total_seconds = totals.get(index, (0, 0.0))
+        totals[index] = (total_bytes + size, total_seconds + seconds)
+    return totals
+
+
+def estimate_audio_bitrates(filepath: Path, media_info: MediaInfo, mode: str = EXACT,
+                            sample_windows: int = 10, window_seconds: float = 30):
+    """Measure the bitrate (kbit/s) of all audio streams in a single ffprobe pass
+
+    Packet sizes are summed per stream without decoding anything. In exact mode the
+    whole file is read, in sampled mode only `sample_windows` evenly spaced windows
+    are read and the bitrate is extrapolated from the packets in those windows.
+
+    Returns {audio stream position (as in 0:a:N): kbit/s}.
+    """
+    duration = media_info.duration
+    cmd = [
+        "ffprobe", "-v", "error", "-select_streams", "a",
+        "-show_entries", "packet=stream_index,size,duration_time", "-of", "compact=p=0",
+    ]
+    sampled = mode == SAMPLED and duration > sample_windows * window_seconds * 2
+    if sampled:
+        cmd += ["-read_intervals", _window_intervals(duration, sample_windows, window_seconds)]
+    cmd.append(str(filepath))
+
+    # a full read of a large file takes minutes, it gets the timeout of the analysis processes
+    output = get_runner().run(cmd, ANALYSIS).stdout
+    totals = parse_packets(output)
+
+    bitrates = {}
+    for position, stream in enumerate(media_info.audio_streams):
+        total_bytes, total_seconds = totals.get(stream.index, (0, 0.0))
+        if not sampled:
+            # the container duration is more reliable than summed packet durations for a full read
+            total_seconds = duration or total_seconds
+        if total_bytes == 0 or total_seconds <= 0:
+            continue
+        bitrates[position] = int(total_bytes * 8 / total_seconds / 1000)
+
+    logging.info(f"Measured audio bitrates ({'sampled' if sampled else 'exact'}) of {filepath}: {bitrates}")
+    return bitrates
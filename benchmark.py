@@ -0,0 +1,286 @@
+#!/usr/bin/env python3
+"""Reproducible benchmark of the analysis stage and the full pipeline on synthetic media
+
+The corpus is generated locally with ffmpeg lavfi sources, so every run measures
+the same input. Results are written as JSON and can be compared with an earlier run:
+
+    python benchmark.py --output before.json
+    python benchmark.py --output after.json --compare before.json
+"""
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from capabilities import FFmpegCapabilities
+from config import Config
+from file_processor import FileProcessor
+from media_probe import ProbeCache
+from pipeline import Pipeline
+from process_runner import ENCODE, get_runner
+from progress import EncodeMonitor
+
+BITEXACT = ["-fflags", "+bitexact", "-flags:v", "+bitexact", "-flags:a", "+bitexact"]
+
+# name -> (ffmpeg input/filter arguments, output codec arguments, extension)
+CORPUS = {
+    # 1080p h264 with a high bitrate stereo track, needs video and audio transcoding
+    "testsrc2_1080p": (
+        ["-f", "lavfi", "-i", "testsrc2=size=1920x1080:rate=24", "-f", "lavfi", "-i", "sine=frequency=440:sample_rate=48000"],
+        ["-c:v", "libx264", "-preset", "ultrafast", "-c:a", "aac", "-b:a", "320k"],
+        ".mp4",
+    ),
+    # 2.40:1 picture padded to 16:9, exercises crop detection
+    "letterboxed_1080p": (
+        ["-f", "lavfi", "-i", "testsrc2=size=1920x800:rate=24,pad=1920:1080:0:140:black",
+         "-f", "lavfi", "-i", "sine=frequency=220:sample_rate=48000"],
+        ["-c:v", "libx264", "-preset", "ultrafast", "-c:a", "aac", "-b:a", "128k"],
+        ".mkv",
+    ),
+    # 5.1 audio, exercises the multi-channel AAC path
+    "multichannel_720p": (
+        ["-f", "lavfi", "-i", "testsrc2=size=1280x720:rate=25",
+         "-f", "lavfi", "-i", "sine=frequency=300:sample_rate=48000",
+         "-filter_complex", "[1:a]pan=5.1|c0=c0|c1=c0|c2=c0|c3=c0|c4=c0|c5=c0[a]", "-map", "0:v", "-map", "[a]"],
+        ["-c:v", "libx264", "-preset", "ultrafast", "-c:a", "aac", "-b:a", "640k"],
+        ".mkv",
+    ),
+    # FLAC in Matroska has no bit_rate tag, exercises the audio bitrate measurement
+    "untagged_audio_dvd": (
+        ["-f", "lavfi", "-i", "testsrc2=size=720x576:rate=25",
+         "-f", "lavfi", "-i", "sine=frequency=500:sample_rate=48000",
+         "-f", "lavfi", "-i", "sine=frequency=600:sample_rate=48000", "-map", "0:v", "-map", "1:a", "-map", "2:a"],
+        ["-c:v", "libx264", "-preset", "ultrafast", "-c:a", "flac"],
+        ".mkv",
+    ),
+}
+
+
+class SpawnCounter:
+    """Counts the ffmpeg/ffprobe processes started through the process runner within a block"""
+
+    def __init__(self):
+        self.counts = {"ffmpeg": 0, "ffprobe": 0}
+        self._before = {}
+
+    @staticmethod
+    def _totals():
+        totals = {}
+        for stats in get_runner().stats().values():
+            for program, count in stats["programs"].items():
+                totals[program] = totals.get(program, 0) + count
+        return totals
+
+    def __enter__(self):
+        self._before = self._totals()
+        return self
+
+    def __exit__(self, *exc):
+        after = self._totals()
+        for program in self.counts:
+            self.counts[program] = after.get(program, 0) - self._before.get(program, 0)
+
+
+def generate_corpus(directory: Path, duration: int):
+    """Create the synthetic files (skipped if they already exist), returns their paths"""
+    directory.mkdir(parents=True, exist_ok=True)
+    files = []
+    for name, (inputs, codecs, ext) in CORPUS.items():
+        path = directory / f"{name}_{duration}s{ext}"
+        if not path.exists():
+            cmd = ["ffmpeg", "-hide_banner", "-v", "error", "-y", *inputs, "-t", str(duration),
+                   *codecs, *BITEXACT, "-threads", "1", str(path)]
+            get_runner().run(cmd, ENCODE)
+        files.append(path)
+    return files
+
+
+def bench_config(source_dir: Path, cache_dir: Path) -> Config:
+    config = Config()
+    config.source_dir = source_dir
+    config.cache_dir = cache_dir
+    config.probe_cache_file = cache_dir / "probe_cache.sqlite"
+    config.capabilities_cache_file = cache_dir / "ffmpeg_capabilities.json"
+    return config
+
+
+def bench_analysis(files, config: Config, capabilities: FFmpegCapabilities, probe_cache=None):
+    """Run the analysis stage on every file, returns per-file results"""
+    results = {}
+    for path in files:
+        processor = FileProcessor(path, config, probe_cache=probe_cache, capabilities=capabilities)
+        with SpawnCounter() as spawns:
+            start = time.perf_counter()
+            plan = processor.analyze()
+            latency = time.perf_counter() - start
+        results[path.name] = {
+            "latency_s": round(latency, 4),
+            "ffprobe_spawns": spawns.counts["ffprobe"],
+            "ffmpeg_spawns": spawns.counts["ffmpeg"],
+            "needs_encode": plan is not None,
+            "stages": {name: round(stage["wall_s"], 4) for name, stage in processor.metrics.stages.items()},
+        }
+    return results
+
+
+class FpsRecorder:
+    """EncodeMonitor listener remembering the average fps of every finished encode"""
+
+    def __init__(self):
+        self.encodes = []
+
+    def on_start(self, state):
+        pass
+
+    def on_update(self, state):
+        pass
+
+    def on_finish(self, state):
+        elapsed = time.monotonic() - state.started
+        self.encodes.append({"name": state.name, "frames": state.frame,
+                             "fps": round(state.frame / elapsed, 2) if elapsed else 0.0})
+
+
+def bench_pipeline(files, config: Config, capabilities: FFmpegCapabilities, workdir: Path):
+    """Run the full pipeline on a copy of the corpus, returns throughput and size figures"""
+    if workdir.exists():
+        shutil.rmtree(workdir)
+    workdir.mkdir(parents=True)
+    copies = []
+    for path in files:
+        copy = workdir / path.name
+        shutil.copy2(path, copy)
+        copies.append(copy)
+    input_bytes = sum(p.stat().st_size for p in copies)
+
+    recorder = FpsRecorder()
+    monitor = EncodeMonitor(recorder)
+    outputs, errors = {}, {}
+
+    def on_result(filepath, result, error, cost):
+        if error is not None:
+            errors[filepath.name] = str(error)
+        else:
+            outputs[filepath.name] = result
+
+    processors = [FileProcessor(p, config, capabilities=capabilities, monitor=monitor) for p in copies]
+    with SpawnCounter() as spawns:
+        start = time.perf_counter()
+        Pipeline(config, on_result=on_result).run(processors)
+        wall = time.perf_counter() - start
+
+    frames = sum(e["frames"] for e in recorder.encodes)
+    output_bytes = sum(Path(p).stat().st_size for p in outputs.values() if Path(p).exists())
+    return {
+        "preset": config.cpu,
+        "crf": config.base_quality,
+        "wall_s": round(wall, 3),
+        "frames": frames,
+        "fps": round(frames / wall, 2) if wall else 0.0,
+        "encodes": recorder.encodes,
+        "input_bytes": input_bytes,
+        "output_bytes": output_bytes,
+        "spawns_per_file": round(sum(spawns.counts.values()) / len(copies), 2),
+        "errors": errors,
+    }
+
+
+def compare(current: dict, baseline: dict, threshold: float):
+    """Return human readable regressions of `current` against `baseline` beyond threshold percent"""
+    regressions = []
+
+    def check(label, new, old, higher_is_better):
+        if not old:
+            return
+        change = 100 * (new - old) / old
+        if (change < -threshold) if higher_is_better else (change > threshold):
+            regressions.append(f"{label}: {old} -> {new} ({change:+.1f}%)")
+
+    for name, result in current["analysis"]["cold"].items():
+        old = baseline.get("analysis", {}).get("cold", {}).get(name)
+        if old:
+            check(f"analysis latency {name}", result["latency_s"], old["latency_s"], False)
+            check(f"ffprobe spawns {name}", result["ffprobe_spawns"], old["ffprobe_spawns"], False)
+            check(f"ffmpeg spawns {name}", result["ffmpeg_spawns"], old["ffmpeg_spawns"], False)
+
+    old_runs = {(r["preset"], r["crf"]): r for r in baseline.get("pipeline", [])}
+    for run in current["pipeline"]:
+        old = old_runs.get((run["preset"], run["crf"]))
+        if old:
+            label = f"preset {run['preset']} crf {run['crf']}"
+            check(f"{label} fps", run["fps"], old["fps"], True)
+            check(f"{label} output bytes", run["output_bytes"], old["output_bytes"], False)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workdir", type=Path, default=Path(tempfile.gettempdir()) / "recode-benchmark")
+    parser.add_argument("--duration", type=int, default=20, help="length of every corpus file in seconds")
+    parser.add_argument("--presets", type=int, nargs="+", default=[10])
+    parser.add_argument("--crfs", type=int, nargs="+", default=[30])
+    parser.add_argument("--analysis-only", action="store_true", help="skip the encode runs")
+    parser.add_argument("--output", type=Path, default=Path("bench_results.json"))
+    parser.add_argument("--compare", type=Path, help="earlier results to check for regressions")
+    parser.add_argument("--threshold", type=float, default=10.0, help="allowed change in percent")
+    args = parser.parse_args()
+
+    files = generate_corpus(args.workdir / "corpus", args.duration)
+    cache_dir = args.workdir / "cache"
+    shutil.rmtree(cache_dir, ignore_errors=True)
+    config = bench_config(args.workdir / "corpus", cache_dir)
+    capabilities = FFmpegCapabilities.detect()
+
+    probe_cache = ProbeCache(config.probe_cache_file)
+    bench_analysis(files, config, capabilities, probe_cache)  # fill the cache
+    results = {
+        "meta": {
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "ffmpeg": capabilities.version,
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "duration": args.duration,
+        },
+        "analysis": {
+            "cold": bench_analysis(files, config, capabilities),
+            "cached": bench_analysis(files, config, capabilities, probe_cache),
+        },
+        "pipeline": [],
+    }
+    probe_cache.close()
+
+    if not args.analysis_only:
+        for preset in args.presets:
+            for crf in args.crfs:
+                run_config = bench_config(args.workdir / "run", cache_dir)
+                run_config.cpu = preset
+                run_config.base_quality = crf
+                run = bench_pipeline(files, run_config, capabilities, args.workdir / "run")
+                results["pipeline"].append(run)
+                print(f"preset {preset} crf {crf}: {run['fps']} fps, "
+                      f"{run['output_bytes'] / 1e6:.1f} MB from {run['input_bytes'] / 1e6:.1f} MB")
+
+    for name, result in results["analysis"]["cold"].items():
+        print(f"{name}: analysis {result['latency_s']:.3f}s, "
+              f"{result['ffprobe_spawns']} ffprobe / {result['ffmpeg_spawns']} ffmpeg spawns")
+
+    args.output.write_text(json.dumps(results, indent=2))
+    print(f"Results written to {args.output}")
+
+    if args.compare:
+        regressions = compare(results, json.loads(args.compare.read_text()), args.threshold)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,112 @@
+import json
+import logging
+import os
+import re
+import shutil
+import threading
+from pathlib import Path
+from typing import Optional
+
+from process_runner import PROBE, get_runner
+
+# Encoders and filters the processing pipeline relies on
+REQUIRED_ENCODERS = ["libsvtav1", "libopus"]
+AAC_ENCODERS = ["libfdk_aac", "aac_at"]  # at least one is needed for multi-channel audio
+REQUIRED_FILTERS = ["cropdetect", "crop", "scale"]
+
+
+def _parse_codec_list(output: str):
+    """Parse the name column of `ffmpeg -encoders` / `ffmpeg -filters` output"""
+    names = set()
+    for line in output.splitlines():
+        parts = line.split()
+        # entries are "<flags> <name> <description>", legend lines are "<flags> = <meaning>"
+        if len(parts) >= 3 and parts[1] != "=" and re.fullmatch(r"[A-Z.|]+", parts[0]):
+            names.add(parts[1])
+    return names
+
+
+class FFmpegCapabilities:
+    """What the ffmpeg binary in use can do, detected once per run"""
+
+    def __init__(self, ffmpeg_path: str, version: str, encoders, filters):
+        self.ffmpeg_path = ffmpeg_path
+        self.version = version
+        self.encoders = set(encoders)
+        self.filters = set(filters)
+
+    def has_encoder(self, name: str) -> bool:
+        return name in self.encoders
+
+    def has_filter(self, name: str) -> bool:
+        return name in self.filters
+
+    def missing_requirements(self):
+        """Return the names of required encoders/filters that are not available"""
+        missing = [e for e in REQUIRED_ENCODERS if not self.has_encoder(e)]
+        if not any(self.has_encoder(e) for e in AAC_ENCODERS):
+            missing.append(" or ".join(AAC_ENCODERS))
+        missing += [f for f in REQUIRED_FILTERS if not self.has_filter(f)]
+        return missing
+
+    def to_dict(self):
+        return {
+            "ffmpeg_path": self.ffmpeg_path,
+            "version": self.version,
+            "encoders": sorted(self.encoders),
+            "filters": sorted(self.filters),
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict):
+        return cls(data["ffmpeg_path"], data["version"], data["encoders"], data["filters"])
+
+    @classmethod
+    def detect(cls, ffmpeg: str = "ffmpeg", cache_file: Optional[Path] = None):
+        """Run ffmpeg to detect its capabilities, or load them from the cache
+
+        The cache is only used if it was written for the same binary (path and mtime).
+        """
+        ffmpeg_path = shutil.which(ffmpeg)
+        if ffmpeg_path is None:
+            raise Exception(f"ffmpeg binary not found: {ffmpeg}")
+        binary_mtime = os.stat(ffmpeg_path).st_mtime_ns
+
+        if cache_file is not None and Path(cache_file).exists():
+            try:
+                cached = json.loads(Path(cache_file).read_text())
+                if cached.get("ffmpeg_path") == ffmpeg_path and cached.get("mtime_ns") == binary_mtime:
+                    return cls.from_dict(cached)
+            except (OSError, ValueError, KeyError) as e:
+                logging.warning(f"Ignoring unreadable capability cache {cache_file}: {e}")
+
+        def run(*args):
+            cmd = [ffmpeg_path, "-hide_banner", *args]
+            return get_runner().run(cmd, PROBE).stdout
+
+        version_output = run("-version").splitlines()
+        version_line = version_output[0] if version_output else ""
+        version = version_line.split(" ")[2] if version_line.startswith("ffmpeg version") else version_line
+        capabilities = cls(ffmpeg_path, version, _parse_codec_list(run("-encoders")), _parse_codec_list(run("-filters")))
+        logging.info(f"Detected ffmpeg {capabilities.version} at {ffmpeg_path}")
+
+        if cache_file is not None:
+            try:
+                Path(cache_file).parent.mkdir(parents=True, exist_ok=True)
+                Path(cache_file).write_text(json.dumps({**capabilities.to_dict(), "mtime_ns": binary_mtime}))
+            except OSError as e:
+                logging.warning(f"Could not write capability cache {cache_file}: {e}")
+        return capabilities
+
+
+_shared_capabilities = None
+_shared_lock = threading.Lock()
+
+
+def get_capabilities(cache_file: Optional[Path] = None) -> FFmpegCapabilities:
+    """Return the process-wide capability registry, detecting it on first use"""
+    global _shared_capabilities
+    with _shared_lock:
+        if _shared_capabilities is None:
+            _shared_capabilities = FFmpegCapabilities.detect(cache_file=cache_file)
+        return _shared_capabilities
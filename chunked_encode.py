@@ -0,0 +1,207 @@
+import concurrent.futures
+import contextvars
+import logging
+import queue
+import shutil
+from pathlib import Path
+
+from encode_plan import EncodePlan
+from process_runner import PROBE, get_runner
+from progress import EncodeMonitor, run_ffmpeg
+from resume import SegmentManifest
+from runtime_control import job_cpus
+from scheduler import affinity_prefix, lp_level, split_cpus
+
+
+def chunk_targets(duration: float, min_chunk_seconds: float, max_chunks: int):
+    """Evenly spaced split points, at least min_chunk_seconds apart"""
+    count = int(min(max_chunks, duration // min_chunk_seconds))
+    if count < 2:
+        return []
+    return [duration * i / count for i in range(1, count)]
+
+
+def find_keyframes(filepath: Path, targets):
+    """Return the keyframe at or before each target timestamp
+
+    ffprobe seeks to the keyframe before every read interval, so reading a single
+    packet per interval is enough. Nothing is decoded and only a few packets are read.
+    """
+    if not targets:
+        return []
+    cmd = [
+        "ffprobe", "-v", "error", "-select_streams", "v:0",
+        "-read_intervals", ",".join(f"{t:.3f}%+#1" for t in targets),
+        "-show_entries", "packet=pts_time,flags", "-of", "csv=p=0", str(filepath)
+    ]
+    output = get_runner().run(cmd, PROBE).stdout
+    keyframes = set()
+    for line in output.splitlines():
+        parts = line.strip().split(",")
+        if len(parts) >= 2 and "K" in parts[1]:
+            try:
+                keyframes.add(float(parts[0]))
+            except ValueError:
+                continue
+    return sorted(keyframes)
+
+
+def plan_chunks(keyframes, duration: float, min_chunk_seconds: float):
+    """Split [0, duration) at keyframes into (start, end) chunks of at least min_chunk_seconds
+
+    The end of the last chunk is None, meaning "until the end of the file".
+    """
+    boundaries = [0.0]
+    for keyframe in keyframes:
+        if keyframe - boundaries[-1] >= min_chunk_seconds and duration - keyframe >= min_chunk_seconds:
+            boundaries.append(keyframe)
+    if len(boundaries) < 2:
+        return []
+    return [(start, end) for start, end in zip(boundaries, boundaries[1:] + [None])]
+
+
+def with_lp_level(video_cmd, level: int):
+    """video_cmd with the lp of its -svtav1-params replaced (or added) by level"""
+    if "-svtav1-params" not in video_cmd:
+        return list(video_cmd)
+    index = video_cmd.index("-svtav1-params") + 1
+    params = [param for param in video_cmd[index].split(":") if not param.startswith("lp=")]
+    return [*video_cmd[:index], ":".join([*params, f"lp={level}"]), *video_cmd[index + 1:]]
+
+
+class ChunkedEncoder:
+    """Encode the video of one file as parallel chunks, then mux it with the other streams
+
+    The chunks are encoded with the plan's video settings, concatenated without
+    re-encoding, and muxed with the audio/subtitle commands of the plan. Finished
+    chunks are recorded in a manifest, an interrupted encode of the same plan
+    resumes with the missing chunks.
+    """
+
+    def __init__(self, plan: EncodePlan, parallel_segments: int, command_prefix=None,
+                 monitor: EncodeMonitor = None, stderr_lines: int = 200, cpus=None):
+        self.plan = plan
+        self.parallel_segments = parallel_segments
+        self.command_prefix = command_prefix or []
+        self.monitor = monitor
+        self.stderr_lines = stderr_lines
+        self.cpus = cpus  # split between the parallel segments, each segment process is pinned to its share
+
+    def _cpus(self):
+        """The CPUs of the encode, those of its job if that continued on other CPUs after a pause"""
+        return job_cpus(self.cpus)
+
+    def _run(self, cmd, name: str, duration: float):
+        logging.info("Running ffmpeg: %s", " ".join(cmd))
+        run_ffmpeg(cmd, self.monitor, name=name, duration=duration, stderr_lines=self.stderr_lines)
+
+    def segment_video_cmd(self, cpus=None):
+        """The plan's video settings with SVT-AV1 told the threads of one segment
+
+        The plan's lp was chosen for a single encode, a segment gets the lp of the
+        CPUs it is pinned to, or of its share of the plan's thread budget.
+        """
+        if cpus:
+            return with_lp_level(self.plan.video_cmd, lp_level(len(cpus)))
+        if "lp=" not in " ".join(self.plan.video_cmd):
+            return list(self.plan.video_cmd)  # no thread budget (fixed scheduler)
+        parallel = max(1, min(self.parallel_segments, len(self.plan.chunks)))
+        return with_lp_level(self.plan.video_cmd, lp_level(max(1, self.plan.threads // parallel)))
+
+    def segment_command(self, input_path: Path, start: float, end, segment_path: Path, cpus=None):
+        cmd = [*affinity_prefix(cpus), *self.command_prefix, "ffmpeg", "-y", "-ss", f"{start:.6f}"]
+        if end is not None:
+            cmd += ["-t", f"{end - start:.6f}"]
+        return cmd + [
+            "-i", str(input_path),
+            "-map", "0:v:0", *self.segment_video_cmd(cpus),
+            "-an", "-sn", "-dn", "-nostats", str(segment_path)
+        ]
+
+    def concat_command(self, list_path: Path, video_path: Path):
+        return ["ffmpeg", "-y", "-f", "concat", "-safe", "0", "-i", str(list_path),
+                "-c", "copy", "-nostats", str(video_path)]
+
+    def mux_command(self, input_path: Path, video_path: Path, output_path: Path):
+        # the encoded video replaces the first video stream, everything else is mapped from the source
+        map_cmd = ["1:v:0" if arg == "0:v:0" else arg for arg in self.plan.map_cmd]
+        return [
+            *affinity_prefix(self._cpus()),
+            *self.command_prefix,
+            "ffmpeg", "-y", "-i", str(input_path), "-i", str(video_path),
+            *map_cmd,
+            "-c:v", "copy",
+            *self.plan.audio_cmd,
+            "-c:s", "copy",
+            "-movflags", "use_metadata_tags",
+            *self.plan.subtitle_cmd,
+            *self.plan.metadata_cmd,
+            "-nostats", str(output_path)
+        ]
+
+    def segment_path(self, workdir: Path, index: int) -> Path:
+        return workdir / f"segment_{index:04d}.mkv"
+
+    def encode_segments(self, input_path: Path, workdir: Path, segments, manifest: SegmentManifest = None):
+        """Encode the given (index, start, end) segments in parallel, returns their paths by index"""
+        paths = {}
+        slots = queue.Queue()  # the share of the CPUs a segment runs on
+        for slot in range(self.parallel_segments):
+            slots.put(slot)
+
+        def encode(segment):
+            index, start, end = segment
+            path = self.segment_path(workdir, index)
+            duration = (end if end is not None else self.plan.duration) - start
+            slot = slots.get()
+            try:
+                cpus = self._cpus()
+                if cpus:
+                    shares = split_cpus(cpus, self.parallel_segments)
+                    cpus = shares[slot % len(shares)]  # fewer CPUs than segments, some share them
+                self._run(self.segment_command(input_path, start, end, path, cpus),
+                          f"{input_path.name} [{index + 1}/{len(self.plan.chunks)}]", duration)
+            finally:
+                slots.put(slot)
+            if manifest is not None:
+                manifest.mark_done(index, path)
+            return index, path
+
+        # every segment runs in a copy of the caller's context, so it belongs to the caller's encode job
+        contexts = [contextvars.copy_context() for _ in segments]
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.parallel_segments) as executor:
+            for index, path in executor.map(lambda context, segment: context.run(encode, segment),
+                                            contexts, segments):
+                paths[index] = path
+        return paths
+
+    def encode(self, input_path: Path, output_path: Path, workdir: Path, keep_workdir: bool = False):
+        """Run the chunked encode of the plan, the work directory is removed on success unless keep_workdir"""
+        manifest = SegmentManifest(workdir, self.plan)
+        if not manifest.load():
+            # left over from another plan (settings or source changed), start over
+            shutil.rmtree(workdir, ignore_errors=True)
+        workdir.mkdir(parents=True, exist_ok=True)
+
+        paths = {}
+        segments = []
+        for i, (start, end) in enumerate(self.plan.chunks):
+            if manifest.is_done(i, self.segment_path(workdir, i)):
+                paths[i] = self.segment_path(workdir, i)
+            else:
+                segments.append((i, start, end))
+        if paths:
+            logging.info(f"Resuming {input_path}: {len(paths)} of {len(self.plan.chunks)} chunks already encoded")
+        else:
+            logging.info(f"Encoding {input_path} in {len(segments)} chunks")
+        paths.update(self.encode_segments(input_path, workdir, segments, manifest))
+
+        list_path = workdir / "segments.txt"
+        list_path.write_text("".join(f"file '{paths[i].name}'\n" for i in sorted(paths)))
+        video_path = workdir / "video.mkv"
+        self._run(self.concat_command(list_path, video_path), f"{input_path.name} [concat]", self.plan.duration)
+        self._run(self.mux_command(input_path, video_path, output_path), f"{input_path.name} [mux]",
+                  self.plan.duration)
+        if not keep_workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+        return output_path
@@ -1,3 +1,4 @@
+import socket
 from pathlib import Path
 
 
@@ -11,8 +12,93 @@ class Config:
         self.audio_bitrate_threshold = 1.25
         self.audio_multichannel_vbr_level = 2  # used for streams witht more than 2 channels. VBR level for libfdk_aac multi-channel (1-5, where 1=highest quality, 5=lowest)
         self.audio_multichannel_aac_at_quality = 10  # VBR quality level for aac_at multi-channel (0-14, where 0=highest quality, 14=lowest)
+        # Measuring audio streams without a bit_rate tag: "exact" reads all packets, "sampled" reads evenly spaced windows
+        self.audio_bitrate_estimation = "exact"
+        self.audio_bitrate_sample_windows = 10
+        self.audio_bitrate_window_seconds = 30
         self.keyint_seconds = "-2"
-        self.max_parallel_encodes = 2
+        self.max_parallel_encodes = 2  # only used by the "fixed" encode scheduler
+        # "adaptive": run as many encodes as fit the CPUs, each limited to a thread budget based on resolution and preset
+        self.encode_scheduler = "adaptive"
+        self.encode_cpus = None  # CPUs available for encoding, None detects them (respects cgroup/cpuset limits)
+        # Pin every encode to its own CPUs, within one NUMA node where possible (adaptive scheduler, Linux taskset)
+        self.pin_encode_cpus = True
+        self.max_parallel_analyses = 8  # probing/cropdetect/audio measuring is I/O bound, runs in its own pool
+        self.encode_queue_size = 16  # analyzed files waiting for a free encode slot, the lookahead for encode_order
+        self.encode_order = "longest"  # "longest" first (shortest total run time), "shortest" first or by "path"
+        # Chunked encoding: long files are split at keyframes and the chunks are encoded in parallel
+        self.chunked_encoding = True
+        self.chunked_min_duration = 5400  # seconds, shorter files are encoded in one piece
+        self.chunk_min_seconds = 300  # long chunks keep the overhead of the extra keyframes small
+        self.chunked_max_chunks = 16
+        self.chunked_parallel_segments = 4
+        # Checkpointed encoding: shorter files that still take long to encode are split the same way, but the
+        # segments are encoded one after another, so an interrupted encode resumes at the last finished segment
+        self.checkpoint_min_duration = 1800  # seconds, None encodes files below chunked_min_duration in one piece
+        self.checkpoint_segment_seconds = 600
+        # Deduplication: hardlinks (same inode) and copies (same size and partial content hash) are processed once,
+        # the other paths get the result; copies are hardlinked to it instead of copied with dedup_relink_copies
+        self.dedup_enabled = True
+        self.dedup_relink_copies = False
+        self.dedup_hash_samples = 3  # blocks read between the first and the last one
+        # Remove outputs of interrupted encodes while walking the tree (chunked and checkpointed encodes whose
+        # source is unchanged are resumed)
+        self.clean_partial_outputs = True
+        # Subprocesses: concurrent ffprobe/ffmpeg analysis processes (encodes are limited by the scheduler)
+        # and timeouts in seconds per kind of process, None waits forever
+        self.max_concurrent_probes = 16
+        self.max_concurrent_analysis_processes = 8
+        self.process_timeouts = {"probe": 300, "analysis": 3600, "encode": None}
+        self.analysis_io_idle = True  # run probes and analysis processes with ionice -c 3 (Linux)
+        # Runtime control: the number of running encodes can be changed during a run with --pause, --resume
+        # and --max-encodes (or by editing the control file), encodes above the limit are paused with SIGSTOP
+        self.control_poll_seconds = 10
+        # Automatic throttling, every rule is off when None/empty
+        self.throttle_max_foreign_load = None  # load average of other processes per CPU, e.g. 0.5
+        self.throttle_min_available_memory_percent = None  # e.g. 10
+        self.throttle_schedule = []  # (start, end, max encodes), e.g. [("08:00", "18:00", 1)]
+        self.ffmpeg_stderr_lines = 200  # lines of ffmpeg stderr kept in memory and logged when an encode fails
         self.video_exts = {".mp4", ".mkv", ".mov", ".webm", ".avi"}
+        # Discovery: glob patterns matched against the path relative to source_dir, e.g. "Movies/*" or "*/Extras"
+        self.include_globs = []
+        self.exclude_globs = []
+        self.discovery_walkers = 4  # parallel walkers, one per top-level directory at a time
+        # Skip the files of directories that were finished by an earlier run and whose mtime did not change.
+        # Files replaced in place (same name) do not change the directory mtime, so this is off by default.
+        self.prune_finished_dirs = False
         self.compressed_suffix = "_compressed"
-        self.crop_timestamps = [90, 180, 300]
\ No newline at end of file
+        # Crop detection: samples are spread evenly over the duration unless fixed crop_timestamps (seconds) are set
+        self.crop_timestamps = None
+        self.crop_sample_count = 6
+        self.crop_frames_per_sample = 3  # keyframes decoded per sample
+        self.crop_detect_mode = "single"  # "single": one ffmpeg for all samples, "parallel": one ffmpeg per sample
+        self.crop_parallel_samples = 3  # concurrent ffmpeg processes in "parallel" mode
+        # Size prediction: encode a few short samples first, the video stream is kept (audio-only transcode)
+        # or the file is skipped when the predicted video saving is below size_prediction_min_saving_percent
+        self.size_prediction_enabled = False
+        self.size_prediction_samples = 4
+        self.size_prediction_sample_seconds = 10
+        self.size_prediction_min_saving_percent = 15
+        # Local (not on the source mount) directory for caches that survive between runs
+        self.cache_dir = Path.home() / ".cache" / "recode-script"
+        # Scratch staging for sources on a slow network mount: the next queued inputs are copied to a local
+        # directory while other files encode, the encode runs scratch to scratch, the output is written back
+        # in the background
+        self.staging_enabled = False
+        self.scratch_dir = self.cache_dir / "scratch"
+        self.scratch_budget_gb = 50  # staged inputs and outputs together
+        self.prefetch_count = 2  # queued inputs copied ahead of their encode
+        # Several hosts sharing one source_dir: lease files on the shared filesystem prevent collisions
+        self.coordination_enabled = False
+        self.lease_dir = self.source_dir / ".recode-leases"
+        self.host_id = socket.gethostname()
+        self.lease_ttl_seconds = 300  # leases not renewed for this long belong to a crashed host and are reclaimed
+        self.lease_heartbeat_seconds = 30
+        self.probe_cache_file = self.cache_dir / "probe_cache.sqlite"
+        # Outcome of every processed file, used to skip finished files on reruns
+        self.state_db_file = self.cache_dir / "state.sqlite"
+        # Detected ffmpeg encoders/filters, invalidated when the ffmpeg binary changes
+        self.capabilities_cache_file = self.cache_dir / "ffmpeg_capabilities.json"
+        # Per host, see runtime_control; a status.json with the effective limit is written next to it
+        self.control_file = self.cache_dir / "control.json"
+        self.retry_failed = False  # requeue files that failed in a previous run even if nothing changed
@@ -0,0 +1,129 @@
+import hashlib
+import json
+import logging
+import os
+import socket
+import threading
+import time
+from pathlib import Path
+
+
+class LeaseManager:
+    """Lease files on the shared filesystem so several hosts can process one tree
+
+    A host may only work on a file while it holds its lease. Leases are created
+    atomically (O_CREAT | O_EXCL) in `lease_dir`, and kept alive by a heartbeat
+    thread that touches them. A lease whose mtime is older than `ttl` belongs to
+    a crashed host and is taken over by the next host that wants the file.
+
+    Hosts compare their own clock against the mtime set by the file server, so
+    `ttl` has to be much larger than the heartbeat interval plus any clock skew.
+    """
+
+    def __init__(self, lease_dir: Path, root: Path, host_id: str = None, ttl: float = 300,
+                 heartbeat_interval: float = 30):
+        self.lease_dir = Path(lease_dir)
+        self.lease_dir.mkdir(parents=True, exist_ok=True)
+        self.root = Path(root)
+        self.host_id = host_id or socket.gethostname()
+        self.ttl = ttl
+        self.heartbeat_interval = heartbeat_interval
+        self._held = {}  # lease file -> key
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._heartbeat = None
+
+    def _lease_path(self, filepath: Path) -> Path:
+        # hosts may mount the tree at different paths, the key is relative to the root
+        try:
+            key = Path(filepath).relative_to(self.root).as_posix()
+        except ValueError:
+            key = Path(filepath).as_posix()
+        return self.lease_dir / (hashlib.sha1(key.encode()).hexdigest() + ".lease")
+
+    def _create(self, lease: Path, filepath: Path) -> bool:
+        try:
+            fd = os.open(lease, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+        except FileExistsError:
+            return False
+        with os.fdopen(fd, "w") as f:
+            json.dump({"host": self.host_id, "pid": os.getpid(), "path": str(filepath),
+                       "acquired": time.time()}, f)
+        return True
+
+    def _reclaim_if_stale(self, lease: Path) -> bool:
+        """Remove an expired lease of another host, returns True if it was removed"""
+        try:
+            age = time.time() - os.stat(lease).st_mtime
+        except FileNotFoundError:
+            return True
+        if age < self.ttl:
+            return False
+        # rename first, only one of several competing hosts can win the rename
+        stale = lease.with_name(f"{lease.name}.stale.{self.host_id}.{os.getpid()}.{threading.get_ident()}")
+        try:
+            os.rename(lease, stale)
+        except FileNotFoundError:
+            return True
+        # another host may have reclaimed and re-created the lease between stat and rename
+        if time.time() - os.stat(stale).st_mtime < self.ttl:
+            try:
+                os.link(stale, lease)
+            except FileExistsError:
+                pass
+            stale.unlink(missing_ok=True)
+            return False
+        try:
+            owner = json.loads(stale.read_text()).get("host", "?")
+        except (OSError, ValueError):
+            owner = "?"
+        logging.warning(f"Reclaiming expired lease of host {owner} ({age:.0f}s old): {lease}")
+        stale.unlink(missing_ok=True)
+        return True
+
+    def try_acquire(self, filepath: Path) -> bool:
+        """Take the lease of a file, returns False if another host holds it"""
+        lease = self._lease_path(filepath)
+        with self._lock:
+            if lease in self._held:
+                return False
+        if not self._create(lease, filepath):
+            if not self._reclaim_if_stale(lease) or not self._create(lease, filepath):
+                return False
+        with self._lock:
+            self._held[lease] = filepath
+        return True
+
+    def release(self, filepath: Path):
+        lease = self._lease_path(filepath)
+        with self._lock:
+            if self._held.pop(lease, None) is None:
+                return
+        lease.unlink(missing_ok=True)
+
+    def _heartbeat_loop(self):
+        while not self._stop.wait(self.heartbeat_interval):
+            with self._lock:
+                leases = list(self._held)
+            for lease in leases:
+                try:
+                    os.utime(lease)
+                except FileNotFoundError:
+                    logging.error(f"Lease was taken away, another host may process the same file: {lease}")
+                except OSError as e:
+                    logging.warning(f"Could not renew lease {lease}: {e}")
+
+    def start(self):
+        self._heartbeat = threading.Thread(target=self._heartbeat_loop, name="lease-heartbeat", daemon=True)
+        self._heartbeat.start()
+
+    def stop(self):
+        """Stop the heartbeat and release all leases still held"""
+        self._stop.set()
+        if self._heartbeat is not None:
+            self._heartbeat.join()
+        with self._lock:
+            leases = list(self._held)
+            self._held.clear()
+        for lease in leases:
+            lease.unlink(missing_ok=True)
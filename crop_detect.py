@@ -0,0 +1,138 @@
+import concurrent.futures
+import logging
+import re
+import subprocess
+from pathlib import Path
+from typing import Optional
+
+from config import Config
+from media_probe import MediaInfo, ProbeCache, file_fingerprint
+from process_runner import ANALYSIS, get_runner
+
+CROP_PATTERN = re.compile(r"crop=(-?\d+):(-?\d+):(-?\d+):(-?\d+)")
+
+
+def sample_positions(duration: float, count: int):
+    """Spread `count` sample timestamps evenly over the duration, skipping the very start and end"""
+    if duration <= 0 or count <= 0:
+        return [0.0]
+    return [round(duration * (i + 1) / (count + 1), 3) for i in range(count)]
+
+
+def parse_crops(output: str):
+    """Return all valid (w, h, x, y) crop values reported by cropdetect"""
+    crops = []
+    for match in CROP_PATTERN.finditer(output):
+        w, h, x, y = map(int, match.groups())
+        # fully black frames produce negative sizes
+        if w > 0 and h > 0 and x >= 0 and y >= 0:
+            crops.append((w, h, x, y))
+    return crops
+
+
+def aggregate_crops(crops, orig_width: int, orig_height: int) -> Optional[str]:
+    """Combine the crops of all samples into one that never cuts off picture content
+
+    The union of all detected picture areas is used, so dark scenes (which
+    cropdetect reports as a smaller picture) can only widen the crop, not shrink it.
+    """
+    if not crops:
+        return None
+    left = min(c[2] for c in crops)
+    top = min(c[3] for c in crops)
+    right = min(max(c[2] + c[0] for c in crops), orig_width)
+    bottom = min(max(c[3] + c[1] for c in crops), orig_height)
+    w, h = right - left, bottom - top
+
+    # Only return crop parameters if they actually crop something
+    if w < orig_width or h < orig_height or left > 0 or top > 0:
+        return f"crop={w}:{h}:{left}:{top}"
+    return None
+
+
+class CropDetector:
+    """Detect black borders from keyframes sampled over the whole file"""
+
+    def __init__(self, filepath: Path, config: Config, media_info: MediaInfo, cache: ProbeCache = None):
+        self.filepath = filepath
+        self.config = config
+        self.media_info = media_info
+        self.cache = cache
+
+    def _timestamps(self):
+        if self.config.crop_timestamps:
+            # fixed timestamps, but never seek past the end of short clips
+            duration = self.media_info.duration
+            return [t for t in self.config.crop_timestamps if not duration or t < duration] or [0.0]
+        return sample_positions(self.media_info.duration, self.config.crop_sample_count)
+
+    def _cache_params(self):
+        """Settings the detected crop depends on, part of the cache key"""
+        return (f"{self.config.crop_timestamps}:{self.config.crop_sample_count}:"
+                f"{self.config.crop_frames_per_sample}:skip0")
+
+    def _input_args(self, timestamp):
+        # fast input seeking, only keyframes are decoded
+        return ["-skip_frame", "nokey", "-ss", str(timestamp), "-i", str(self.filepath)]
+
+    def _output_args(self, input_index):
+        return [
+            "-map", f"{input_index}:v:0", "-frames:v", str(self.config.crop_frames_per_sample),
+            # cropdetect ignores the first 2 frames by default, every decoded keyframe should count
+            "-vf", "cropdetect=skip=0", "-f", "null", "-"
+        ]
+
+    def _run(self, cmd):
+        try:
+            return get_runner().run(cmd, ANALYSIS).stderr
+        except (subprocess.CalledProcessError, subprocess.TimeoutExpired) as e:
+            # partial output (e.g. a seek past the last keyframe) is still usable
+            logging.debug(f"cropdetect failed for {self.filepath}: {e}")
+            return e.stderr or ""
+
+    def _detect_single(self, timestamps):
+        """One ffmpeg process, one input (seeked) and one null output per sample"""
+        cmd = ["ffmpeg", "-hide_banner", "-nostats"]
+        for t in timestamps:
+            cmd += self._input_args(t)
+        for i in range(len(timestamps)):
+            cmd += self._output_args(i)
+        return parse_crops(self._run(cmd))
+
+    def _detect_parallel(self, timestamps):
+        """A small batch of concurrent ffmpeg processes, one per sample"""
+        def detect_at(t):
+            cmd = ["ffmpeg", "-hide_banner", "-nostats", *self._input_args(t), *self._output_args(0)]
+            return parse_crops(self._run(cmd))
+
+        crops = []
+        workers = max(1, min(self.config.crop_parallel_samples, len(timestamps)))
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            for result in executor.map(detect_at, timestamps):
+                crops += result
+        return crops
+
+    def detect(self) -> Optional[str]:
+        """Return the crop filter for the file, or None if there is nothing to crop"""
+        video = self.media_info.video
+        if video is None:
+            return None
+
+        fingerprint = None
+        if self.cache is not None:
+            fingerprint = file_fingerprint(self.filepath)
+            cached = self.cache.get_crop(self.filepath, fingerprint, self._cache_params())
+            if cached is not None:
+                return cached or None
+
+        timestamps = self._timestamps()
+        if self.config.crop_detect_mode == "parallel":
+            crops = self._detect_parallel(timestamps)
+        else:
+            crops = self._detect_single(timestamps)
+        crop = aggregate_crops(crops, video.width, video.height)
+
+        # failed detections are not cached, they are retried on the next run
+        if self.cache is not None and crops:
+            self.cache.put_crop(self.filepath, fingerprint, self._cache_params(), crop or "")
+        return crop
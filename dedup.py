@@ -0,0 +1,168 @@
+import concurrent.futures
+import hashlib
+import logging
+import os
+import threading
+from pathlib import Path
+
+HASH_BLOCK = 1 << 16  # bytes read per sampled position
+
+
+def partial_hash(filepath: Path, samples: int = 3, block: int = HASH_BLOCK) -> str:
+    """Hash of the size, the first and last block and evenly spaced blocks in between
+
+    Enough to tell copies of a video apart from different files of the same size,
+    without reading the whole file.
+    """
+    size = os.stat(filepath).st_size
+    digest = hashlib.blake2b(str(size).encode(), digest_size=16)
+    offsets = [0] + [size * (i + 1) // (samples + 1) for i in range(samples)] + [max(0, size - block)]
+    with open(filepath, "rb") as f:
+        for offset in offsets:
+            f.seek(offset)
+            digest.update(f.read(block))
+    return digest.hexdigest()
+
+
+class _Group:
+    """Paths with the same content, the primary is the one that is processed"""
+
+    def __init__(self, primary: Path, st: os.stat_result):
+        self.primary = primary
+        self.fingerprint = (st.st_size, st.st_mtime_ns)
+        self.hash = None
+        self.planned = False  # the primary needs an encode
+        self.done = False
+        self.result = None
+        self.error = None
+        self.duplicates = []  # (processor, is hardlink) waiting for the primary
+
+    def content_hash(self, samples: int):
+        """Hash of the primary, None if it can't be read as it was when found (e.g. already replaced)"""
+        if self.hash is None:
+            try:
+                st = os.stat(self.primary)
+                if (st.st_size, st.st_mtime_ns) == self.fingerprint:
+                    self.hash = partial_hash(self.primary, samples)
+            except OSError:
+                pass
+        return self.hash
+
+
+class Deduplicator:
+    """Makes sure hardlinks and copies of the same video are analyzed and encoded once
+
+    Files are grouped by (st_dev, st_ino) for hardlinks and by size plus
+    partial_hash for copies. The first path of a group is processed, the others
+    take its result once it is finished (FileProcessor.take_result_of): they
+    are hardlinked to the encode (copies only with relink_copies and on the same
+    filesystem) or get a copy of it, through the usual _replace_original swap.
+    Duplicates waiting for a primary that fails are reported as failed, so the
+    next run retries them; ones found after the failure, or after the primary
+    was already replaced, are processed on their own.
+
+    Duplicates are linked/copied on a worker thread of their own, so the result
+    callback of the pipeline and the discovery never wait for the copies.
+    close() waits for the pending ones.
+    """
+
+    def __init__(self, on_result, samples: int = 3, relink_copies: bool = False):
+        # called as on_result(filepath, result, error) for every duplicate once it was handled
+        self.on_result = on_result
+        self.samples = samples
+        self.relink_copies = relink_copies
+        self._lock = threading.Lock()
+        self._by_inode = {}  # (st_dev, st_ino) -> group
+        self._unhashed = {}  # size -> groups, hashed once another file of their size shows up
+        self._by_content = {}  # (size, partial hash) -> group
+        self._hashed_sizes = set()  # sizes in _by_content, files of these sizes are hashed when found
+        self._by_primary = {}  # primary path -> group
+        self.duplicates = 0
+        self._worker = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="dedup")
+
+    def _find_group(self, filepath: Path, st: os.stat_result):
+        """The group of filepath, whether it is a hardlink of its primary, and the content key of filepath"""
+        group = self._by_inode.get((st.st_dev, st.st_ino))
+        # hardlinks share size and mtime, anything else reuses the inode of a replaced primary
+        if group is not None and group.fingerprint == (st.st_size, st.st_mtime_ns):
+            return group, True, None
+        unhashed = self._unhashed.pop(st.st_size, [])
+        for candidate in unhashed:
+            content_hash = candidate.content_hash(self.samples)
+            if content_hash is not None:  # primaries replaced before they were hashed can't be matched
+                self._by_content.setdefault((st.st_size, content_hash), candidate)
+                self._hashed_sizes.add(st.st_size)
+        if st.st_size not in self._hashed_sizes:
+            return None, False, None
+        key = (st.st_size, partial_hash(filepath, self.samples))
+        return self._by_content.get(key), False, key
+
+    def claim(self, processor) -> bool:
+        """Register a discovered file, returns True if it is a duplicate that must not be processed itself"""
+        filepath = processor.filepath
+        try:
+            st = os.stat(filepath)
+            with self._lock:
+                group, hardlink, key = self._find_group(filepath, st)
+                if group is None or (group.done and group.error is not None):
+                    group = _Group(filepath, st)
+                    self._by_inode[(st.st_dev, st.st_ino)] = group
+                    if key is None:
+                        self._unhashed.setdefault(st.st_size, []).append(group)
+                    else:
+                        group.hash = key[1]
+                        self._by_content[key] = group  # replaces a failed primary
+                        self._hashed_sizes.add(st.st_size)
+                    self._by_primary[filepath] = group
+                    return False
+                self.duplicates += 1
+                logging.info(f"{filepath} is a {'hardlink' if hardlink else 'copy'} of {group.primary}")
+                if not group.done:
+                    group.duplicates.append((processor, hardlink))
+                    return True
+        except OSError as e:
+            logging.warning(f"Could not check {filepath} for duplicates: {e}")
+            return False
+        # the primary was finished before this duplicate was found
+        self._worker.submit(self._apply, group, processor, hardlink)
+        return True
+
+    def seal(self, filepath: Path):
+        """Called when a primary gets an encode plan: hash it while the original is still there"""
+        with self._lock:
+            group = self._by_primary.get(filepath)
+            if group is None:
+                return
+            group.planned = True
+            try:
+                group.content_hash(self.samples)
+            except OSError as e:
+                logging.warning(f"Could not hash {filepath}: {e}")
+
+    def finish(self, filepath: Path, result, error):
+        """Called with the result of a primary, hands it to the duplicates found so far"""
+        with self._lock:
+            group = self._by_primary.get(filepath)
+            if group is None:
+                return
+            group.done, group.result, group.error = True, result, error
+            waiting, group.duplicates = group.duplicates, []
+        for processor, hardlink in waiting:
+            self._worker.submit(self._apply, group, processor, hardlink)
+
+    def close(self):
+        """Wait until every duplicate handed over so far is finished"""
+        self._worker.shutdown(wait=True)
+
+    def _apply(self, group: _Group, processor, hardlink: bool):
+        if group.error is not None:
+            self.on_result(processor.filepath, None,
+                           Exception(f"Not processed, {group.primary} with the same content failed: {group.error}"))
+            return
+        try:
+            result = processor.take_result_of(Path(group.result) if group.planned else None,
+                                              link=hardlink or self.relink_copies)
+        except Exception as e:
+            self.on_result(processor.filepath, None, e)
+            return
+        self.on_result(processor.filepath, result, None)
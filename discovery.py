@@ -0,0 +1,178 @@
+import fnmatch
+import logging
+import os
+import queue
+import threading
+from pathlib import Path
+
+_WALKER_DONE = object()  # sentinel a walker thread puts into the queue when it finished its subtree
+
+
+def _matches(relative: str, patterns) -> bool:
+    return any(fnmatch.fnmatch(relative, pattern) for pattern in patterns)
+
+
+class DirectoryWalker:
+    """Stream video files of a tree with os.scandir, yielding them as soon as they are found
+
+    include/exclude are glob patterns matched against the path relative to the
+    root (with "/" separators). Excluded directories are not descended into.
+    Optionally, each top-level directory is walked by its own thread.
+    """
+
+    def __init__(self, root: Path, video_exts, include=None, exclude=None, parallel_walkers: int = 1,
+                 is_dir_finished=None, on_dir_listed=None, clean_dir=None):
+        self.root = Path(root)
+        self.video_exts = {ext.lower() for ext in video_exts}
+        self.include = list(include or [])
+        self.exclude = list(exclude or [])
+        self.parallel_walkers = parallel_walkers
+        # is_dir_finished(path, mtime_ns) -> True skips the files of a directory (subdirectories are still walked)
+        self.is_dir_finished = is_dir_finished
+        # on_dir_listed(path, files) is called with the video files yielded from each directory
+        self.on_dir_listed = on_dir_listed
+        # clean_dir(path, names) is called with the entry names of each directory before its files
+        # are yielded, and returns the names of the entries it removed
+        self.clean_dir = clean_dir
+
+    def _relative(self, path: str) -> str:
+        return Path(os.path.relpath(path, self.root)).as_posix()
+
+    def _is_candidate(self, entry: os.DirEntry) -> bool:
+        name = entry.name
+        if name.startswith("._"):
+            return False
+        if os.path.splitext(name)[1].lower() not in self.video_exts:
+            return False
+        relative = self._relative(entry.path)
+        if self.include and not _matches(relative, self.include):
+            return False
+        return not _matches(relative, self.exclude)
+
+    def _scan_dir(self, directory: str, names=None):
+        """Return (video files, subdirectories) of one directory, both sorted by name
+
+        The names of all entries are appended to names, if given.
+        """
+        files, subdirs = [], []
+        try:
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    if names is not None:
+                        names.append(entry.name)
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            if not _matches(self._relative(entry.path), self.exclude):
+                                subdirs.append(entry.path)
+                        elif entry.is_file() and self._is_candidate(entry):
+                            files.append(entry.path)
+                    except OSError as e:
+                        logging.warning(f"Could not read {entry.path}: {e}")
+        except OSError as e:
+            logging.warning(f"Could not list {directory}: {e}")
+        return sorted(files), sorted(subdirs)
+
+    def _dir_is_finished(self, directory: str) -> bool:
+        if self.is_dir_finished is None:
+            return False
+        try:
+            return self.is_dir_finished(Path(directory), os.stat(directory).st_mtime_ns)
+        except OSError:
+            return False
+
+    def _walk(self, top: str, recurse: bool = True):
+        """Depth-first walk, yields files of a directory before descending into its subdirectories"""
+        stack = [top]
+        while stack:
+            directory = stack.pop()
+            names = [] if self.clean_dir is not None else None
+            files, subdirs = self._scan_dir(directory, names)
+            if names:
+                removed = set(self.clean_dir(Path(directory), names))
+                if removed:
+                    files = [f for f in files if os.path.basename(f) not in removed]
+                    subdirs = [d for d in subdirs if os.path.basename(d) not in removed]
+            if files and self._dir_is_finished(directory):
+                logging.debug(f"Skipping finished directory {directory}")
+                files = []
+            if self.on_dir_listed is not None:
+                self.on_dir_listed(Path(directory), [Path(f) for f in files])
+            for f in files:
+                yield Path(f)
+            if recurse:
+                stack.extend(reversed(subdirs))
+
+    def __iter__(self):
+        if self.parallel_walkers <= 1:
+            yield from self._walk(str(self.root))
+            return
+
+        # files directly in the root first, then one walker per top-level directory
+        yield from self._walk(str(self.root), recurse=False)
+        _, top_dirs = self._scan_dir(str(self.root))
+        if not top_dirs:
+            return
+
+        found = queue.Queue(maxsize=1000)
+        pending_dirs = queue.Queue()
+        for d in top_dirs:
+            pending_dirs.put(d)
+
+        def walker():
+            while True:
+                try:
+                    top = pending_dirs.get_nowait()
+                except queue.Empty:
+                    break
+                for path in self._walk(top):
+                    found.put(path)
+            found.put(_WALKER_DONE)
+
+        walker_count = min(self.parallel_walkers, len(top_dirs))
+        for i in range(walker_count):
+            threading.Thread(target=walker, name=f"walker-{i}", daemon=True).start()
+
+        finished_walkers = 0
+        while finished_walkers < walker_count:
+            item = found.get()
+            if item is _WALKER_DONE:
+                finished_walkers += 1
+                continue
+            yield item
+
+
+class DirectoryTracker:
+    """Marks a directory finished once every video file yielded from it was processed successfully"""
+
+    def __init__(self, mark_finished):
+        # mark_finished(path, mtime_ns) is called when a directory is finished
+        self.mark_finished = mark_finished
+        self._lock = threading.Lock()
+        self._outstanding = {}  # directory -> number of files not yet finished
+        self._failed = set()
+
+    def dir_listed(self, directory: Path, files):
+        if not files:
+            return
+        with self._lock:
+            self._outstanding[directory] = self._outstanding.get(directory, 0) + len(files)
+
+    def file_done(self, filepath: Path, success: bool):
+        directory = Path(filepath).parent
+        with self._lock:
+            if directory not in self._outstanding:
+                return
+            if not success:
+                self._failed.add(directory)
+            self._outstanding[directory] -= 1
+            if self._outstanding[directory] > 0:
+                return
+            del self._outstanding[directory]
+            finished = directory not in self._failed
+            self._failed.discard(directory)
+        if finished:
+            try:
+                # our own encodes changed the directory, so its current mtime is recorded
+                self.mark_finished(directory, os.stat(directory).st_mtime_ns)
+            except OSError as e:
+                logging.warning(f"Could not record finished directory {directory}: {e}")
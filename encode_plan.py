@@ -0,0 +1,77 @@
+from pathlib import Path
+
+
+class EncodePlan:
+    """Everything needed to run the encode of one file, built by the analysis stage
+
+    The encode stage only runs ffmpeg with the command built from the plan, it
+    never probes the file again.
+    """
+
+    def __init__(self, source: Path, output: Path, map_cmd, video_cmd, audio_cmd, subtitle_cmd, metadata_cmd,
+                 video_transcode: bool, audio_transcode: bool, duration: float = 0.0, width: int = 0,
+                 height: int = 0, source_codec: str = "", fingerprint=None, threads: int = 1,
+                 chunks=None, parallel_segments: int = 1):
+        self.source = Path(source)
+        self.output = Path(output)
+        self.map_cmd = list(map_cmd)
+        self.video_cmd = list(video_cmd)
+        self.audio_cmd = list(audio_cmd)
+        self.subtitle_cmd = list(subtitle_cmd)
+        self.metadata_cmd = list(metadata_cmd)
+        self.video_transcode = video_transcode
+        self.audio_transcode = audio_transcode
+        self.duration = duration
+        self.width = width
+        self.height = height
+        self.source_codec = source_codec
+        self.fingerprint = tuple(fingerprint) if fingerprint else None
+        self.threads = threads  # CPU budget reserved by the EncodeScheduler
+        self.cpus = None  # CPUs the encode is pinned to, assigned when it starts, not part of the plan file
+        # (start, end) of video chunks encoded in parallel, empty for a regular single-process encode
+        self.chunks = [tuple(chunk) for chunk in chunks or []]
+        self.parallel_segments = parallel_segments  # chunks encoded at the same time, 1 for checkpointed encodes
+
+    def build_command(self, input_path: Path = None, output_path: Path = None, stats: bool = False):
+        """Build the ffmpeg argv, optionally reading from / writing to other paths than planned"""
+        return [
+            "ffmpeg", "-y", "-i", str(input_path or self.source),
+            *self.map_cmd,
+            *self.video_cmd,
+            *self.audio_cmd,
+            "-c:s", "copy",
+            "-movflags", "use_metadata_tags",
+            *self.subtitle_cmd,
+            *self.metadata_cmd,
+            "-stats" if stats else "-nostats",
+            str(output_path or self.output)
+        ]
+
+    def audio_codecs(self):
+        """Target codec of every mapped audio stream, "copy" for streams that are not transcoded"""
+        return [self.audio_cmd[i + 1] for i, arg in enumerate(self.audio_cmd) if arg.startswith("-c:a")]
+
+    def to_dict(self):
+        return {
+            "source": str(self.source),
+            "output": str(self.output),
+            "map_cmd": self.map_cmd,
+            "video_cmd": self.video_cmd,
+            "audio_cmd": self.audio_cmd,
+            "subtitle_cmd": self.subtitle_cmd,
+            "metadata_cmd": self.metadata_cmd,
+            "video_transcode": self.video_transcode,
+            "audio_transcode": self.audio_transcode,
+            "duration": self.duration,
+            "width": self.width,
+            "height": self.height,
+            "source_codec": self.source_codec,
+            "fingerprint": list(self.fingerprint) if self.fingerprint else None,
+            "threads": self.threads,
+            "chunks": [list(chunk) for chunk in self.chunks],
+            "parallel_segments": self.parallel_segments,
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict):
+        return cls(**data)
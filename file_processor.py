@@ -1,38 +1,212 @@
 import os
 import shutil
-import subprocess
-import platform
 import logging
-import json
-import re
 from pathlib import Path
-import platform
+from audio_bitrate import estimate_audio_bitrates
+from capabilities import FFmpegCapabilities, get_capabilities
+from chunked_encode import ChunkedEncoder, chunk_targets, find_keyframes, plan_chunks
 from config import Config
+from crop_detect import CropDetector
+from encode_plan import EncodePlan
+from metrics import FileMetrics, MetricsReport
+from media_probe import MediaInfo, ProbeCache, file_fingerprint, probe_media
+from process_runner import RunnerStopped, get_runner
+from progress import EncodeMonitor, run_ffmpeg
+from runtime_control import job_cpus
+from scheduler import affinity_prefix, available_cpus, low_priority_prefix, thread_budget
+from size_prediction import SizePredictor
+from staging import ScratchStaging
+from state_store import ENCODED, FAILED, UNTOUCHED, StateStore, has_settings_tags, settings_key
 
 
 class FileProcessor:
-    def __init__(self, filepath: Path, config: Config):
+    def __init__(self, filepath: Path, config: Config, probe_cache: ProbeCache = None, state_store: StateStore = None,
+                 capabilities: FFmpegCapabilities = None, monitor: EncodeMonitor = None,
+                 report: MetricsReport = None, staging: ScratchStaging = None):
         self.filepath = filepath
         self.config = config
+        self.probe_cache = probe_cache
+        self.state_store = state_store
+        self.capabilities = capabilities
+        self.monitor = monitor
+        self.report = report
+        self.staging = staging
+        self.metrics = FileMetrics(filepath)
+        self.settings_key = settings_key(config)
         self._aac_encoder_info = None  # Cache for encoder detection
+        self._media_info = None  # Cache for the ffprobe result
     
     def process(self):
         """Process the video file through the complete lifecycle"""
+        plan = self.analyze()
+        if plan is None:
+            return self.filepath
+        return self.execute(plan)
+
+    def analyze(self):
+        """Analyze the file and return its EncodePlan, or None if no transcoding is needed"""
+        logging.info(f"Analyzing {self.filepath}")
+        try:
+            if self._is_previous_output():
+                logging.info(f"Already encoded by a previous run, leaving file untouched: {self.filepath}")
+                self._record_outcome(self.filepath, ENCODED)
+                return None
+            plan = self._plan_compression()
+            if plan is None:
+                # failed analysis processes are tolerated, after a stop that may look like nothing to do
+                self._raise_if_stopped()
+                self._record_outcome(self.filepath, UNTOUCHED)
+            return plan
+        except Exception as e:
+            self._raise_if_stopped(e)
+            logging.error(f"Failed: {self.filepath} - {e}")
+            self._record_outcome(self.filepath, FAILED, str(e))
+            raise Exception(f"Failed analyzing {self.filepath}: {e}")
+
+    def execute(self, plan: EncodePlan):
+        """Run the encode of a plan and replace the original file with the result
+
+        Returns the final path, or a Future of it if the output is written back from scratch.
+        """
         logging.info(f"Processing {self.filepath}")
+        self.metrics.set(
+            target_video_codec="av1" if plan.video_transcode else "copy",
+            target_audio_codecs=plan.audio_codecs(),
+            chunks=len(plan.chunks),
+        )
+        # plans read from a plan file were analyzed by another process
+        if plan.fingerprint:
+            self.metrics.fields.setdefault("input_size", plan.fingerprint[0])
+        self.metrics.fields.setdefault("duration", plan.duration)
         try:
-            compressed_path = self._compress_video()
-            final_path = self._replace_original(compressed_path)
+            if self.staging is not None:
+                write_back = self._execute_staged(plan)
+                if write_back is not None:
+                    return write_back
+            with self.metrics.stage("encode"):
+                compressed_path = self._execute_compression(plan)
+            with self.metrics.stage("replace"):
+                final_path = self._replace_original(compressed_path)
+            self._record_outcome(final_path, ENCODED)
             return final_path
         except Exception as e:
+            self._raise_if_stopped(e)
             logging.error(f"Failed: {self.filepath} - {e}")
+            self._record_outcome(self.filepath, FAILED, str(e))
             raise Exception(f"Failed processing {self.filepath}: {e}")
+
+    def _raise_if_stopped(self, error: Exception = None):
+        """Raise RunnerStopped if the run was stopped, no outcome is recorded so the next run retries the file"""
+        if isinstance(error, RunnerStopped) or get_runner().stopped:
+            logging.info(f"Interrupted: {self.filepath}")
+            raise RunnerStopped(f"Interrupted processing {self.filepath}") from error
     
+    def _execute_staged(self, plan: EncodePlan):
+        """Encode from and to scratch, returns the Future of the write-back or None if the input is not staged"""
+        input_path = self.staging.staged_input(self.filepath)
+        if input_path is None:
+            return None
+        scratch_output = self.staging.scratch_output(self.filepath)
+        try:
+            with self.metrics.stage("encode"):
+                # the segments are kept until the write-back, a failed one resumes from them
+                self._execute_compression(plan, input_path, scratch_output, keep_chunks=True)
+        except Exception:
+            self.staging.discard(self.filepath)  # keeps the finished segments
+            raise
+        self.staging.release_input(self.filepath)
+        return self.staging.write_back(self.filepath, lambda: self._write_back(scratch_output, plan.output))
+
+    def _write_back(self, scratch_output: Path, output: Path):
+        """Copy a scratch output next to the original and swap it in, runs on a write-back thread"""
+        try:
+            with self.metrics.stage("write_back"):
+                shutil.copyfile(scratch_output, output)
+            with self.metrics.stage("replace"):
+                final_path = self._replace_original(output)
+            self._record_outcome(final_path, ENCODED)
+            return final_path
+        except Exception as e:
+            logging.error(f"Failed: {self.filepath} - {e}")
+            output.unlink(missing_ok=True)
+            self._record_outcome(self.filepath, FAILED, str(e))
+            raise Exception(f"Failed processing {self.filepath}: {e}")
+
+    def take_result_of(self, encoded: Path, link: bool = True):
+        """Finish this file with the result of an identical file (see dedup.Deduplicator)
+
+        encoded is the final path of its encode, or None if it needed none. The
+        encode is hardlinked (if link and on the same filesystem) or copied next to
+        this file and swapped in like an own encode.
+        """
+        if encoded is None:
+            self._record_outcome(self.filepath, UNTOUCHED)
+            return self.filepath
+        output = self._get_output_path()
+        try:
+            with self.metrics.stage("replace"):
+                linked = False
+                if link:
+                    try:
+                        os.link(encoded, output)
+                        linked = True
+                    except OSError:  # e.g. on another filesystem
+                        pass
+                if not linked:
+                    shutil.copyfile(encoded, output)
+                final_path = self._replace_original(output)
+            self._record_outcome(final_path, ENCODED)
+            return final_path
+        except Exception as e:
+            logging.error(f"Failed: {self.filepath} - {e}")
+            output.unlink(missing_ok=True)
+            self._record_outcome(self.filepath, FAILED, str(e))
+            raise Exception(f"Failed processing {self.filepath}: {e}")
+
     def should_skip(self):
         """Check if this file should be skipped"""
         if self.config.compressed_suffix in self.filepath.stem:
             logging.info(f"Skipping {self.filepath} because it is a temporary file")
             return True
+        if self.state_store is not None:
+            try:
+                fingerprint = file_fingerprint(self.filepath)
+            except OSError:
+                return False
+            if self.state_store.is_finished(self.filepath, fingerprint, self.settings_key):
+                logging.info(f"Skipping {self.filepath} because it was already processed with the current settings")
+                return True
         return False
+
+    def _is_previous_output(self):
+        """Check if the file carries the settings tags written by _build_metadata_commands"""
+        return has_settings_tags(self._get_media_info().format_tags)
+
+    def _record_outcome(self, path: Path, outcome: str, reason: str = None):
+        """Store the outcome of processing in the state store and the metrics report, if used"""
+        self._write_metrics(path, outcome, reason)
+        if self.state_store is None:
+            return
+        try:
+            self.state_store.record(path, file_fingerprint(path), outcome, self.settings_key, reason)
+        except Exception as e:
+            logging.warning(f"Could not record state for {path}: {e}")
+
+    def _write_metrics(self, path: Path, outcome: str, reason: str = None):
+        """Write the metrics record of this file to the report"""
+        if self.report is None:
+            return
+        self.metrics.set(outcome=outcome, output_path=str(path))
+        if reason is not None:
+            self.metrics.set(reason=reason)
+        try:
+            self.metrics.set(output_size=os.stat(path).st_size)
+        except OSError:
+            pass
+        try:
+            self.report.write(self.metrics)
+        except Exception as e:
+            logging.warning(f"Could not write metrics for {path}: {e}")
     
     def _get_available_aac_encoder(self):
         """Detect which AAC encoder is available and return encoder info"""
@@ -40,16 +214,16 @@ class FileProcessor:
             return self._aac_encoder_info
             
         try:
-            # Check if libfdk_aac is available
-            cmd = ["ffmpeg", "-hide_banner", "-encoders"]
-            result = subprocess.run(cmd, capture_output=True, text=True, check=True)
-            
-            if "libfdk_aac" in result.stdout:
+            # The registry is detected once per run and shared by all processors
+            if self.capabilities is None:
+                self.capabilities = get_capabilities(self.config.capabilities_cache_file)
+
+            if self.capabilities.has_encoder("libfdk_aac"):
                 self._aac_encoder_info = ("libfdk_aac", "vbr", self.config.audio_multichannel_vbr_level)
-                logging.info("Using libfdk_aac encoder for multi-channel audio")
-            elif "aac_at" in result.stdout:
+                logging.debug("Using libfdk_aac encoder for multi-channel audio")
+            elif self.capabilities.has_encoder("aac_at"):
                 self._aac_encoder_info = ("aac_at", "q:a", self.config.audio_multichannel_aac_at_quality)
-                logging.info("Using aac_at encoder for multi-channel audio")
+                logging.debug("Using aac_at encoder for multi-channel audio")
             else:
                 raise Exception("No suitable AAC encoder found")
                 
@@ -58,73 +232,37 @@ class FileProcessor:
             
         return self._aac_encoder_info
     
+    def _get_media_info(self) -> MediaInfo:
+        """Probe the file once, every other method reads from the result"""
+        if self._media_info is None:
+            with self.metrics.stage("probe"):
+                self._media_info = probe_media(self.filepath, self.probe_cache)
+            video = self._media_info.video
+            self.metrics.set(
+                input_size=os.stat(self.filepath).st_size,
+                duration=self._media_info.duration,
+                source_video_codec=video.codec_name if video else None,
+                source_audio_codecs=[s.codec_name for s in self._media_info.audio_streams],
+            )
+        return self._media_info
+
     def _get_resolution(self):
         """Get video resolution"""
-        cmd = [
-            "ffprobe", "-v", "error", "-select_streams", "v:0",
-            "-show_entries", "stream=width,height", "-of", "json",
-            str(self.filepath)
-        ]
-        output = subprocess.check_output(cmd).decode()
-        data = json.loads(output)
-        stream = data["streams"][0]
-        return int(stream["width"]), int(stream["height"])
+        video = self._get_media_info().video
+        if video is None:
+            raise Exception(f"No video stream found in {self.filepath}")
+        return video.width, video.height
     
     def _get_crop_params(self):
         """Get crop parameters for the video"""
-        crops = []
-        for t in self.config.crop_timestamps:
-            cmd = [
-                "ffmpeg", "-ss", str(t), "-i", str(self.filepath),
-                "-vframes", "10", "-vf", "cropdetect",
-                "-f", "null", "-"
-            ]
-            try:
-                result = subprocess.check_output(cmd, stderr=subprocess.STDOUT).decode()
-                crop_matches = re.findall(r"crop=\d+:\d+:\d+:\d+", result)
-                crops += crop_matches
-            except subprocess.CalledProcessError:
-                continue
-
-        if not crops:
-            return None
-
-        crop_values = [list(map(int, x.split("=")[1].split(":"))) for x in crops]
-        w = max(c[0] for c in crop_values)
-        h = max(c[1] for c in crop_values)
-        x = min(c[2] for c in crop_values)
-        y = min(c[3] for c in crop_values)
-        
-        # Get original resolution to compare
-        orig_width, orig_height = self._get_resolution()
-        
-        # Only return crop parameters if they actually crop something
-        # (i.e., if the crop dimensions are smaller than original or offset from 0,0)
-        if w < orig_width or h < orig_height or x > 0 or y > 0:
-            return f"crop={w}:{h}:{x}:{y}"
-        
-        return None
-    
-    def _get_low_priority_prefix(self):
-        """Return the command prefix to run a process at lowest priority based on OS"""
-        system = platform.system().lower()
-        if system == 'darwin':  # macOS
-            return ["nice", "-n", "20"]
-        elif system == 'linux':
-            return ["nice", "-n", "19"]
-        elif system == 'windows':
-            return ["start", "/low", "/wait", "cmd", "/c"]
-        return []  # Default: no prefix
+        detector = CropDetector(self.filepath, self.config, self._get_media_info(), self.probe_cache)
+        with self.metrics.stage("cropdetect"):
+            return detector.detect()
     
     def _should_copy_video_stream(self):
         """Check if the video stream should be copied based on codec and filename"""
-        cmd_check_codec = [
-            "ffprobe", "-v", "error", "-select_streams", "v:0",
-            "-show_entries", "stream=codec_name", "-of", "default=nw=1:nk=1",
-            str(self.filepath)
-        ]
         try:
-            codec = subprocess.check_output(cmd_check_codec).decode().strip()
+            codec = self._get_media_info().video.codec_name
             if codec == 'av1':
                 return True
             return codec == "hevc" and "FuN" in self.filepath.name
@@ -134,19 +272,14 @@ class FileProcessor:
     
     def _analyze_audio_streams(self):
         """Analyze audio streams and determine what processing is needed"""
-        cmd = [
-            "ffprobe", "-v", "error", "-select_streams", "a",
-            "-show_entries", "stream=channels,bit_rate:format=duration", "-of", "json", str(self.filepath)
-        ]
         try:
-            output = subprocess.check_output(cmd).decode()
-            data = json.loads(output)
-            streams = data.get("streams", [])
+            media_info = self._get_media_info()
+            streams = media_info.audio_streams
             if not streams:
                 return [], False
 
             # Get duration from format section
-            duration = float(data.get("format", {}).get("duration", 0))
+            duration = media_info.duration
             
             stream_targets = []
             transcode_anything = False
@@ -154,13 +287,19 @@ class FileProcessor:
             # Get available AAC encoder info
             encoder_name, quality_param, quality_value = self._get_available_aac_encoder()
 
+            # Streams without a bit_rate tag are measured together in a single pass
+            measured_bitrates = {}
+            if any(s.bit_rate == 0 for s in streams):
+                measured_bitrates = self._get_actual_audio_bitrates(duration)
+
             for i, s in enumerate(streams):
-                ch = s.get("channels", 2)
-                src_br = int(s.get("bit_rate", 0)) // 1000
+                ch = s.channels
+                src_br = s.bit_rate // 1000
+                bitrate_measured = src_br == 0
                 
-                # If bitrate is unknown, get it by extracting the stream
-                if src_br == 0:
-                    src_br = self._get_actual_audio_bitrate(i, duration)
+                # If bitrate is unknown, use the measured one
+                if bitrate_measured:
+                    src_br = measured_bitrates.get(i, 1)  # fallback: minimal bitrate, prevent multiple reencodes in case of errors
                 
                 # For stereo/mono: use target bitrate, for multi-channel: use VBR (no bitrate comparison needed)
                 if ch > 2:
@@ -203,6 +342,7 @@ class FileProcessor:
                     'target_bitrate': tgt_br,
                     'target_codec': target_codec,
                     'needs_transcode': needs_transcode,
+                    'bitrate_measured': bitrate_measured,
                     'encoder_name': encoder_name if ch > 2 else target_codec,
                     'quality_param': quality_param if ch > 2 else None,
                     'quality_value': quality_value if ch > 2 else None
@@ -270,44 +410,112 @@ class FileProcessor:
     
     def _get_subtitle_dispositions(self):
         """Get subtitle stream dispositions"""
-        cmd = [
-            "ffprobe", "-v", "error", "-select_streams", "s",
-            "-show_entries", "stream=index:stream_tags=DISPOSITION_DEFAULT",
-            "-of", "json", str(self.filepath)
-        ]
         try:
-            result = subprocess.check_output(cmd).decode()
-            data = json.loads(result)
             dispositions = []
 
-            for stream in data.get("streams", []):
-                index = stream.get("index", 0)  # Get actual stream index from ffprobe
-                tags = stream.get("tags", {})
-                is_default = tags.get("DISPOSITION_DEFAULT", "0") == "1"
+            for stream in self._get_media_info().subtitle_streams:
+                index = stream.index  # Get actual stream index from ffprobe
+                is_default = stream.tags.get("DISPOSITION_DEFAULT", "0") == "1"
                 dispositions.append((index, is_default))
             return dispositions
         except:
             return []
     
-    def _compress_video(self):
-        """Compress the video file"""
+    def _plan_compression(self):
+        """Build the EncodePlan, or return None if no transcoding is needed"""
         # Build command components
         video_cmd = self._build_video_commands()
+        if self.config.size_prediction_enabled and video_cmd != ["-c:v", "copy"]:
+            video_cmd = self._check_predicted_saving(video_cmd)
         audio_transcode, audio_cmd = self._get_audio_bitrate_cmd()
         
         # Check if any transcoding is needed
         video_transcode = video_cmd != ["-c:v", "copy"]
         if not audio_transcode and not video_transcode:
             logging.info("No transcoding needed, leaving file untouched: %s", str(self.filepath))
-            return self.filepath
-        
-        # Transcoding needed, build remaining components and execute
-        dst = self._get_output_path()
-        map_cmd = self._build_map_commands()
-        subtitle_cmd = self._build_subtitle_commands()
-        metadata_cmd = self._build_metadata_commands(video_cmd, audio_cmd)
+            return None
         
-        return self._execute_compression(dst, map_cmd, video_cmd, audio_cmd, subtitle_cmd, metadata_cmd, audio_transcode)
+        # Transcoding needed, build remaining components
+        media_info = self._get_media_info()
+        video = media_info.video
+        chunks, parallel = self._plan_chunks(media_info.duration) if video_transcode else ([], 1)
+        threads = 1  # a stream copy with audio transcoding needs about one core
+        if video_transcode:
+            threads = self._get_thread_budget()[0]
+            if parallel > 1:
+                threads = min(threads * parallel, self.config.encode_cpus or available_cpus())
+        return EncodePlan(
+            source=self.filepath,
+            output=self._get_output_path(),
+            map_cmd=self._build_map_commands(),
+            video_cmd=video_cmd,
+            audio_cmd=audio_cmd,
+            subtitle_cmd=self._build_subtitle_commands(),
+            metadata_cmd=self._build_metadata_commands(video_cmd, audio_cmd),
+            video_transcode=video_transcode,
+            audio_transcode=audio_transcode,
+            duration=media_info.duration,
+            width=video.width if video else 0,
+            height=video.height if video else 0,
+            source_codec=video.codec_name if video else "",
+            fingerprint=file_fingerprint(self.filepath),
+            threads=threads,
+            chunks=chunks,
+            parallel_segments=parallel,
+        )
+
+    def _check_predicted_saving(self, video_cmd):
+        """Encode samples with video_cmd, returns a stream copy instead if the saving would be too small"""
+        media_info = self._get_media_info()
+        predictor = SizePredictor(self.filepath, self.config, media_info, video_cmd, self.probe_cache,
+                                  low_priority_prefix())
+        with self.metrics.stage("size_prediction"):
+            prediction = predictor.predict()
+        if prediction is None:
+            return video_cmd
+
+        saving = prediction.saving_percent
+        encode_seconds = prediction.predicted_encode_seconds(media_info.duration)
+        self.metrics.set(predicted_saving_percent=round(saving, 2),
+                         predicted_video_size=prediction.predicted_video_bytes(media_info.duration),
+                         predicted_encode_seconds=round(encode_seconds, 1))
+        if saving < self.config.size_prediction_min_saving_percent:
+            logging.info(f"Predicted video saving of {saving:.1f}% is below "
+                         f"{self.config.size_prediction_min_saving_percent}%, keeping the video stream: {self.filepath}")
+            return ["-c:v", "copy"]
+        logging.info(f"Predicted video saving of {saving:.1f}%, encode takes about {encode_seconds / 60:.0f} "
+                     f"single-threaded min: "
+                     f"{self.filepath}")
+        return video_cmd
+
+    def _plan_chunks(self, duration):
+        """Split long files at keyframes, returns (chunks, segments encoded in parallel)
+
+        Files of at least chunked_min_duration get a chunked parallel encode, files of
+        at least checkpoint_min_duration are encoded segment by segment so they can be
+        resumed. ([], 1) means a regular encode in one piece.
+        """
+        if self.config.chunked_encoding and duration >= self.config.chunked_min_duration:
+            min_seconds = self.config.chunk_min_seconds
+            targets = chunk_targets(duration, min_seconds, self.config.chunked_max_chunks)
+            parallel = self.config.chunked_parallel_segments
+        elif (self.config.checkpoint_min_duration is not None
+              and duration >= self.config.checkpoint_min_duration):
+            # the split points are evenly spaced, the keyframes before them may come a little earlier
+            min_seconds = self.config.checkpoint_segment_seconds / 2
+            targets = chunk_targets(duration, self.config.checkpoint_segment_seconds,
+                                    int(duration // self.config.checkpoint_segment_seconds))
+            parallel = 1
+        else:
+            return [], 1
+        try:
+            with self.metrics.stage("keyframes"):
+                keyframes = find_keyframes(self.filepath, targets)
+        except Exception as e:
+            logging.warning(f"Could not find keyframes of {self.filepath}, encoding it in one piece: {e}")
+            return [], 1
+        chunks = plan_chunks(keyframes, duration, min_seconds)
+        return chunks, max(1, min(parallel, len(chunks)))
     
     def _get_output_path(self):
         """Get the output file path"""
@@ -345,6 +553,9 @@ class FileProcessor:
             f"enable-qm=1:qm-min=0:tune=2:"
             f"enable-variance-boost=1:keyint={self.config.keyint_seconds}"
         )
+        if self.config.encode_scheduler == "adaptive":
+            _, lp_level = self._get_thread_budget()
+            svt_params += f":lp={lp_level}"
         
         video_cmd = [
             "-c:v", "libsvtav1",
@@ -359,6 +570,12 @@ class FileProcessor:
             
         return video_cmd
     
+    def _get_thread_budget(self):
+        """Get (threads, SVT-AV1 lp level) for encoding this file"""
+        width, height = self._get_resolution()
+        total_cpus = self.config.encode_cpus or available_cpus()
+        return thread_budget(width, height, self.config.cpu, total_cpus)
+
     def _calculate_adjusted_crf(self, width):
         """Calculate adjusted CRF based on resolution"""
         adjusted_crf = self.config.base_quality
@@ -383,33 +600,28 @@ class FileProcessor:
             "-metadata", f"audio_settings={' '.join(audio_cmd)}"
         ]
     
-    def _execute_compression(self, dst, map_cmd, video_cmd, audio_cmd, subtitle_cmd, metadata_cmd, audio_transcode):
+    def _execute_compression(self, plan: EncodePlan, input_path: Path = None, output_path: Path = None,
+                             keep_chunks: bool = False):
         """Execute the compression (only called when transcoding is needed)"""
+        input_path = input_path or self.filepath
+        dst = output_path or plan.output
+        cpus = job_cpus(plan.cpus)
+        if plan.chunks:
+            encoder = ChunkedEncoder(plan, plan.parallel_segments, low_priority_prefix(),
+                                     self.monitor, self.config.ffmpeg_stderr_lines, cpus)
+            return encoder.encode(input_path, dst, dst.with_name(dst.name + ".chunks"), keep_chunks)
+
         cmd = [
-            *self._get_low_priority_prefix(),
-            "ffmpeg", "-y", "-i", str(self.filepath),
-            *map_cmd,
-            *video_cmd,
-            *audio_cmd,
-            "-c:s", "copy",
-            "-movflags", "use_metadata_tags",
-            *subtitle_cmd,
-            *metadata_cmd,
-            "-nostats" if self.config.max_parallel_encodes > 1 else "-stats",
-            str(dst)
+            *affinity_prefix(cpus),
+            *low_priority_prefix(),
+            *plan.build_command(input_path, dst)
         ]
         logging.info("Running ffmpeg: %s", " ".join(cmd))
         
-        try:
-            result = subprocess.run(cmd, check=True, capture_output=True, text=True)
-            return dst
-        except subprocess.CalledProcessError as e:
-            logging.error("FFmpeg command failed with return code %d", e.returncode)
-            if hasattr(e, 'stderr') and e.stderr:
-                logging.error("FFmpeg STDERR: %s", e.stderr)
-            if hasattr(e, 'stdout') and e.stdout:
-                logging.error("FFmpeg STDOUT: %s", e.stdout)
-            raise e
+        # progress is read while ffmpeg runs, only the tail of stderr is kept for errors
+        run_ffmpeg(cmd, self.monitor, name=self.filepath.name, duration=plan.duration,
+                   stderr_lines=self.config.ffmpeg_stderr_lines)
+        return dst
     
     def _replace_original(self, new_path: Path):
         """Replace the original file with the compressed version"""
@@ -425,31 +637,17 @@ class FileProcessor:
             self.filepath.unlink()
         return final_path
     
-    def _get_actual_audio_bitrate(self, stream_index, duration):
-        """Get actual audio bitrate by extracting the stream and measuring size"""
-        try:            
-            # Extract the audio stream to null and get the size
-            extract_cmd = [
-                "ffmpeg", "-i", str(self.filepath), "-map", f"0:a:{stream_index}",
-                "-c", "copy", "-f", "null", "-"
-            ]
-            
-            # Run ffmpeg and capture stderr to get the size info
-            result = subprocess.run(extract_cmd, capture_output=True, text=True, check=True)
-            
-            # Parse the audio size from ffmpeg output (look for "audio:XXXkB" in stderr)
-            size_match = re.search(r'audio:(\d+)[kK]', result.stderr, re.IGNORECASE)
-            if size_match:
-                size_kb = int(size_match.group(1))
-                size_bits = size_kb * 1024 * 8
-                bitrate_bps = size_bits / duration
-                bitrate_kbps = int(bitrate_bps / 1000)
-                
-                logging.info(f"Measured audio bitrate for stream {stream_index}: {bitrate_kbps}k")
-                return bitrate_kbps
-            else:
-                raise Exception(f"Could not parse audio stream size from ffmpeg output for stream index {stream_index} of file {self.filepath}")
-                
+    def _get_actual_audio_bitrates(self, duration):
+        """Get actual audio bitrates of all audio streams by summing their packet sizes"""
+        try:
+            if duration <= 0:
+                raise Exception("unknown duration")
+            media_info = self._get_media_info()
+            with self.metrics.stage("audio_bitrate"):
+                return estimate_audio_bitrates(
+                    self.filepath, media_info, self.config.audio_bitrate_estimation,
+                    self.config.audio_bitrate_sample_windows, self.config.audio_bitrate_window_seconds
+                )
         except Exception as e:
-            logging.warning(f"Could not measure audio bitrate for stream {stream_index}: {e}")
-            return 1  # fallback: minimal bitrate, prevent multiple reencodes in case of errors
\ No newline at end of file
+            logging.warning(f"Could not measure audio bitrates of {self.filepath}: {e}")
+            return {}
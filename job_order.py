@@ -0,0 +1,79 @@
+import heapq
+
+from encode_plan import EncodePlan
+from scheduler import FULL_HD_PIXELS, output_pixels
+
+# Relative decode cost of source codecs, compared to h264
+CODEC_COST = {
+    "mpeg2video": 0.8,
+    "mpeg4": 0.8,
+    "h264": 1.0,
+    "vc1": 1.1,
+    "vp9": 1.2,
+    "hevc": 1.3,
+    "av1": 1.3,
+}
+
+# Encode order of analyzed files, see order_key
+ORDER_POLICIES = ("longest", "shortest", "path")
+
+
+def estimate_cost(plan: EncodePlan) -> float:
+    """Estimated encode work of a plan, in "1080p hours"
+
+    Video encodes scale with duration and output pixel count. Audio-only plans
+    copy the video, their cost is only a small fraction of that.
+    """
+    hours = plan.duration / 3600
+    if not plan.video_transcode:
+        return hours * 0.02
+    pixels = output_pixels(plan.width, plan.height) / FULL_HD_PIXELS
+    return hours * pixels * CODEC_COST.get(plan.source_codec, 1.0)
+
+
+def order_key(policy: str, plan: EncodePlan, cost: float):
+    """Sort key for the encode queue, smaller keys are encoded first
+
+    "longest" (longest processing time first) minimizes the total run time,
+    "shortest" finishes as many files as possible early, "path" keeps the
+    order of the directory tree.
+    """
+    if policy == "longest":
+        return -cost
+    if policy == "shortest":
+        return cost
+    if policy == "path":
+        return str(plan.source)
+    raise ValueError(f"Unknown encode order policy: {policy}")
+
+
+def simulate_makespan(jobs, total_cpus: int) -> float:
+    """Simulate the EncodeScheduler for (cost, threads) jobs in the given order
+
+    A job starts as soon as its threads fit the free CPUs and takes `cost` time
+    units. Returns the time at which the last job finishes.
+    """
+    now = 0.0
+    used = 0
+    running = []  # heap of (finish time, threads)
+    for cost, threads in jobs:
+        while running and used + threads > total_cpus:
+            now, finished_threads = heapq.heappop(running)
+            used -= finished_threads
+        used += threads
+        heapq.heappush(running, (now + cost, threads))
+    return max((finish for finish, _ in running), default=now)
+
+
+def makespan_by_policy(plans, total_cpus: int, job_threads: int = None):
+    """Return {policy: estimated makespan} for all ORDER_POLICIES
+
+    job_threads replaces the thread budget of every plan, e.g. 1 for fixed encode slots.
+    """
+    costs = [(plan, estimate_cost(plan)) for plan in plans]
+    result = {}
+    for policy in ORDER_POLICIES:
+        ordered = sorted(costs, key=lambda item: order_key(policy, item[0], item[1]))
+        result[policy] = simulate_makespan([(cost, job_threads or plan.threads) for plan, cost in ordered],
+                                           total_cpus)
+    return result
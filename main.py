@@ -1,61 +1,431 @@
 import os
+import argparse
+import itertools
 import logging
-import concurrent.futures
+import signal
+import sys
+import threading
 from pathlib import Path
 from tqdm import tqdm
 from datetime import datetime
+from capabilities import FFmpegCapabilities
 from config import Config
+from coordination import LeaseManager
+from dedup import Deduplicator
+from discovery import DirectoryTracker, DirectoryWalker
 from file_processor import FileProcessor
+from job_order import ORDER_POLICIES, estimate_cost, makespan_by_policy, order_key
+from media_probe import ProbeCache
+from metrics import MetricsReport
+from pipeline import Pipeline
+from plan_file import FAILED, UNTOUCHED, plan_entry, plan_is_current, read_plan_file, select_plans, write_plan_file
+from process_runner import ProcessRunner, runner_from_config, set_runner, shutdown_runner
+from progress import EncodeMonitor
+from resume import PartialOutputCleaner
+from runtime_control import RuntimeController, ThrottlePolicy, write_control
+from staging import ScratchStaging
+from state_store import StateStore, settings_key
 
-# === LOGGING SETUP ===
 config = Config()
-log_file = config.source_dir / f"video_compression_{datetime.now().strftime('%Y-%m-%d_%H-%M-%S')}.log"
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s [%(levelname)s] %(message)s",
-    handlers = [
-        logging.FileHandler(log_file),
-    ]
-)
 
 # Try to disable copyfile (._ files) on macOS
 os.environ['COPYFILE_DISABLE'] = '1'
 
 
+# === LOGGING SETUP ===
+def setup_logging(config: Config) -> Path:
+    """Log into a new file in the source directory, returns its path"""
+    log_file = config.source_dir / f"video_compression_{datetime.now().strftime('%Y-%m-%d_%H-%M-%S')}.log"
+    logging.basicConfig(
+        level=logging.INFO,
+        format="%(asctime)s [%(levelname)s] %(message)s",
+        handlers = [
+            logging.FileHandler(log_file),
+        ]
+    )
+    return log_file
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Compress a video library to AV1")
+    parser.add_argument("--dry-run", action="store_true",
+                        help="only analyze the files and print the estimated makespan of each encode order")
+    parser.add_argument("--order", choices=ORDER_POLICIES, default=config.encode_order,
+                        help="order in which analyzed files are encoded")
+    parser.add_argument("--analyses", type=int, default=config.max_parallel_analyses,
+                        help="number of files analyzed in parallel")
+    parser.add_argument("--plan-out", type=Path, metavar="PLAN_JSON",
+                        help="only analyze the files and write every decision and ffmpeg command to a plan file")
+    parser.add_argument("--execute", type=Path, metavar="PLAN_JSON",
+                        help="encode the files of a plan file without analyzing them again")
+    parser.add_argument("--only", action="append", metavar="GLOB",
+                        help="with --execute: only encode files whose path matches (can be repeated)")
+    parser.add_argument("--limit", type=int, help="with --execute: encode at most this many files")
+    control = parser.add_argument_group("control a running instance on this host")
+    control.add_argument("--pause", action="store_true", help="pause all running encodes")
+    control.add_argument("--resume", action="store_true", help="resume paused encodes")
+    control.add_argument("--max-encodes", type=int, metavar="N",
+                         help="run at most N encodes at the same time, 0 restores the default")
+    control.add_argument("--auto-throttle", choices=["on", "off"], help="switch the automatic throttling")
+    args = parser.parse_args(argv)
+    if args.plan_out and args.execute:
+        parser.error("--plan-out and --execute can not be combined")
+    if args.plan_out:
+        args.dry_run = True
+    return args
+
+
+def update_control(args) -> bool:
+    """Write the control options to the control file of the running instance, returns True if there were any"""
+    changes = {}
+    if args.pause or args.resume:
+        changes["paused"] = args.pause
+    if args.max_encodes is not None:
+        changes["max_encodes"] = args.max_encodes or None
+    if args.auto_throttle:
+        changes["auto_throttle"] = args.auto_throttle == "on"
+    if changes:
+        write_control(config.control_file, **changes)
+        print(f"Updated {config.control_file}: {changes}")
+    return bool(changes)
+
+
 def main():
-    video_files = find_video_files(config.source_dir)
-    total_files = len(video_files)
-
-    logging.info(f"Found {total_files} video files to process")
-
-    # Setup progress bar
-    with tqdm(total=total_files, desc="Compressing videos", unit="file") as progress_bar:
-        # Process videos in parallel using ThreadPoolExecutor
-        with concurrent.futures.ThreadPoolExecutor(max_workers=config.max_parallel_encodes) as executor:
-            futures = {}
-            for filepath in video_files:
-                processor = FileProcessor(filepath, config)
-                if processor.should_skip():
-                    logging.info(f"Skipping {filepath}")
-                    progress_bar.update(1)  # Update progress for skipped files
-                    continue
-                future = executor.submit(processor.process)
-                futures[future] = filepath
-
-            # Wait for all tasks to complete and log results
-            for future in concurrent.futures.as_completed(futures):
-                try:
-                    result = future.result()
-                    logging.info(f"Done: {result}")
-                except Exception as e:
-                    filepath = futures[future]
-                    logging.error(f"Failed task: {filepath} - {e}")
-                finally:
-                    progress_bar.update(1)  # Update progress bar
-
-def find_video_files(root: Path):
-    files = [p for p in root.rglob("*") if p.suffix.lower() in config.video_exts and not p.name.startswith("._")]
-    return sorted(files)
+    args = parse_args()
+    # control options and --help only touch the control file or print, they need no log file
+    if update_control(args):
+        return
+    log_file = setup_logging(config)
+    config.encode_order = args.order
+    config.max_parallel_analyses = args.analyses
+    # every ffprobe/ffmpeg process is started, limited and timed by this runner
+    results = run(config, runner_from_config(config), args, log_file.with_suffix(".jsonl"))
+    if results is not None and results["stop_signal"]:
+        sys.exit(128 + results["stop_signal"])
+
+
+def run(config: Config, runner: ProcessRunner, args, report_path: Path):
+    """Process the tree below config.source_dir, or the plan file of --execute, as given by args
+
+    args are the options of parse_args, runner becomes the process-wide runner for the run.
+    Returns None for dry runs, otherwise the counts of the run (files done and failed,
+    duplicates, removed partial outputs), the signal that stopped it, if any, and the
+    CPU budget of the adaptive scheduler.
+    """
+    set_runner(runner)
+
+    # Detect ffmpeg capabilities once and fail before any work is queued
+    capabilities = FFmpegCapabilities.detect(cache_file=config.capabilities_cache_file)
+    missing = capabilities.missing_requirements()
+    if missing:
+        logging.error(f"ffmpeg at {capabilities.ffmpeg_path} is missing required components: {', '.join(missing)}")
+        raise SystemExit(f"ffmpeg is missing required components: {', '.join(missing)}")
+    logging.info(f"Using ffmpeg {capabilities.version} at {capabilities.ffmpeg_path}")
+
+    probe_cache = ProbeCache(config.probe_cache_file)
+    state_store = StateStore(config.state_db_file, retry_failed=config.retry_failed)
+    current_settings = settings_key(config)
+    # only a real run over the tree finishes directories
+    tracker = None if args.dry_run or args.execute else DirectoryTracker(
+        lambda directory, mtime_ns: state_store.record_directory(directory, mtime_ns, current_settings))
+
+    lease_manager = None
+    if config.coordination_enabled and not args.dry_run:
+        lease_manager = LeaseManager(config.lease_dir, config.source_dir, config.host_id,
+                                     config.lease_ttl_seconds, config.lease_heartbeat_seconds)
+        lease_manager.start()
+
+    # each directory is cleaned while it is walked, right before its files are processed
+    cleaner = None
+    if config.clean_partial_outputs and not args.dry_run:
+        cleaner = PartialOutputCleaner(config.compressed_suffix, config.video_exts, lease_manager)
+
+    # live progress of running encodes, shown as one sub-bar per encode
+    monitor = None if args.dry_run else EncodeMonitor()
+
+    staging = None
+    if config.staging_enabled and not args.dry_run:
+        staging = ScratchStaging(config.scratch_dir, int(config.scratch_budget_gb * 1e9), config.prefetch_count)
+
+    # one JSONL record per file next to the log file
+    report = MetricsReport(report_path)
+
+    dedup = None  # created for real runs over the tree, see below
+
+    def processors(progress_bar):
+        """Stream files into the pipeline while the tree is still being walked"""
+        found = 0
+        for filepath in find_video_files(config, state_store, tracker, cleaner):
+            found += 1
+            progress_bar.total = found
+            progress_bar.refresh()
+            processor = FileProcessor(filepath, config, probe_cache=probe_cache, state_store=state_store,
+                                      capabilities=capabilities, monitor=monitor, report=report,
+                                      staging=staging)
+            if processor.should_skip():
+                logging.info(f"Skipping {filepath}")
+                progress_bar.update(1)  # Update progress for skipped files
+                if tracker is not None:
+                    tracker.file_done(filepath, True)
+                continue
+            if lease_manager is not None and not acquire_lease(lease_manager, filepath):
+                progress_bar.update(1)
+                if tracker is not None:
+                    tracker.file_done(filepath, False)  # finished by another host, not by us
+                continue
+            if dedup is not None and dedup.claim(processor):
+                continue  # reported once the file it duplicates is finished
+            yield processor
+        logging.info(f"Found {found} video files to process")
+
+    def planned_processors(progress_bar):
+        """(processor, plan) of the selected files of the plan file, in encode order"""
+        settings, plans = read_plan_file(args.execute)
+        if settings != current_settings:
+            logging.warning(f"{args.execute} was made with other settings than the current ones")
+        plans = select_plans(plans, args.only, args.limit)
+        plans.sort(key=lambda plan: order_key(config.encode_order, plan, estimate_cost(plan)))
+        progress_bar.total = len(plans)
+        progress_bar.refresh()
+        for plan in plans:
+            if not plan_is_current(plan):
+                progress_bar.update(1)
+                continue
+            if lease_manager is not None and not acquire_lease(lease_manager, plan.source):
+                progress_bar.update(1)
+                continue
+            processor = FileProcessor(plan.source, config, state_store=state_store, capabilities=capabilities,
+                                      monitor=monitor, report=report, staging=staging)
+            yield processor, plan
+
+    if args.dry_run:
+        outcomes = {}  # files that need no encode or failed, for the plan file
+        with tqdm(total=0, desc="Analyzing videos", unit="file") as progress_bar:
+            def on_result(filepath, result, error, cost):
+                outcomes[filepath] = error
+                progress_bar.update(1)
+
+            pipeline = Pipeline(config, on_result=on_result, on_planned=lambda *_: progress_bar.update(1))
+            planned = pipeline.analyze_only(processors(progress_bar))
+        print_makespan_estimate(config, [plan for _, plan in planned], pipeline)
+        if args.plan_out:
+            entries = [plan_entry(plan, processor.metrics.fields) for processor, plan in planned]
+            entries += [{"path": str(path), "decision": FAILED, "error": str(error)} if error is not None
+                        else {"path": str(path), "decision": UNTOUCHED} for path, error in outcomes.items()]
+            write_plan_file(args.plan_out, entries, current_settings)
+            print(f"Plan of {len(entries)} files written to {args.plan_out}")
+        report.close()
+        state_store.close()
+        probe_cache.close()
+        return None
+
+    counts = {"done": 0, "failed": 0}
+    # Setup progress bars, the main bar is weighted by the estimated encode work of the queued files
+    with tqdm(total=0, desc="Files", unit="file", position=1) as file_bar, \
+            tqdm(total=0, desc="Compressing videos", unit="work", position=0,
+                 bar_format="{l_bar}{bar}| {n:.2f}/{total:.2f} [{elapsed}<{remaining}{postfix}]") as work_bar:
+        monitor.listener = EncodeBars(work_bar, monitor, first_position=2)
+
+        def on_planned(filepath, plan, cost):
+            if dedup is not None:
+                dedup.seal(filepath)
+            work_bar.total += cost
+            work_bar.refresh()
+
+        def on_result(filepath, result, error, cost=0.0):
+            if error is None:
+                logging.info(f"Done: {result}")
+            else:
+                logging.error(f"Failed task: {filepath} - {error}")
+            counts["done" if error is None else "failed"] += 1
+            if tracker is not None:
+                tracker.file_done(filepath, error is None)
+            if lease_manager is not None:
+                lease_manager.release(filepath)
+            file_bar.update(1)
+            work_bar.update(cost)
+            if dedup is not None:
+                dedup.finish(filepath, result, error)
+
+        # Analysis and encoding run in separate thread pools, see Pipeline
+        pipeline = Pipeline(config, on_result=on_result, on_planned=on_planned, staging=staging)
+        if config.dedup_enabled and not args.execute:
+            # duplicates are finished on the worker of the Deduplicator, reported like the pipeline results
+            dedup = Deduplicator(pipeline.report, config.dedup_hash_samples, config.dedup_relink_copies)
+        policy = None
+        if (config.throttle_max_foreign_load is not None or config.throttle_min_available_memory_percent is not None
+                or config.throttle_schedule):
+            policy = ThrottlePolicy(os.cpu_count() or 1, config.throttle_max_foreign_load,
+                                    config.throttle_min_available_memory_percent, config.throttle_schedule)
+        # a pause or limit left over from an earlier run applies to this one too
+        controller = RuntimeController(pipeline.gate, config.control_file, policy, config.control_poll_seconds)
+        controller.start()
+        stop_signal, restore_signals = stop_on_signals(pipeline, runner)
+        try:
+            if args.execute:
+                pipeline.run_plans(planned_processors(file_bar))
+            else:
+                pipeline.run(processors(file_bar))
+        finally:
+            restore_signals()
+            controller.stop()
+            if staging is not None:
+                staging.close()
+            if dedup is not None:
+                dedup.close()
+            if lease_manager is not None:
+                lease_manager.stop()
+
+    if cleaner is not None and cleaner.removed:
+        logging.info(f"Removed {cleaner.removed} partial outputs of interrupted encodes")
+    if dedup is not None and dedup.duplicates:
+        logging.info(f"{dedup.duplicates} files were hardlinks or copies of other files and were encoded once")
+    summary = report.summary()
+    report.close()
+    logging.info(f"Run summary:\n{summary}")
+    for kind, stats in runner.stats().items():
+        logging.info(f"{kind} processes: {stats['spawns']} started, {stats['seconds']:.0f}s total, "
+                     f"{stats['failed']} failed, {stats['timeouts']} timed out")
+    print(summary)
+    state_store.close()
+    probe_cache.close()
+    scheduler = pipeline.scheduler
+    return {
+        **counts,
+        "duplicates": dedup.duplicates if dedup is not None else 0,
+        "removed_partials": cleaner.removed if cleaner is not None else 0,
+        "stop_signal": stop_signal[0] if stop_signal else None,
+        # CPU budget no encode had reserved, e.g. because analysis did not keep the encode queue filled
+        "scheduler_cpus": scheduler.total_cpus if scheduler is not None else None,
+        "scheduler_idle_cpu_seconds": scheduler.idle_cpu_seconds() if scheduler is not None else None,
+    }
+
+
+def stop_on_signals(pipeline: Pipeline, runner: ProcessRunner):
+    """Stop the pipeline on SIGTERM/SIGINT/SIGHUP and kill the running processes right away
+
+    The processes run in sessions of their own, so a Ctrl-C in the terminal does not reach
+    them. The handler only records the signal, a watcher thread does the stopping.
+    Returns the list the received signal number is appended to, and a function that puts
+    the previous handlers back once the run is over.
+    """
+    received = []
+    signalled = threading.Event()
+    previous = {}
+
+    def on_signal(signum, frame):
+        received.append(signum)
+        signalled.set()
+
+    def watch():
+        signalled.wait()
+        if not received:
+            return  # the run ended without a signal
+        logging.warning("Stopping, the interrupted files are processed again on the next run")
+        pipeline.stop()
+        runner.shutdown()
+
+    def restore():
+        for signum, handler in previous.items():
+            signal.signal(signum, handler)
+        signalled.set()
+
+    threading.Thread(target=watch, name="stop-watcher", daemon=True).start()
+    for name in ("SIGTERM", "SIGINT", "SIGHUP"):
+        if hasattr(signal, name):
+            signum = getattr(signal, name)
+            previous[signum] = signal.signal(signum, on_signal)
+    return received, restore
+
+
+class EncodeBars:
+    """One tqdm sub-bar per running ffmpeg process, and the total fps on the main bar"""
+
+    def __init__(self, main_bar: tqdm, monitor: EncodeMonitor, first_position: int):
+        self.main_bar = main_bar
+        self.monitor = monitor
+        self.first_position = first_position
+        self._bars = {}
+        self._positions = {}
+        self._lock = threading.Lock()
+
+    def on_start(self, state):
+        with self._lock:
+            used = set(self._positions.values())
+            position = next(p for p in itertools.count(self.first_position) if p not in used)
+            self._positions[state.job_id] = position
+            self._bars[state.job_id] = tqdm(total=max(1, round(state.duration)), desc=state.name[:40], unit="s",
+                                            position=position, leave=False)
+
+    def on_update(self, state):
+        bar = self._bars.get(state.job_id)
+        if bar is None:
+            return
+        bar.n = min(bar.total, int(state.out_time))
+        eta = f"{state.eta / 60:.0f}min" if state.eta is not None else "?"
+        bar.set_postfix(fps=f"{state.fps:.1f}", speed=f"{state.speed:.2f}x", bitrate=state.bitrate, eta=eta)
+        self.main_bar.set_postfix(fps=f"{self.monitor.total_fps():.1f}")
+
+    def on_finish(self, state):
+        with self._lock:
+            bar = self._bars.pop(state.job_id, None)
+            self._positions.pop(state.job_id, None)
+        if bar is not None:
+            bar.close()
+
+
+def acquire_lease(lease_manager: LeaseManager, filepath: Path) -> bool:
+    """Take the lease of a file, skipping files other hosts work on or already replaced"""
+    if not lease_manager.try_acquire(filepath):
+        logging.info(f"Skipping {filepath} because another host is processing it")
+        return False
+    # the host that held the lease before may have replaced the file meanwhile
+    if not filepath.exists():
+        logging.info(f"Skipping {filepath} because it was replaced by another host")
+        lease_manager.release(filepath)
+        return False
+    return True
+
+
+def print_makespan_estimate(config: Config, plans, pipeline: Pipeline):
+    """Print the simulated run time of the analyzed encodes for every order policy"""
+    job_threads = None
+    if pipeline.scheduler is not None:
+        total_cpus = pipeline.scheduler.total_cpus
+    else:
+        # fixed number of slots, every encode takes one; the plans keep their budgets for --plan-out
+        total_cpus = config.max_parallel_encodes
+        job_threads = 1
+    total_work = sum(estimate_cost(plan) for plan in plans)
+    print(f"{len(plans)} files need encoding, estimated work: {total_work:.2f} (1080p hours)")
+    for policy, makespan in makespan_by_policy(plans, total_cpus, job_threads).items():
+        marker = " (selected)" if policy == config.encode_order else ""
+        print(f"  {policy:<10} estimated makespan: {makespan:.2f}{marker}")
+
+
+def find_video_files(config: Config, state_store: StateStore = None, tracker: DirectoryTracker = None,
+                     cleaner: PartialOutputCleaner = None):
+    """Return a streaming walker over the video files below config.source_dir"""
+    is_dir_finished = None
+    if config.prune_finished_dirs and state_store is not None:
+        current_settings = settings_key(config)
+        is_dir_finished = lambda directory, mtime_ns: state_store.is_directory_finished(
+            directory, mtime_ns, current_settings)
+    return DirectoryWalker(
+        config.source_dir, config.video_exts,
+        include=config.include_globs,
+        # work directories of chunked encodes hold segment files, not videos
+        exclude=config.exclude_globs + [f"*{config.compressed_suffix}.mkv.chunks"],
+        parallel_walkers=config.discovery_walkers,
+        is_dir_finished=is_dir_finished,
+        on_dir_listed=tracker.dir_listed if tracker is not None else None,
+        clean_dir=cleaner,
+    )
 
 if __name__ == "__main__":
-    main()
+    # e.g. docker stop before the pipeline runs, exit through the finally blocks so no ffmpeg is left running
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(128 + signum))
+    try:
+        main()
+    finally:
+        shutdown_runner()
@@ -0,0 +1,186 @@
+import json
+import logging
+import os
+import sqlite3
+import threading
+from pathlib import Path
+from typing import Optional
+
+from process_runner import PROBE, get_runner
+
+
+def file_fingerprint(filepath: Path):
+    """Return a (size, mtime_ns) tuple identifying the current file contents"""
+    st = os.stat(filepath)
+    return st.st_size, st.st_mtime_ns
+
+
+class StreamInfo:
+    """A single stream as reported by ffprobe"""
+
+    def __init__(self, data: dict):
+        self.index: int = int(data.get("index", 0))
+        self.codec_type: str = data.get("codec_type", "")
+        self.codec_name: str = data.get("codec_name", "")
+        self.width: int = int(data.get("width", 0) or 0)
+        self.height: int = int(data.get("height", 0) or 0)
+        self.channels: int = int(data.get("channels", 2) or 2)
+        self.bit_rate: int = int(data.get("bit_rate", 0) or 0)
+        self.tags: dict = data.get("tags", {}) or {}
+        self.disposition: dict = data.get("disposition", {}) or {}
+
+
+class MediaInfo:
+    """Parsed result of a single `ffprobe -show_streams -show_format` call"""
+
+    def __init__(self, data: dict):
+        self.data = data
+        self.streams = [StreamInfo(s) for s in data.get("streams", [])]
+        fmt = data.get("format", {}) or {}
+        self.format_name: str = fmt.get("format_name", "")
+        self.duration: float = float(fmt.get("duration", 0) or 0)
+        self.size: int = int(fmt.get("size", 0) or 0)
+        self.bit_rate: int = int(fmt.get("bit_rate", 0) or 0)
+        self.format_tags: dict = fmt.get("tags", {}) or {}
+
+    @property
+    def video_streams(self):
+        # attached pictures (cover art) are reported as video streams, but are not the main video
+        return [s for s in self.streams
+                if s.codec_type == "video" and not s.disposition.get("attached_pic")]
+
+    @property
+    def audio_streams(self):
+        return [s for s in self.streams if s.codec_type == "audio"]
+
+    @property
+    def subtitle_streams(self):
+        return [s for s in self.streams if s.codec_type == "subtitle"]
+
+    @property
+    def video(self) -> Optional[StreamInfo]:
+        """First video stream, the one that gets mapped by `-map 0:v:0`"""
+        streams = self.video_streams
+        return streams[0] if streams else None
+
+    def to_json(self):
+        return json.dumps(self.data)
+
+    @classmethod
+    def from_json(cls, text: str):
+        return cls(json.loads(text))
+
+
+def run_ffprobe(filepath: Path) -> MediaInfo:
+    """Probe all streams and the container of a file with one ffprobe call"""
+    cmd = [
+        "ffprobe", "-v", "error", "-show_streams", "-show_format",
+        "-of", "json", str(filepath)
+    ]
+    output = get_runner().run(cmd, PROBE).stdout
+    return MediaInfo(json.loads(output))
+
+
+class ProbeCache:
+    """SQLite backed cache of ffprobe results, keyed by path, size and mtime
+
+    The database should live on a local disk. It is shared by all worker threads.
+    """
+
+    def __init__(self, db_path: Path):
+        db_path = Path(db_path)
+        db_path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(db_path), check_same_thread=False)
+        with self._lock, self._conn:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS probes ("
+                "path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, data TEXT)"
+            )
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS crops ("
+                "path TEXT, params TEXT, size INTEGER, mtime_ns INTEGER, crop TEXT, "
+                "PRIMARY KEY (path, params))"
+            )
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS samples ("
+                "path TEXT, params TEXT, size INTEGER, mtime_ns INTEGER, data TEXT, "
+                "PRIMARY KEY (path, params))"
+            )
+
+    def get(self, filepath: Path, fingerprint) -> Optional[MediaInfo]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT size, mtime_ns, data FROM probes WHERE path = ?", (str(filepath),)
+            ).fetchone()
+        if row is None or (row[0], row[1]) != tuple(fingerprint):
+            return None
+        return MediaInfo.from_json(row[2])
+
+    def put(self, filepath: Path, fingerprint, info: MediaInfo):
+        size, mtime_ns = fingerprint
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO probes (path, size, mtime_ns, data) VALUES (?, ?, ?, ?)",
+                (str(filepath), size, mtime_ns, info.to_json())
+            )
+
+    def get_crop(self, filepath: Path, fingerprint, params: str) -> Optional[str]:
+        """Return the cached crop filter ("" means no crop), or None on a cache miss"""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT size, mtime_ns, crop FROM crops WHERE path = ? AND params = ?",
+                (str(filepath), params)
+            ).fetchone()
+        if row is None or (row[0], row[1]) != tuple(fingerprint):
+            return None
+        return row[2]
+
+    def put_crop(self, filepath: Path, fingerprint, params: str, crop: str):
+        size, mtime_ns = fingerprint
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO crops (path, params, size, mtime_ns, crop) VALUES (?, ?, ?, ?, ?)",
+                (str(filepath), params, size, mtime_ns, crop)
+            )
+
+    def get_samples(self, filepath: Path, fingerprint, params: str) -> Optional[str]:
+        """Return the cached sample encode result (JSON), or None on a cache miss"""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT size, mtime_ns, data FROM samples WHERE path = ? AND params = ?",
+                (str(filepath), params)
+            ).fetchone()
+        if row is None or (row[0], row[1]) != tuple(fingerprint):
+            return None
+        return row[2]
+
+    def put_samples(self, filepath: Path, fingerprint, params: str, data: str):
+        size, mtime_ns = fingerprint
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO samples (path, params, size, mtime_ns, data) VALUES (?, ?, ?, ?, ?)",
+                (str(filepath), params, size, mtime_ns, data)
+            )
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+def probe_media(filepath: Path, cache: Optional[ProbeCache] = None) -> MediaInfo:
+    """Return the MediaInfo of a file, from the cache if the file did not change"""
+    if cache is None:
+        return run_ffprobe(filepath)
+
+    fingerprint = file_fingerprint(filepath)
+    info = cache.get(filepath, fingerprint)
+    if info is not None:
+        return info
+
+    info = run_ffprobe(filepath)
+    try:
+        cache.put(filepath, fingerprint, info)
+    except sqlite3.Error as e:
+        logging.warning(f"Could not store probe result for {filepath}: {e}")
+    return info
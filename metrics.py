@@ -0,0 +1,117 @@
+import contextvars
+import functools
+import json
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+# add_child_cpu(seconds) of the stage the calling thread is in, the ProcessRunner passes it the CPU time of
+# every process started from that thread
+current_stage = contextvars.ContextVar("current_stage", default=None)
+
+
+class FileMetrics:
+    """Stage timings and compression figures of one file"""
+
+    def __init__(self, filepath: Path):
+        self.filepath = filepath
+        self.stages = {}  # name -> {"wall_s", "cpu_s", "child_cpu_s", "calls"}
+        self.fields = {}
+        self._lock = threading.Lock()  # child CPU times are added from the process runner thread
+
+    @contextmanager
+    def stage(self, name: str):
+        """Measure wall time and CPU time of the calling thread for a stage
+
+        The CPU time of the processes started during the stage is added by the ProcessRunner.
+        """
+        wall_start = time.perf_counter()
+        cpu_start = time.thread_time()
+        token = current_stage.set(functools.partial(self.add_child_cpu, name))
+        try:
+            yield
+        finally:
+            current_stage.reset(token)
+            self.add_stage(name, time.perf_counter() - wall_start, time.thread_time() - cpu_start)
+
+    def add_stage(self, name: str, wall: float, cpu: float = 0.0, child_cpu: float = 0.0):
+        with self._lock:
+            stage = self.stages.setdefault(name, {"wall_s": 0.0, "cpu_s": 0.0, "child_cpu_s": 0.0, "calls": 0})
+            stage["wall_s"] += wall
+            stage["cpu_s"] += cpu
+            stage["child_cpu_s"] += child_cpu
+            stage["calls"] += 1
+
+    def add_child_cpu(self, name: str, child_cpu: float):
+        """CPU time used by ffmpeg/ffprobe processes started during a stage"""
+        with self._lock:
+            self.stages.setdefault(name, {"wall_s": 0.0, "cpu_s": 0.0, "child_cpu_s": 0.0, "calls": 0})
+            self.stages[name]["child_cpu_s"] += child_cpu
+
+    def set(self, **fields):
+        self.fields.update(fields)
+
+    def to_record(self):
+        record = {"path": str(self.filepath), **self.fields}
+        record["stages"] = {name: {k: round(v, 3) if isinstance(v, float) else v for k, v in stage.items()}
+                            for name, stage in self.stages.items()}
+        input_size = record.get("input_size")
+        output_size = record.get("output_size")
+        if input_size and output_size is not None:
+            record["saved_bytes"] = input_size - output_size
+            record["saved_percent"] = round(100 * (input_size - output_size) / input_size, 2)
+        encode = self.stages.get("encode")
+        if encode and encode["wall_s"] > 0 and record.get("duration"):
+            record["encode_speed"] = round(record["duration"] / encode["wall_s"], 3)  # x realtime
+        return record
+
+
+class MetricsReport:
+    """Writes one JSONL record per file and keeps the totals for the end-of-run summary"""
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self.started = time.monotonic()
+        self._lock = threading.Lock()
+        self._file = open(self.path, "a", encoding="utf-8")
+        self._files = 0
+        self._encoded = 0
+        self._saved_bytes = 0
+        self._encoded_seconds = 0.0  # content duration of encoded files
+        self._stage_totals = {}
+        self._slowest = {}  # stage -> (wall, path)
+
+    def write(self, metrics: FileMetrics):
+        record = metrics.to_record()
+        with self._lock:
+            self._file.write(json.dumps(record) + "\n")
+            self._file.flush()
+            self._files += 1
+            if record.get("outcome") == "encoded":
+                self._encoded += 1
+                self._saved_bytes += record.get("saved_bytes", 0)
+                self._encoded_seconds += record.get("duration", 0.0)
+            for name, stage in record["stages"].items():
+                self._stage_totals[name] = self._stage_totals.get(name, 0.0) + stage["wall_s"]
+                if name not in self._slowest or stage["wall_s"] > self._slowest[name][0]:
+                    self._slowest[name] = (stage["wall_s"], record["path"])
+
+    def summary(self) -> str:
+        with self._lock:
+            wall_hours = (time.monotonic() - self.started) / 3600
+            lines = [
+                f"Processed {self._files} files, encoded {self._encoded}, "
+                f"saved {self._saved_bytes / 1e9:.2f} GB",
+                f"Throughput: {self._encoded_seconds / 3600 / wall_hours if wall_hours else 0:.2f} "
+                f"content-hours encoded per wall-hour",
+                "Time per stage (summed over files):",
+            ]
+            for name, total in sorted(self._stage_totals.items(), key=lambda item: item[1], reverse=True):
+                slowest_wall, slowest_path = self._slowest[name]
+                lines.append(f"  {name:<14} {total:10.1f}s  slowest {slowest_wall:.1f}s ({slowest_path})")
+        return "\n".join(lines)
+
+    def close(self):
+        with self._lock:
+            self._file.close()
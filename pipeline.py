@@ -0,0 +1,266 @@
+import concurrent.futures
+import heapq
+import itertools
+import queue
+import threading
+
+from config import Config
+from job_order import estimate_cost, order_key
+from runtime_control import EncodeGate, current_job
+from scheduler import CpuAllocator, EncodeScheduler, available_cpus
+
+_STOP = (1, 0, 0, None)  # sorts after every plan, tells an encode worker to exit
+
+
+class Pipeline:
+    """Two-stage processing of FileProcessors
+
+    A wide, I/O-bound analysis pool builds EncodePlans and pushes them into a
+    bounded queue. The encode workers only run ffmpeg for queued plans, so files
+    that need no transcoding never take an encode slot. With the adaptive
+    scheduler, an encode only starts once its thread budget fits the free CPUs.
+    Queued plans are encoded in the order of Config.encode_order.
+
+    The EncodeGate limits the number of running encodes on top of that; its
+    limit can be changed while the pipeline runs (see runtime_control).
+
+    With a ScratchStaging, the inputs at the head of the queue are prefetched to
+    scratch, and files are reported once their output was written back.
+
+    stop() ends a run early: analyses not started yet are cancelled and queued
+    plans are dropped. Killing the running processes is up to the caller
+    (process_runner.shutdown_runner); files interrupted that way are not reported.
+    """
+
+    def __init__(self, config: Config, on_result=None, on_planned=None, staging=None):
+        self.config = config
+        # called as on_result(filepath, result, error, cost) from worker threads
+        self.on_result = on_result
+        # called as on_planned(filepath, plan, cost) when a plan is queued for encoding
+        self.on_planned = on_planned
+        self.staging = staging
+        self._encode_queue = queue.PriorityQueue(maxsize=config.encode_queue_size)
+        self._sequence = itertools.count()  # tie breaker, keeps equal keys in FIFO order
+        self._result_lock = threading.Lock()
+        self._admission_lock = threading.Lock()
+        self._stopping = threading.Event()
+        self._analysis_pool = None
+        self.scheduler = None
+        if config.encode_scheduler == "adaptive":
+            allocator = CpuAllocator.detect() if config.pin_encode_cpus else None
+            self.scheduler = EncodeScheduler(config.encode_cpus or available_cpus(), allocator)
+        if self.scheduler is None:
+            self.gate = EncodeGate(config.max_parallel_encodes)
+        else:
+            # paused encodes hold no CPUs, so they never keep the scheduler from admitting the others
+            # a resumed job gets its CPUs back if they are free, the CPUs of a leaving job are free for it
+            self.gate = EncodeGate(None, on_pause=lambda job: self.scheduler.suspend(job.threads, job.cpus),
+                                   on_resume=lambda job: job.set_cpus(
+                                       self.scheduler.unsuspend(job.threads, job.cpus)),
+                                   on_leave=lambda job: self.scheduler.release_cpus(job.cpus))
+
+    def _encode_worker_count(self):
+        if self.scheduler is None:
+            # the gate starts at max_parallel_encodes, spare workers allow raising it at runtime
+            return max(self.config.max_parallel_encodes, available_cpus() // 2)
+        # enough workers for the smallest budget, the scheduler limits how many actually run
+        return max(1, self.scheduler.total_cpus // 2)
+
+    def stop(self):
+        """Stop taking new work, run() returns once the running analyses and encodes ended"""
+        self._stopping.set()
+        self.gate.close()  # workers waiting for a paused gate must see the stop
+        pool = self._analysis_pool
+        if pool is not None:
+            pool.shutdown(wait=False, cancel_futures=True)
+
+    @property
+    def stopping(self) -> bool:
+        return self._stopping.is_set()
+
+    def run(self, processors):
+        """Analyze and encode all processors, returns when everything is finished"""
+        encode_workers = self._start_encode_workers()
+        self._run_analysis(processors, self._analyze)
+        self._stop_encode_workers(encode_workers)
+
+    def run_plans(self, planned):
+        """Encode (processor, plan) pairs analyzed earlier, e.g. read from a plan file, without analyzing again"""
+        encode_workers = self._start_encode_workers()
+        for processor, plan in planned:
+            if self.stopping:
+                break
+            self._queue_plan(processor, plan)
+        self._stop_encode_workers(encode_workers)
+
+    def _start_encode_workers(self):
+        encode_workers = [
+            threading.Thread(target=self._encode_worker, name=f"encode-{i}", daemon=True)
+            for i in range(self._encode_worker_count())
+        ]
+        for worker in encode_workers:
+            worker.start()
+        return encode_workers
+
+    def _stop_encode_workers(self, encode_workers):
+        """Let the workers finish the queued plans, then wait for them and for pending write-backs"""
+        for _ in encode_workers:
+            self._encode_queue.put(_STOP)
+        for worker in encode_workers:
+            worker.join()
+        if self.staging is not None:
+            self.staging.wait()
+
+    def analyze_only(self, processors):
+        """Run only the analysis stage and return the (processor, plan) of every file that needs encoding"""
+        planned = []
+        planned_lock = threading.Lock()
+
+        def analyze(processor):
+            plan = self._analyze_processor(processor)
+            if plan is None:
+                return
+            if self.on_planned is not None:
+                with self._result_lock:
+                    self.on_planned(processor.filepath, plan, estimate_cost(plan))
+            with planned_lock:
+                planned.append((processor, plan))
+
+        self._run_analysis(processors, analyze)
+        return planned
+
+    def _run_analysis(self, processors, analyze):
+        max_pending = self.config.max_parallel_analyses * 4
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.config.max_parallel_analyses,
+                                                   thread_name_prefix="analyze") as analysis_pool:
+            self._analysis_pool = analysis_pool
+            pending = set()
+            for processor in processors:
+                if self.stopping:
+                    break
+                # don't create a future for every file of a huge tree up front
+                if len(pending) >= max_pending:
+                    pending = self._wait(pending, concurrent.futures.FIRST_COMPLETED)
+                try:
+                    pending.add(analysis_pool.submit(analyze, processor))
+                except RuntimeError:
+                    break  # shut down by stop()
+            self._wait(pending, concurrent.futures.ALL_COMPLETED)
+        self._analysis_pool = None
+
+    @staticmethod
+    def _wait(futures, return_when):
+        """concurrent.futures.wait, returns the futures not done yet
+
+        Futures cancelled by stop() never wake up a waiting thread, so this waits in
+        steps and leaves those out.
+        """
+        while futures:
+            _, not_done = concurrent.futures.wait(futures, timeout=1, return_when=return_when)
+            not_done = {future for future in not_done if not future.cancelled()}
+            if return_when == concurrent.futures.FIRST_COMPLETED and len(not_done) < len(futures):
+                return not_done
+            futures = not_done
+        return futures
+
+    def report(self, filepath, result, error, cost=0.0):
+        """Hand a result to on_result, serialized with the results of the pipeline itself"""
+        if self.on_result is None:
+            return
+        with self._result_lock:
+            self.on_result(filepath, result, error, cost)
+
+    def _analyze_processor(self, processor):
+        """Analyze one file, report files that need no encode, return the plan otherwise"""
+        try:
+            plan = processor.analyze()
+        except Exception as e:
+            if not self.stopping:
+                self.report(processor.filepath, None, e)
+            return None
+        if plan is None:
+            self.report(processor.filepath, processor.filepath, None)
+        return plan
+
+    def _analyze(self, processor):
+        plan = self._analyze_processor(processor)
+        if plan is not None:
+            self._queue_plan(processor, plan)
+
+    def _queue_plan(self, processor, plan):
+        cost = estimate_cost(plan)
+        if self.on_planned is not None:
+            with self._result_lock:
+                self.on_planned(processor.filepath, plan, cost)
+        key = order_key(self.config.encode_order, plan, cost)
+        item = (0, key, next(self._sequence), (processor, plan, cost))
+        # blocks while the encode stage is saturated, until stop() is called
+        while True:
+            if self.stopping:
+                return
+            try:
+                self._encode_queue.put(item, timeout=1)
+                break
+            except queue.Full:
+                pass
+        self._prefetch_queued()
+
+    def _prefetch_queued(self):
+        """Stage the inputs of the plans that are encoded next"""
+        if self.staging is None:
+            return
+        with self._encode_queue.mutex:
+            upcoming = heapq.nsmallest(self.staging.prefetch_count, self._encode_queue.queue)
+        for item in upcoming:
+            if item[3] is not None:
+                self.staging.prefetch(item[3][0].filepath)
+
+    def _admit_next(self):
+        """Take the head of the encode queue and wait until the scheduler and the gate admit it
+
+        Only one worker at a time takes a plan and waits for room, so the encodes
+        start in queue order instead of the order in which waiting workers wake up.
+        Returns (processor, plan, cost, job), or None once the worker should exit.
+        """
+        with self._admission_lock:
+            while True:
+                item = self._encode_queue.get()
+                if item is _STOP:
+                    return None
+                if self.stopping:
+                    continue  # drop the queued plans, the _STOP items still end the workers
+                processor, plan, cost = item[3]
+                self._prefetch_queued()
+                if self.scheduler is not None:
+                    plan.cpus = self.scheduler.acquire(plan.threads)
+                # entered only once the scheduler admitted the encode, so every job of the gate holds its CPUs
+                job = self.gate.enter(processor.filepath.name, plan.threads, plan.cpus)
+                return processor, plan, cost, job
+
+    def _encode_worker(self):
+        while True:
+            admitted = self._admit_next()
+            if admitted is None:
+                return
+            processor, plan, cost, job = admitted
+            token = current_job.set(job)
+            try:
+                if self.stopping:
+                    continue
+                result = processor.execute(plan)
+            except Exception as e:
+                if not self.stopping:
+                    self.report(processor.filepath, None, e, cost)
+                continue
+            finally:
+                current_job.reset(token)
+                self.gate.leave(job)  # counts a paused job again before its CPUs are released
+                if self.scheduler is not None:
+                    self.scheduler.release(plan.threads)  # the CPUs were freed when the job left the gate
+            if isinstance(result, concurrent.futures.Future):
+                # staged encodes are finished once the write-back is done
+                result.add_done_callback(
+                    lambda future, filepath=processor.filepath, cost=cost: self.report(
+                        filepath, None if future.exception() else future.result(), future.exception(), cost))
+                continue
+            self.report(processor.filepath, result, None, cost)
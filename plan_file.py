@@ -0,0 +1,97 @@
+import fnmatch
+import json
+import logging
+import os
+import time
+from pathlib import Path
+
+from chunked_encode import ChunkedEncoder
+from encode_plan import EncodePlan
+from job_order import estimate_cost
+from media_probe import file_fingerprint
+from scheduler import low_priority_prefix
+
+PLAN_FILE_VERSION = 1
+
+# decision of a file in the plan file
+TRANSCODE = "transcode"
+UNTOUCHED = "untouched"
+FAILED = "failed"
+
+
+def plan_commands(plan: EncodePlan):
+    """The ffmpeg argv of every process the encode of a plan runs, in order
+
+    Built like FileProcessor.execute builds them. Only the taskset prefix is missing,
+    the CPUs of an encode are assigned when the scheduler admits it.
+    """
+    if not plan.chunks:
+        return [[*low_priority_prefix(), *plan.build_command()]]
+    encoder = ChunkedEncoder(plan, plan.parallel_segments, low_priority_prefix())
+    workdir = plan.output.with_name(plan.output.name + ".chunks")
+    commands = [encoder.segment_command(plan.source, start, end, encoder.segment_path(workdir, i))
+                for i, (start, end) in enumerate(plan.chunks)]
+    commands.append(encoder.concat_command(workdir / "segments.txt", workdir / "video.mkv"))
+    commands.append(encoder.mux_command(plan.source, workdir / "video.mkv", plan.output))
+    return commands
+
+
+def plan_entry(plan: EncodePlan, metrics_fields: dict = None) -> dict:
+    """Plan file entry of a file that needs transcoding"""
+    fields = metrics_fields or {}
+    entry = {
+        "path": str(plan.source),
+        "decision": TRANSCODE,
+        "video": "transcode" if plan.video_transcode else "copy",
+        "audio": plan.audio_codecs(),
+        "cost": round(estimate_cost(plan), 4),
+        "input_size": fields.get("input_size"),
+        # only known when size prediction is enabled
+        "expected_saving_percent": fields.get("predicted_saving_percent"),
+        "commands": plan_commands(plan),
+        "plan": plan.to_dict(),
+    }
+    return entry
+
+
+def write_plan_file(path: Path, entries, settings: str):
+    """Write the plan file atomically, entries are sorted by path"""
+    data = {
+        "version": PLAN_FILE_VERSION,
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "settings": settings,
+        "files": sorted(entries, key=lambda entry: entry["path"]),
+    }
+    path = Path(path)
+    partial = path.with_name(path.name + ".part")
+    partial.write_text(json.dumps(data, indent=1))
+    os.replace(partial, path)
+
+
+def read_plan_file(path: Path):
+    """Return (settings key, EncodePlans) of a plan file"""
+    data = json.loads(Path(path).read_text())
+    if data.get("version") != PLAN_FILE_VERSION:
+        raise ValueError(f"Unsupported plan file version {data.get('version')} in {path}")
+    plans = [EncodePlan.from_dict(entry["plan"]) for entry in data["files"] if entry["decision"] == TRANSCODE]
+    return data.get("settings"), plans
+
+
+def select_plans(plans, patterns=None, limit: int = None):
+    """Plans whose source matches one of the glob patterns (all without patterns), at most `limit`"""
+    if patterns:
+        plans = [plan for plan in plans if any(fnmatch.fnmatch(str(plan.source), p) for p in patterns)]
+    return plans[:limit] if limit is not None else plans
+
+
+def plan_is_current(plan: EncodePlan) -> bool:
+    """Check that the source did not change since it was planned"""
+    try:
+        current = file_fingerprint(plan.source)
+    except OSError:
+        logging.info(f"Skipping {plan.source}, it does not exist anymore")
+        return False
+    if plan.fingerprint is None or tuple(current) != tuple(plan.fingerprint):
+        logging.info(f"Skipping {plan.source}, it changed since the plan was made")
+        return False
+    return True
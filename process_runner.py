@@ -0,0 +1,363 @@
+import asyncio
+import logging
+import os
+import shutil
+import signal
+import subprocess
+import threading
+import time
+
+from config import Config
+from metrics import current_stage
+from runtime_control import current_job
+
+# Kinds of processes, each kind has its own concurrency limit and timeout
+PROBE = "probe"  # short ffprobe/ffmpeg queries
+ANALYSIS = "analysis"  # cropdetect, audio packet reads, sample encodes
+ENCODE = "encode"  # the encodes themselves, limited by the EncodeScheduler instead
+
+_DEFAULT = object()  # timeout argument not given, use the timeout of the kind
+
+# lines of ffmpeg output can be long (e.g. -progress blocks, stream dumps), the asyncio default is 64 KiB
+_LINE_LIMIT = 1024 * 1024
+
+
+class RunnerStopped(Exception):
+    """A process was killed or not started because the runner was shut down
+
+    The file it belonged to was interrupted, not failed, and is processed again on the next run.
+    """
+
+
+def _program(cmd) -> str:
+    """Name of the ffmpeg/ffprobe binary of a command, skipping prefixes like nice"""
+    for arg in cmd:
+        name = os.path.basename(str(arg))
+        if name in ("ffmpeg", "ffprobe"):
+            return name
+    return os.path.basename(str(cmd[0])) if cmd else ""
+
+
+class _Child:
+    """A child process reaped by the runner itself with os.wait4, so its CPU time is known exactly
+
+    Offers the parts of asyncio.subprocess.Process the runner uses. A thread
+    waits for the exit, like the child watcher of asyncio does.
+    """
+
+    def __init__(self, popen: subprocess.Popen, loop):
+        self.pid = popen.pid
+        self.returncode = None
+        self.cpu_time = None  # user + system seconds of the process and the children it waited for
+        self.stdout = None
+        self.stderr = None
+        self._popen = popen
+        self._loop = loop
+        self._exited = loop.create_future()
+        self._transports = []
+        threading.Thread(target=self._wait, name=f"wait-{self.pid}", daemon=True).start()
+
+    @classmethod
+    async def start(cls, cmd):
+        # a new session makes the process a group leader, killing the group also kills its children
+        popen = subprocess.Popen(cmd, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                 start_new_session=True)
+        child = cls(popen, asyncio.get_running_loop())
+        child.stdout = await child._reader(popen.stdout)
+        child.stderr = await child._reader(popen.stderr)
+        return child
+
+    async def _reader(self, pipe):
+        reader = asyncio.StreamReader(limit=_LINE_LIMIT)
+        transport, _ = await self._loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), pipe)
+        self._transports.append(transport)
+        return reader
+
+    def _wait(self):
+        _, status, usage = os.wait4(self.pid, 0)
+        try:
+            self._loop.call_soon_threadsafe(self._set_exited, os.waitstatus_to_exitcode(status),
+                                            usage.ru_utime + usage.ru_stime)
+        except RuntimeError:  # the loop is gone, nobody waits anymore
+            pass
+
+    def _set_exited(self, returncode: int, cpu_time: float):
+        self.returncode = self._popen.returncode = returncode  # Popen must not reap it again
+        self.cpu_time = cpu_time
+        self._exited.set_result(returncode)
+
+    async def wait(self) -> int:
+        return await asyncio.shield(self._exited)
+
+    async def communicate(self):
+        stdout, stderr, _ = await asyncio.gather(self.stdout.read(), self.stderr.read(), self.wait())
+        return stdout, stderr
+
+    def kill(self):
+        if self.returncode is None:
+            os.kill(self.pid, signal.SIGKILL)
+
+    def close(self):
+        for transport in self._transports:
+            transport.close()
+
+
+class ProcessRunner:
+    """Runs every ffmpeg/ffprobe process on one asyncio event loop in a background thread
+
+    All spawns go through this class: the processes of a kind share a concurrency
+    limit and a timeout, each process runs in its own process group (killed as a
+    whole on timeout, cancellation and shutdown), and every spawn is timed and
+    counted. run() and stream() block the calling thread, any thread may call them.
+
+    The CPU time of every process is added to the metrics stage the calling
+    thread is in (metrics.current_stage).
+    """
+
+    def __init__(self, limits: dict = None, timeouts: dict = None, idle_io_kinds=()):
+        self.limits = dict(limits or {})  # kind -> max concurrent processes, kinds without a limit are unbounded
+        self.timeouts = dict(timeouts or {})  # kind -> seconds, None means no timeout
+        # kinds run in the idle I/O class, so their reads don't slow down the encodes
+        self.idle_io_kinds = set(idle_io_kinds) if shutil.which("ionice") else set()
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, name="process-runner", daemon=True)
+        self._thread.start()
+        self._semaphores = {}  # only used on the loop
+        self._processes = set()  # only used on the loop
+        self._stats_lock = threading.Lock()
+        self._stats = {}
+        self._closed = False
+
+    def _semaphore(self, kind: str):
+        if kind not in self._semaphores and self.limits.get(kind):
+            self._semaphores[kind] = asyncio.Semaphore(self.limits[kind])
+        return self._semaphores.get(kind)
+
+    def _record(self, kind: str, program: str, seconds: float, outcome: str):
+        with self._stats_lock:
+            stats = self._stats.setdefault(kind, {"spawns": 0, "seconds": 0.0, "failed": 0, "timeouts": 0,
+                                                  "cancelled": 0, "programs": {}})
+            stats["spawns"] += 1
+            stats["seconds"] += seconds
+            stats["programs"][program] = stats["programs"].get(program, 0) + 1
+            if outcome in ("failed", "timeouts", "cancelled"):
+                stats[outcome] += 1
+
+    def stats(self) -> dict:
+        """Spawn count, summed run time and failures per kind"""
+        with self._stats_lock:
+            return {kind: {**stats, "programs": dict(stats["programs"])} for kind, stats in self._stats.items()}
+
+    async def _spawn(self, cmd, kind: str):
+        if kind in self.idle_io_kinds:
+            cmd = ["ionice", "-c", "3", *cmd]
+        cmd = [str(arg) for arg in cmd]
+        if hasattr(os, "wait4"):
+            process = await _Child.start(cmd)
+        else:  # no process groups and no CPU times on Windows
+            process = await asyncio.create_subprocess_exec(
+                *cmd, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.PIPE, limit=_LINE_LIMIT)
+        self._processes.add(process)
+        return process
+
+    def _kill(self, process):
+        if process.returncode is not None:
+            return
+        try:
+            if hasattr(os, "killpg"):
+                os.killpg(process.pid, signal.SIGKILL)
+            else:
+                process.kill()
+        except (ProcessLookupError, PermissionError):
+            pass
+
+    async def _reap(self, process):
+        """Kill a process and wait for it, so its transport is closed before the loop may stop"""
+        if process is None:
+            return
+        self._kill(process)
+        try:
+            await asyncio.shield(process.wait())
+        except asyncio.CancelledError:
+            pass
+
+    async def _supervise(self, cmd, kind: str, timeout, communicate, job=None, stage=None):
+        """Spawn cmd under the limit of its kind and run communicate(process) within the timeout
+
+        The process is added to job (an EncodeJob), so it is paused and resumed with it,
+        and its CPU time is passed to stage (see metrics.current_stage) once it exited.
+        """
+        semaphore = self._semaphore(kind)
+        if semaphore is not None:
+            await semaphore.acquire()
+        started = time.perf_counter()
+        outcome = "ok"
+        process = None
+        try:
+            process = await self._spawn(cmd, kind)
+            if job is not None:
+                job.add_process(process.pid)
+            result = await asyncio.wait_for(communicate(process), timeout)
+            if process.returncode != 0:
+                outcome = "failed"
+            return result
+        except asyncio.TimeoutError:
+            outcome = "timeouts"
+            logging.error(f"Killing {_program(cmd)} after {timeout}s timeout: {' '.join(map(str, cmd))}")
+            self._kill(process)
+            await process.wait()
+            raise subprocess.TimeoutExpired(cmd, timeout)
+        except asyncio.CancelledError:
+            outcome = "cancelled"
+            await self._reap(process)
+            raise
+        except BaseException:
+            outcome = "failed"
+            await self._reap(process)
+            raise
+        finally:
+            if process is not None:
+                self._processes.discard(process)
+                if job is not None:
+                    job.remove_process(process.pid)
+                if isinstance(process, _Child):
+                    process.close()
+                    if stage is not None and process.cpu_time is not None:
+                        stage(process.cpu_time)
+            if semaphore is not None:
+                semaphore.release()
+            self._record(kind, _program(cmd), time.perf_counter() - started, outcome)
+
+    @property
+    def stopped(self) -> bool:
+        """True once shutdown() was called"""
+        return self._closed
+
+    def _call(self, coro):
+        if self._closed:
+            coro.close()
+            raise RunnerStopped("The process runner was shut down")
+        future = asyncio.run_coroutine_threadsafe(coro, self._loop)
+        try:
+            return future.result()
+        except BaseException as e:
+            # e.g. KeyboardInterrupt in the calling thread, cancelling kills the process group
+            future.cancel()
+            if self._closed and isinstance(e, Exception):
+                # cancelled or killed by shutdown()
+                raise RunnerStopped("The process was killed by the shutdown of the runner") from e
+            raise
+
+    def run(self, cmd, kind: str = PROBE, timeout=_DEFAULT, check: bool = True) -> subprocess.CompletedProcess:
+        """Run a command to completion and return its decoded output
+
+        Raises CalledProcessError (if check) or TimeoutExpired like subprocess.run,
+        and RunnerStopped if the runner was shut down.
+        """
+        timeout = self.timeouts.get(kind) if timeout is _DEFAULT else timeout
+
+        async def communicate(process):
+            stdout, stderr = await process.communicate()  # also waits for the exit
+            return subprocess.CompletedProcess(cmd, process.returncode, stdout.decode(errors="replace"),
+                                               stderr.decode(errors="replace"))
+
+        completed = self._call(self._supervise(cmd, kind, timeout, communicate, current_job.get(),
+                                               current_stage.get()))
+        if completed.returncode != 0 and self._closed:
+            raise RunnerStopped("The process was killed by the shutdown of the runner")
+        if check and completed.returncode != 0:
+            raise subprocess.CalledProcessError(completed.returncode, cmd, completed.stdout, completed.stderr)
+        return completed
+
+    def stream(self, cmd, kind: str = ENCODE, on_stdout_line=None, on_stderr_line=None, on_start=None,
+               timeout=_DEFAULT) -> int:
+        """Run a command and pass every output line to the callbacks as it arrives, returns the exit code
+
+        The callbacks run on the runner thread; on_start(pid) is called right after the spawn.
+        Processes started while the calling thread runs an encode job (runtime_control.current_job)
+        are paused and resumed with that job. Raises RunnerStopped if the runner was shut down.
+        """
+        timeout = self.timeouts.get(kind) if timeout is _DEFAULT else timeout
+
+        async def pump(reader, callback):
+            while True:
+                line = await reader.readline()
+                if not line:
+                    return
+                if callback is not None:
+                    callback(line.decode(errors="replace"))
+
+        async def communicate(process):
+            if on_start is not None:
+                on_start(process.pid)
+            await asyncio.gather(pump(process.stdout, on_stdout_line), pump(process.stderr, on_stderr_line))
+            return await process.wait()
+
+        returncode = self._call(self._supervise(cmd, kind, timeout, communicate, current_job.get(),
+                                                current_stage.get()))
+        if returncode != 0 and self._closed:
+            raise RunnerStopped("The process was killed by the shutdown of the runner")
+        return returncode
+
+    def shutdown(self):
+        """Kill the process groups of all running processes and stop the event loop"""
+        if self._closed:
+            return
+        self._closed = True
+
+        async def cancel_all():
+            for process in list(self._processes):
+                self._kill(process)
+            tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+        try:
+            asyncio.run_coroutine_threadsafe(cancel_all(), self._loop).result(timeout=10)
+        except Exception as e:
+            logging.warning(f"Could not stop all processes: {e}")
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join(timeout=10)
+
+
+def runner_from_config(config: Config) -> ProcessRunner:
+    limits = {PROBE: config.max_concurrent_probes, ANALYSIS: config.max_concurrent_analysis_processes}
+    idle_io_kinds = (PROBE, ANALYSIS) if config.analysis_io_idle else ()
+    return ProcessRunner(limits, config.process_timeouts, idle_io_kinds)
+
+
+_runner = None
+_runner_lock = threading.Lock()
+
+
+def get_runner() -> ProcessRunner:
+    """The process-wide runner, created with the default Config unless configure_runner was called"""
+    global _runner
+    with _runner_lock:
+        if _runner is None:
+            _runner = runner_from_config(Config())
+        return _runner
+
+
+def set_runner(runner: ProcessRunner) -> ProcessRunner:
+    """Make runner the process-wide runner, the one it replaces is shut down"""
+    global _runner
+    with _runner_lock:
+        previous, _runner = _runner, runner
+    if previous is not None and previous is not runner:
+        previous.shutdown()
+    return runner
+
+
+def configure_runner(config: Config) -> ProcessRunner:
+    """Replace the process-wide runner by one with the limits and timeouts of config"""
+    return set_runner(runner_from_config(config))
+
+
+def shutdown_runner():
+    """Kill all running processes, called on exit so no ffmpeg outlives the script"""
+    with _runner_lock:
+        runner = _runner
+    if runner is not None:
+        runner.shutdown()
@@ -0,0 +1,149 @@
+import collections
+import logging
+import subprocess
+import threading
+import time
+
+from process_runner import ENCODE, ProcessRunner, get_runner
+
+
+def parse_progress_block(lines):
+    """Turn the key=value lines of one `-progress` block into a dict"""
+    values = {}
+    for line in lines:
+        key, sep, value = line.strip().partition("=")
+        if sep:
+            values[key] = value
+    return values
+
+
+class EncodeState:
+    """Live progress of one running ffmpeg process"""
+
+    def __init__(self, job_id, name: str, duration: float):
+        self.job_id = job_id
+        self.name = name
+        self.duration = duration
+        self.started = time.monotonic()
+        self.frame = 0
+        self.fps = 0.0
+        self.bitrate = ""
+        self.speed = 0.0
+        self.out_time = 0.0  # seconds of output written
+        self.pid = None
+
+    def update(self, values: dict):
+        try:
+            self.frame = int(values.get("frame", self.frame))
+            self.fps = float(values.get("fps", self.fps))
+        except ValueError:
+            pass
+        self.bitrate = values.get("bitrate", self.bitrate).strip()
+        speed = values.get("speed", "").strip().rstrip("x")
+        try:
+            self.speed = float(speed)
+        except ValueError:
+            pass
+        out_time_us = values.get("out_time_us", values.get("out_time_ms"))  # both are microseconds
+        try:
+            self.out_time = max(0.0, int(out_time_us) / 1_000_000)
+        except (TypeError, ValueError):
+            pass
+
+    @property
+    def eta(self):
+        """Estimated seconds until the encode finishes, None if unknown"""
+        if not self.duration or self.speed <= 0:
+            return None
+        return max(0.0, (self.duration - self.out_time) / self.speed)
+
+
+class EncodeMonitor:
+    """Collects the progress of all running encodes and notifies a listener
+
+    The listener gets on_start(state), on_update(state) and on_finish(state) calls
+    from the encode threads, e.g. to drive one progress bar per worker.
+    """
+
+    def __init__(self, listener=None):
+        self.listener = listener
+        self._states = {}
+        self._lock = threading.Lock()
+
+    def start(self, job_id, name: str, duration: float) -> EncodeState:
+        state = EncodeState(job_id, name, duration)
+        with self._lock:
+            self._states[job_id] = state
+        if self.listener is not None:
+            self.listener.on_start(state)
+        return state
+
+    def update(self, state: EncodeState, values: dict):
+        state.update(values)
+        if self.listener is not None:
+            self.listener.on_update(state)
+
+    def finish(self, state: EncodeState):
+        with self._lock:
+            self._states.pop(state.job_id, None)
+        if self.listener is not None:
+            self.listener.on_finish(state)
+
+    def total_fps(self) -> float:
+        """Frames per second encoded across all workers"""
+        with self._lock:
+            return sum(state.fps for state in self._states.values())
+
+
+def _with_progress_output(cmd):
+    """Add `-progress pipe:1` as a global option right after the ffmpeg binary"""
+    index = next((i for i, arg in enumerate(cmd) if arg == "ffmpeg" or arg.endswith("/ffmpeg")), None)
+    if index is None:
+        return list(cmd)
+    return [*cmd[:index + 1], "-progress", "pipe:1", *cmd[index + 1:]]
+
+
+def run_ffmpeg(cmd, monitor: EncodeMonitor = None, job_id=None, name: str = "", duration: float = 0.0,
+               stderr_lines: int = 200, runner: ProcessRunner = None):
+    """Run ffmpeg, reading its `-progress` output line by line while it runs
+
+    Only the last `stderr_lines` lines of stderr are kept in memory; they are
+    attached to the CalledProcessError raised when ffmpeg fails. Returns the
+    final EncodeState of the process.
+    """
+    cmd = _with_progress_output(cmd)
+    stderr_tail = collections.deque(maxlen=stderr_lines)
+    states = []  # the state is created once the pid is known
+    block = []
+
+    def on_start(pid):
+        state_id = job_id if job_id is not None else pid
+        state = monitor.start(state_id, name, duration) if monitor else EncodeState(state_id, name, duration)
+        state.pid = pid
+        states.append(state)
+
+    def on_stdout_line(line):
+        block.append(line)
+        # every block ends with progress=continue or progress=end
+        if line.startswith("progress="):
+            state = states[0]
+            values = parse_progress_block(block)
+            if monitor is not None:
+                monitor.update(state, values)
+            else:
+                state.update(values)
+            block.clear()
+
+    try:
+        returncode = (runner or get_runner()).stream(cmd, ENCODE, on_stdout_line,
+                                                     lambda line: stderr_tail.append(line.rstrip("\n")), on_start)
+    finally:
+        if monitor is not None and states:
+            monitor.finish(states[0])
+
+    if returncode != 0:
+        stderr = "\n".join(stderr_tail)
+        logging.error("FFmpeg command failed with return code %d", returncode)
+        logging.error("FFmpeg STDERR (last %d lines): %s", len(stderr_tail), stderr)
+        raise subprocess.CalledProcessError(returncode, cmd, stderr=stderr)
+    return states[0]
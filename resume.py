@@ -0,0 +1,134 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+import threading
+from pathlib import Path
+
+from encode_plan import EncodePlan
+from media_probe import file_fingerprint
+
+MANIFEST_NAME = "manifest.json"
+
+
+def plan_hash(plan: EncodePlan) -> str:
+    """Hash of everything the encoded segments depend on"""
+    key = [str(plan.source), list(plan.fingerprint or ()), plan.video_cmd, [list(c) for c in plan.chunks]]
+    return hashlib.sha1(json.dumps(key).encode()).hexdigest()
+
+
+class SegmentManifest:
+    """manifest.json in the work directory of a chunked encode, lists the completed segments
+
+    The manifest is replaced atomically after every finished segment, so a killed
+    run leaves either the old or the new list, never a partial one.
+    """
+
+    def __init__(self, workdir: Path, plan: EncodePlan):
+        self.path = Path(workdir) / MANIFEST_NAME
+        self.plan_hash = plan_hash(plan)
+        self.source = str(plan.source)
+        self.fingerprint = list(plan.fingerprint or ())
+        self.segments = {}  # index -> size of the finished segment file
+        self._lock = threading.Lock()
+
+    def load(self) -> bool:
+        """Read the completed segments of an earlier run, False if there is no manifest for this plan"""
+        try:
+            data = json.loads(self.path.read_text())
+        except (OSError, ValueError):
+            return False
+        if data.get("plan") != self.plan_hash:
+            return False
+        self.segments = {int(index): size for index, size in data.get("segments", {}).items()}
+        return True
+
+    def is_done(self, index: int, segment_path: Path) -> bool:
+        try:
+            return self.segments.get(index) == os.stat(segment_path).st_size
+        except OSError:
+            return False
+
+    def mark_done(self, index: int, segment_path: Path):
+        with self._lock:
+            self.segments[index] = os.stat(segment_path).st_size
+            data = {"plan": self.plan_hash, "source": self.source, "fingerprint": self.fingerprint,
+                    "segments": {str(i): size for i, size in sorted(self.segments.items())}}
+            partial = self.path.with_name(self.path.name + ".part")
+            partial.write_text(json.dumps(data))
+            os.replace(partial, self.path)
+
+
+def is_resumable(workdir: Path) -> bool:
+    """Check if a chunk work directory belongs to a source that is still unchanged"""
+    try:
+        data = json.loads((Path(workdir) / MANIFEST_NAME).read_text())
+        return list(file_fingerprint(Path(data["source"]))) == data["fingerprint"] and bool(data["segments"])
+    except (OSError, ValueError, KeyError, TypeError):
+        return False
+
+
+def partial_output_names(names, compressed_suffix: str):
+    """The names of outputs (files and chunk work directories) of interrupted encodes among names"""
+    output_name = compressed_suffix + ".mkv"
+    return [name for name in names
+            if not name.startswith("._") and (name.endswith(output_name) or name.endswith(output_name + ".chunks"))]
+
+
+def _source_of(partial: Path, compressed_suffix: str, video_exts):
+    """The source file a partial output belongs to, None if it does not exist anymore"""
+    stem = partial.name[:partial.name.index(compressed_suffix + ".mkv")]
+    for ext in sorted(video_exts):
+        source = partial.with_name(stem + ext)
+        if source.exists():
+            return source
+    return None
+
+
+class PartialOutputCleaner:
+    """Removes outputs of interrupted encodes, one directory at a time while the tree is walked
+
+    Used as clean_dir of the DirectoryWalker, so a directory is cleaned right
+    before its files are processed. Chunk directories that can be resumed are
+    kept, and partial outputs of files another host holds the lease of are left alone.
+    """
+
+    def __init__(self, compressed_suffix: str, video_exts, lease_manager=None):
+        self.compressed_suffix = compressed_suffix
+        self.video_exts = video_exts
+        self.lease_manager = lease_manager
+        self.removed = 0
+        self._lock = threading.Lock()  # the walker threads clean directories in parallel
+
+    def __call__(self, directory: Path, names):
+        """Clean one directory given the names of its entries, returns the names of the removed outputs"""
+        removed = []
+        for name in partial_output_names(names, self.compressed_suffix):
+            if self._remove(Path(directory) / name):
+                removed.append(name)
+        with self._lock:
+            self.removed += len(removed)
+        return removed
+
+    def _remove(self, partial: Path) -> bool:
+        if partial.is_dir() and is_resumable(partial):
+            logging.info(f"Keeping segments of an interrupted encode for resuming: {partial}")
+            return False
+        source = _source_of(partial, self.compressed_suffix, self.video_exts)
+        if source is not None and self.lease_manager is not None and not self.lease_manager.try_acquire(source):
+            logging.info(f"Not removing {partial}, another host is processing {source}")
+            return False
+        try:
+            logging.warning(f"Removing partial output of an interrupted encode: {partial}")
+            if partial.is_dir():
+                shutil.rmtree(partial)
+            else:
+                partial.unlink()
+            return True
+        except OSError as e:
+            logging.warning(f"Could not remove {partial}: {e}")
+            return False
+        finally:
+            if source is not None and self.lease_manager is not None:
+                self.lease_manager.release(source)
@@ -0,0 +1,337 @@
+import contextvars
+import datetime
+import json
+import logging
+import os
+import signal
+import threading
+import time
+from pathlib import Path
+from typing import Optional
+
+# The encode job of the calling thread, processes started for it are paused and resumed with it
+current_job = contextvars.ContextVar("current_job", default=None)
+
+
+def _signal_group(pid: int, sig):
+    try:
+        os.killpg(pid, sig)
+    except (ProcessLookupError, PermissionError):
+        pass
+
+
+def _set_affinity(pid: int, cpus):
+    """Pin every thread of a process to cpus"""
+    try:
+        tids = [int(tid) for tid in os.listdir(f"/proc/{pid}/task")]
+    except OSError:
+        tids = [pid]
+    for tid in tids:
+        try:
+            os.sched_setaffinity(tid, cpus)
+        except OSError:
+            pass  # exited meanwhile
+
+
+def job_cpus(cpus):
+    """The CPUs of the encode job of the calling thread, or cpus outside a job
+
+    A paused job may continue on other CPUs than the ones it was admitted with.
+    """
+    job = current_job.get()
+    return job.cpus if job is not None else cpus
+
+
+class EncodeJob:
+    """The process groups of one running encode, stopped (SIGSTOP) and continued (SIGCONT) together"""
+
+    def __init__(self, name: str, threads: int = 1, cpus=None):
+        self.name = name
+        self.threads = threads
+        self.cpus = cpus  # the CPUs the processes are pinned to, None if they are not pinned
+        self.paused = False
+        self._pids = set()
+        self._lock = threading.Lock()
+
+    def add_process(self, pid: int):
+        with self._lock:
+            self._pids.add(pid)
+            if self.paused and hasattr(signal, "SIGSTOP"):
+                _signal_group(pid, signal.SIGSTOP)
+
+    def remove_process(self, pid: int):
+        with self._lock:
+            self._pids.discard(pid)
+
+    @property
+    def has_processes(self) -> bool:
+        with self._lock:
+            return bool(self._pids)
+
+    def pause(self):
+        with self._lock:
+            self.paused = True
+            if hasattr(signal, "SIGSTOP"):  # on Windows only new encodes are held back
+                for pid in self._pids:
+                    _signal_group(pid, signal.SIGSTOP)
+
+    def set_cpus(self, cpus):
+        """Move the processes to other CPUs (None: all CPUs of this process), e.g. when the job resumes"""
+        with self._lock:
+            previous, self.cpus = self.cpus, cpus
+            if cpus == previous or not hasattr(os, "sched_setaffinity"):
+                return
+            for pid in self._pids:
+                _set_affinity(pid, cpus or os.sched_getaffinity(0))
+
+    def resume(self):
+        with self._lock:
+            self.paused = False
+            if hasattr(signal, "SIGCONT"):
+                for pid in self._pids:
+                    _signal_group(pid, signal.SIGCONT)
+
+
+class EncodeGate:
+    """Limits the number of encodes running at the same time, the limit can change at any time
+
+    When the limit drops below the number of running encodes, the newest ones are
+    paused, and resumed once there is room again. Encodes that have processes
+    are paused first, holding back one that runs none (yet) frees nothing.
+    Paused encodes are resumed before new ones start, so no work is lost.
+    A limit of None means unlimited, 0 pauses everything.
+
+    on_pause(job) and on_resume(job) are called with every job paused and resumed,
+    e.g. to take it out of the EncodeScheduler accounting while it is stopped.
+    A job that leaves while paused is resumed first. on_leave(job) is called
+    with a leaving job before the paused ones are resumed, e.g. to free its CPUs for them.
+    """
+
+    def __init__(self, limit: Optional[int] = None, on_pause=None, on_resume=None, on_leave=None):
+        self.limit = limit
+        self.on_pause = on_pause
+        self.on_resume = on_resume
+        self.on_leave = on_leave
+        self._jobs = []  # admitted jobs in start order
+        self._condition = threading.Condition()
+        self._closed = False
+
+    def _has_room(self) -> bool:
+        if any(job.paused for job in self._jobs):
+            return False
+        return self.limit is None or len(self._jobs) < self.limit
+
+    def enter(self, name: str, threads: int = 1, cpus=None) -> EncodeJob:
+        """Wait until another encode may run, returns its job"""
+        with self._condition:
+            while not self._has_room():
+                self._condition.wait()
+            job = EncodeJob(name, threads, cpus)
+            self._jobs.append(job)
+            return job
+
+    def leave(self, job: EncodeJob):
+        with self._condition:
+            self._jobs.remove(job)
+            if job.paused:
+                self._resume(job)
+            if self.on_leave is not None:
+                self.on_leave(job)
+            self._rebalance()
+            self._condition.notify_all()
+
+    def set_limit(self, limit: Optional[int]):
+        with self._condition:
+            if limit == self.limit or self._closed:
+                return
+            logging.info(f"Encode limit changed from {self.limit} to {limit}")
+            self.limit = limit
+            self._rebalance()
+            self._condition.notify_all()
+
+    def close(self):
+        """Lift the limit for good, e.g. when the run is stopped and the encodes are killed anyway"""
+        with self._condition:
+            self._closed = True
+            self.limit = None
+            self._rebalance()
+            self._condition.notify_all()
+
+    def _pause(self, job: EncodeJob):
+        logging.info(f"Pausing encode of {job.name}")
+        job.pause()
+        if self.on_pause is not None:
+            self.on_pause(job)
+
+    def _resume(self, job: EncodeJob):
+        job.resume()
+        if self.on_resume is not None:
+            self.on_resume(job)
+
+    def _rebalance(self):
+        active = [job for job in self._jobs if not job.paused]
+        if self.limit is not None and len(active) > self.limit:
+            # newest first, the ones without processes only if that is not enough
+            candidates = sorted(reversed(active), key=lambda job: not job.has_processes)
+            for job in candidates[:len(active) - self.limit]:
+                self._pause(job)
+            return
+        room = None if self.limit is None else self.limit - len(active)
+        for job in self._jobs:
+            if room is not None and room <= 0:
+                break
+            if job.paused:
+                logging.info(f"Resuming encode of {job.name}")
+                self._resume(job)
+                if room is not None:
+                    room -= 1
+
+    def status(self) -> dict:
+        with self._condition:
+            return {
+                "limit": self.limit,
+                "running": [job.name for job in self._jobs if not job.paused],
+                "paused": [job.name for job in self._jobs if job.paused],
+                "running_threads": sum(job.threads for job in self._jobs if not job.paused),
+            }
+
+
+def _memory_available_percent(meminfo: Path = Path("/proc/meminfo")) -> Optional[float]:
+    try:
+        values = {}
+        for line in meminfo.read_text().splitlines():
+            key, _, value = line.partition(":")
+            values[key] = int(value.split()[0])
+        return 100 * values["MemAvailable"] / values["MemTotal"]
+    except (OSError, ValueError, KeyError, IndexError, ZeroDivisionError):
+        return None
+
+
+def _in_window(now: datetime.time, start: str, end: str) -> bool:
+    start_time = datetime.time.fromisoformat(start)
+    end_time = datetime.time.fromisoformat(end)
+    if start_time <= end_time:
+        return start_time <= now < end_time
+    return now >= start_time or now < end_time  # window over midnight
+
+
+class ThrottlePolicy:
+    """Automatic encode limit from the load of other processes, available memory and a time-of-day schedule
+
+    Under load or memory pressure the limit drops by one encode per evaluation,
+    and grows back by one per evaluation once the pressure is gone.
+    """
+
+    def __init__(self, total_cpus: int, max_foreign_load: float = None, min_available_memory_percent: float = None,
+                 schedule=None):
+        self.total_cpus = total_cpus
+        self.max_foreign_load = max_foreign_load  # load average of other processes, per CPU
+        self.min_available_memory_percent = min_available_memory_percent
+        self.schedule = list(schedule or [])  # [(start "HH:MM", end "HH:MM", max encodes)]
+        self._limit = None
+
+    def _pressure(self, running_threads: int):
+        """Reason to run fewer encodes, None if the machine is not under pressure"""
+        if self.max_foreign_load is not None and hasattr(os, "getloadavg"):
+            # the load average includes the threads of our own encodes
+            foreign = os.getloadavg()[0] - running_threads
+            if foreign > self.max_foreign_load * self.total_cpus:
+                return f"load of other processes {foreign:.1f}"
+        if self.min_available_memory_percent is not None:
+            available = _memory_available_percent()
+            if available is not None and available < self.min_available_memory_percent:
+                return f"{available:.0f}% memory available"
+        return None
+
+    def evaluate(self, status: dict, now: datetime.datetime = None):
+        """Return (limit or None, reason)"""
+        now = now or datetime.datetime.now()
+        admitted = len(status["running"]) + len(status["paused"])
+        reason = self._pressure(status["running_threads"])
+        if reason is not None:
+            current = self._limit if self._limit is not None else len(status["running"])
+            self._limit = max(0, min(current, len(status["running"])) - 1)
+        elif self._limit is not None:
+            self._limit += 1
+            if self._limit > admitted:
+                self._limit = None  # nothing is held back anymore
+
+        limit, reasons = self._limit, [reason] if reason else []
+        for start, end, max_encodes in self.schedule:
+            if _in_window(now.time(), start, end):
+                limit = max_encodes if limit is None else min(limit, max_encodes)
+                reasons.append(f"schedule {start}-{end}")
+        return limit, ", ".join(reasons)
+
+
+def read_control(path: Path) -> dict:
+    try:
+        return json.loads(Path(path).read_text())
+    except (OSError, ValueError):
+        return {}
+
+
+def write_control(path: Path, **changes):
+    """Update the control file of a running instance, e.g. write_control(path, paused=True)"""
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    control = {**read_control(path), **changes}
+    partial = path.with_name(path.name + ".part")
+    partial.write_text(json.dumps(control, indent=1))
+    os.replace(partial, path)
+
+
+class RuntimeController:
+    """Applies the control file and the throttle policy to the EncodeGate of a running pipeline
+
+    The control file is JSON with the optional keys "max_encodes" (null restores
+    the default), "paused" and "auto_throttle". The effective state is written
+    to a status file next to it.
+    """
+
+    def __init__(self, gate: EncodeGate, control_file: Path, policy: ThrottlePolicy = None,
+                 interval: float = 10):
+        self.gate = gate
+        self.control_file = Path(control_file)
+        self.status_file = self.control_file.with_name("status.json")
+        self.policy = policy
+        self.interval = interval
+        self.default_limit = gate.limit
+        self._stop = threading.Event()
+        self._thread = None
+
+    def apply(self, now: datetime.datetime = None):
+        control = read_control(self.control_file)
+        limit = control.get("max_encodes") or self.default_limit
+        reason = "manual" if control.get("max_encodes") else ""
+        if control.get("paused"):
+            limit, reason = 0, "paused"
+        elif self.policy is not None and control.get("auto_throttle", True):
+            auto_limit, auto_reason = self.policy.evaluate(self.gate.status(), now)
+            if auto_limit is not None and (limit is None or auto_limit < limit):
+                limit, reason = auto_limit, auto_reason
+        self.gate.set_limit(limit)
+        try:
+            self.status_file.write_text(json.dumps({**self.gate.status(), "reason": reason,
+                                                    "updated": time.strftime("%Y-%m-%dT%H:%M:%S")}, indent=1))
+        except OSError as e:
+            logging.debug(f"Could not write {self.status_file}: {e}")
+
+    def _loop(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.apply()
+            except Exception as e:
+                logging.warning(f"Runtime control failed: {e}")
+
+    def start(self):
+        self.apply()
+        self._thread = threading.Thread(target=self._loop, name="runtime-control", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stop applying changes and let paused encodes finish"""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.gate.set_limit(None)
@@ -0,0 +1,272 @@
+#!/usr/bin/env python3
+"""Scale test of the orchestration: the whole pipeline over a large tree of placeholder files
+
+Fake ffmpeg/ffprobe executables are put first on PATH. They answer with canned
+probe JSON, packet, cropdetect and -progress output after a configurable delay,
+and write a tiny output for every encode, so a run measures only our side:
+discovery, probe fan-out, deduplication, scheduling, logging and result handling.
+
+    python scale_harness.py --files 100000 --output after.json --compare before.json
+"""
+
+import argparse
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from config import Config
+from main import parse_args, run
+from process_runner import ProcessRunner, configure_runner, get_runner, shutdown_runner
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+# 1080p h264, a tagged stereo track and an untagged one (measured from packets), 2 subtitles
+PROBE_RESULT = {
+    "streams": [
+        {"index": 0, "codec_type": "video", "codec_name": "h264", "width": 1920, "height": 1080},
+        {"index": 1, "codec_type": "audio", "codec_name": "aac", "channels": 2, "bit_rate": "320000"},
+        {"index": 2, "codec_type": "audio", "codec_name": "flac", "channels": 2},
+        {"index": 3, "codec_type": "subtitle", "codec_name": "subrip", "tags": {"language": "eng"}},
+        {"index": 4, "codec_type": "subtitle", "codec_name": "subrip", "tags": {"language": "ger"}},
+    ],
+    "format": {"format_name": "matroska,webm", "duration": "__DURATION__", "size": "1000000000",
+               "bit_rate": "4000000"},
+}
+
+ENCODERS = """Encoders:
+ V..... = Video
+ A..... = Audio
+ ------
+ V....D libsvtav1            SVT-AV1(Scalable Video Technology for AV1) encoder (codec av1)
+ A....D libopus              libopus Opus (codec opus)
+ A....D libfdk_aac           Fraunhofer FDK AAC (codec aac)
+ A....D aac                  AAC (Advanced Audio Coding)
+"""
+
+FILTERS = """Filters:
+  T.. = Timeline support
+  ------
+ ... crop              V->V       Crop the input video.
+ ... cropdetect        V->V       Auto-detect crop size.
+ ... scale             V->V       Scale the input video size.
+"""
+
+# Both fakes are this script, they tell by their name what they are
+FAKE_TOOL = r'''
+import json
+import os
+import sys
+import time
+
+args = sys.argv[1:]
+duration = float(os.environ.get("SCALE_FAKE_DURATION", "1800"))
+
+
+def wait(variable):
+    time.sleep(float(os.environ.get(variable, "0")))
+
+
+if os.path.basename(sys.argv[0]) == "ffprobe":
+    if "-show_format" in args:
+        wait("SCALE_FAKE_PROBE_LATENCY")
+        print(__PROBE__.replace('"__DURATION__"', str(duration)))
+    elif "packet=pts_time,flags" in args:
+        # keyframe lookup: a keyframe at the start of every read interval
+        wait("SCALE_FAKE_PROBE_LATENCY")
+        intervals = args[args.index("-read_intervals") + 1].split(",")
+        sys.stdout.write("".join(f"{interval.split('%')[0]},K__\n" for interval in intervals))
+    elif any(arg.startswith("packet=") for arg in args):
+        wait("SCALE_FAKE_ANALYSIS_LATENCY")
+        packets = int(duration * 48000 / 1024 / 100)  # every 100th packet of the untagged 48 kHz track
+        sys.stdout.write("".join(f"stream_index=2|size=102400|duration_time=2.133333\n" for _ in range(packets)))
+    else:
+        wait("SCALE_FAKE_PROBE_LATENCY")
+    sys.exit(0)
+
+if "-version" in args:
+    print("ffmpeg version 99.0-scale-harness Copyright (c) fake")
+elif "-encoders" in args:
+    print(__ENCODERS__)
+elif "-filters" in args:
+    print(__FILTERS__)
+elif any(arg.startswith("cropdetect") for arg in args):
+    wait("SCALE_FAKE_ANALYSIS_LATENCY")
+    for sample in range(args.count("-i")):
+        sys.stderr.write(f"[Parsed_cropdetect_{sample} @ 0x0] x1:0 x2:1919 y1:140 y2:939 w:1920 h:800 "
+                         f"x:0 y:140 pts:0 t:{sample}.000 crop=1920:800:0:140\n")
+else:
+    # an encode: -progress blocks on stdout while it "runs", then a small output file
+    steps = 4
+    latency = float(os.environ.get("SCALE_FAKE_ENCODE_LATENCY", "0"))
+    for step in range(1, steps + 1):
+        time.sleep(latency / steps)
+        out_time_us = int(duration * 1e6 * step / steps)
+        sys.stdout.write(f"frame={int(24 * duration * step / steps)}\nfps=240.0\nout_time_us={out_time_us}\n"
+                         f"speed=10x\nprogress={'end' if step == steps else 'continue'}\n")
+        sys.stdout.flush()
+    with open(args[-1], "wb") as output:
+        output.write(b"\0" * 1024)
+'''
+
+
+def write_fake_tools(bin_dir: Path):
+    """Write the fake ffmpeg and ffprobe into bin_dir"""
+    bin_dir.mkdir(parents=True, exist_ok=True)
+    source = (FAKE_TOOL.replace("__PROBE__", repr(json.dumps(PROBE_RESULT)))
+              .replace("__ENCODERS__", repr(ENCODERS)).replace("__FILTERS__", repr(FILTERS)))
+    for name in ("ffmpeg", "ffprobe"):
+        path = bin_dir / name
+        # -S: no site import, the fakes should start as fast as possible
+        path.write_text(f"#!{sys.executable} -S\n{source}")
+        path.chmod(0o755)
+
+
+def make_tree(root: Path, files: int, files_per_dir: int):
+    """Create `files` placeholder videos; each holds its own name, so none of them are duplicates"""
+    if root.exists():
+        shutil.rmtree(root)
+    for i in range(files):
+        directory = root / f"show_{i // (files_per_dir * 10):03d}" / f"season_{i // files_per_dir:04d}"
+        if i % files_per_dir == 0:
+            directory.mkdir(parents=True)
+        path = directory / f"episode_{i:07d}.mkv"
+        path.write_text(path.name)
+
+
+def harness_config(source_dir: Path, cache_dir: Path) -> Config:
+    config = Config()
+    config.source_dir = source_dir
+    config.cache_dir = cache_dir
+    config.probe_cache_file = cache_dir / "probe_cache.sqlite"
+    config.capabilities_cache_file = cache_dir / "ffmpeg_capabilities.json"
+    config.state_db_file = cache_dir / "state.sqlite"
+    config.control_file = cache_dir / "control.json"
+    config.scratch_dir = cache_dir / "scratch"
+    config.lease_dir = cache_dir / "leases"
+    return config
+
+
+def _spawns(runner: ProcessRunner):
+    return {kind: stats["spawns"] for kind, stats in runner.stats().items()}
+
+
+def peak_rss_bytes():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024  # bytes on macOS, KiB elsewhere
+
+
+def run_pipeline(config: Config, workdir: Path, runner: ProcessRunner = None) -> dict:
+    """Run main.run over config.source_dir, returns the figures"""
+    shutil.rmtree(config.cache_dir, ignore_errors=True)
+    config.cache_dir.mkdir(parents=True)
+    runner = runner or get_runner()
+    spawns_before = _spawns(runner)
+    started = time.perf_counter()
+    outcome = run(config, runner, parse_args([]), workdir / "metrics.jsonl")
+    wall = time.perf_counter() - started
+
+    files = outcome["done"] + outcome["failed"]
+    spawns = {kind: count - spawns_before.get(kind, 0) for kind, count in _spawns(runner).items()}
+    results = {
+        "files": files,
+        "failed": outcome["failed"],
+        "duplicates": outcome["duplicates"],
+        "wall_s": round(wall, 3),
+        "files_per_s": round(files / wall, 2) if wall else 0.0,
+        "spawns_per_file": round(sum(spawns.values()) / files, 2) if files else 0.0,
+        "spawns_by_kind": spawns,
+        "peak_rss_mb": round(peak_rss_bytes() / 1e6, 1) if resource is not None else None,
+        "scheduler_idle_percent": None,
+    }
+    if outcome["scheduler_cpus"] and wall:
+        idle = outcome["scheduler_idle_cpu_seconds"]
+        results["scheduler_idle_percent"] = round(100 * idle / (outcome["scheduler_cpus"] * wall), 1)
+    return results
+
+
+def compare(current: dict, baseline: dict, threshold: float):
+    """Return human readable regressions of `current` against `baseline` beyond threshold percent"""
+    regressions = []
+    for key, higher_is_better in (("files_per_s", True), ("spawns_per_file", False), ("peak_rss_mb", False)):
+        new, old = current.get(key), baseline.get(key)
+        if not old or new is None:
+            continue
+        change = 100 * (new - old) / old
+        if (change < -threshold) if higher_is_better else (change > threshold):
+            regressions.append(f"{key}: {old} -> {new} ({change:+.1f}%)")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workdir", type=Path, default=Path(tempfile.gettempdir()) / "recode-scale-harness")
+    parser.add_argument("--files", type=int, default=10000)
+    parser.add_argument("--files-per-dir", type=int, default=20)
+    parser.add_argument("--probe-latency", type=float, default=0.01, help="seconds per fake ffprobe")
+    parser.add_argument("--analysis-latency", type=float, default=0.02, help="seconds per fake cropdetect/packet read")
+    parser.add_argument("--encode-latency", type=float, default=0.05, help="seconds per fake encode")
+    parser.add_argument("--duration", type=float, default=1800, help="reported duration of every file")
+    parser.add_argument("--encode-cpus", type=int, default=64,
+                        help="CPUs the scheduler hands out, the fake encodes use none, so this can exceed the real count")
+    parser.add_argument("--leases", action="store_true", help="take a lease for every file like a multi-host run")
+    parser.add_argument("--output", type=Path, default=Path("scale_results.json"))
+    parser.add_argument("--compare", type=Path, help="earlier results to check for regressions")
+    parser.add_argument("--threshold", type=float, default=10.0, help="allowed change in percent")
+    args = parser.parse_args()
+
+    write_fake_tools(args.workdir / "bin")
+    os.environ["PATH"] = str(args.workdir / "bin") + os.pathsep + os.environ.get("PATH", "")
+    os.environ.update({
+        "SCALE_FAKE_PROBE_LATENCY": str(args.probe_latency),
+        "SCALE_FAKE_ANALYSIS_LATENCY": str(args.analysis_latency),
+        "SCALE_FAKE_ENCODE_LATENCY": str(args.encode_latency),
+        "SCALE_FAKE_DURATION": str(args.duration),
+    })
+    print(f"Creating {args.files} placeholder files")
+    make_tree(args.workdir / "tree", args.files, args.files_per_dir)
+
+    # the log is part of the measured overhead, like the log file of main.py
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s",
+                        handlers=[logging.FileHandler(args.workdir / "harness.log", mode="w")])
+    config = harness_config(args.workdir / "tree", args.workdir / "cache")
+    config.encode_cpus = args.encode_cpus
+    config.pin_encode_cpus = False  # the simulated CPUs don't exist
+    config.coordination_enabled = args.leases
+    runner = configure_runner(config)
+    try:
+        results = run_pipeline(config, args.workdir, runner)
+    finally:
+        shutdown_runner()
+    results["meta"] = {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "cpus": os.cpu_count(),
+        "latencies_s": {"probe": args.probe_latency, "analysis": args.analysis_latency,
+                        "encode": args.encode_latency},
+    }
+
+    print(f"{results['files']} files in {results['wall_s']}s: {results['files_per_s']} files/s, "
+          f"{results['spawns_per_file']} spawns per file, peak RSS {results['peak_rss_mb']} MB, "
+          f"scheduler idle {results['scheduler_idle_percent']}%")
+    args.output.write_text(json.dumps(results, indent=2))
+    print(f"Results written to {args.output}")
+
+    if args.compare:
+        regressions = compare(results, json.loads(args.compare.read_text()), args.threshold)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,275 @@
+import logging
+import math
+import os
+import platform
+import shutil
+import threading
+import time
+from pathlib import Path
+
+# SVT-AV1 2.x interprets `lp` as a level of parallelism instead of a thread count.
+# Approximate number of cores each level keeps busy.
+LP_LEVEL_THREADS = {1: 1, 2: 2, 3: 8, 4: 12, 5: 16, 6: 20}
+
+FULL_HD_PIXELS = 1920 * 1080
+
+
+def _cgroup_cpu_limit():
+    """CPU limit of the container from cgroup v2 (cpu.max) or v1 (cfs quota), None if unlimited"""
+    try:
+        quota, period = Path("/sys/fs/cgroup/cpu.max").read_text().split()
+        if quota != "max":
+            return float(quota) / float(period)
+        return None
+    except (OSError, ValueError):
+        pass
+    try:
+        quota = int(Path("/sys/fs/cgroup/cpu/cpu.cfs_quota_us").read_text())
+        period = int(Path("/sys/fs/cgroup/cpu/cpu.cfs_period_us").read_text())
+        if quota > 0 and period > 0:
+            return quota / period
+    except (OSError, ValueError):
+        pass
+    return None
+
+
+def available_cpus() -> int:
+    """Number of CPUs this process may use, respecting cpusets (affinity) and cgroup quotas"""
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:  # not available on macOS/Windows
+        cpus = os.cpu_count() or 1
+    limit = _cgroup_cpu_limit()
+    if limit is not None:
+        cpus = min(cpus, max(1, math.ceil(limit)))
+    return cpus
+
+
+def parse_cpulist(text: str):
+    """CPU numbers of a kernel cpulist like "0-3,8-11" """
+    cpus = set()
+    for part in text.strip().split(","):
+        if not part:
+            continue
+        start, _, end = part.partition("-")
+        cpus.update(range(int(start), int(end or start) + 1))
+    return cpus
+
+
+def format_cpulist(cpus) -> str:
+    """Inverse of parse_cpulist, as accepted by taskset -c"""
+    ranges = []
+    for cpu in sorted(cpus):
+        if ranges and cpu == ranges[-1][1] + 1:
+            ranges[-1][1] = cpu
+        else:
+            ranges.append([cpu, cpu])
+    return ",".join(str(a) if a == b else f"{a}-{b}" for a, b in ranges)
+
+
+def numa_nodes(allowed=None, node_dir: Path = Path("/sys/devices/system/node")):
+    """The CPUs this process may use, grouped by NUMA node (a single group without NUMA information)"""
+    if allowed is None:
+        allowed = os.sched_getaffinity(0)
+    nodes = []
+    for cpulist in sorted(node_dir.glob("node[0-9]*/cpulist")):
+        try:
+            cpus = parse_cpulist(cpulist.read_text()) & set(allowed)
+        except (OSError, ValueError):
+            continue
+        if cpus:
+            nodes.append(frozenset(cpus))
+    return nodes or [frozenset(allowed)]
+
+
+def affinity_prefix(cpus):
+    """Command prefix pinning a process to the given CPUs, empty for no pinning"""
+    if not cpus:
+        return []
+    return ["taskset", "-c", format_cpulist(cpus)]
+
+
+def low_priority_prefix():
+    """Return the command prefix to run a process at lowest priority based on OS"""
+    system = platform.system().lower()
+    if system == 'darwin':  # macOS
+        return ["nice", "-n", "20"]
+    elif system == 'linux':
+        return ["nice", "-n", "19"]
+    elif system == 'windows':
+        return ["start", "/low", "/wait", "cmd", "/c"]
+    return []  # Default: no prefix
+
+
+def split_cpus(cpus, parts: int):
+    """Split a CPU set into up to `parts` disjoint sets of consecutive CPUs"""
+    cpus = sorted(cpus)
+    parts = max(1, min(parts, len(cpus)))
+    size, extra = divmod(len(cpus), parts)
+    slices, start = [], 0
+    for i in range(parts):
+        end = start + size + (1 if i < extra else 0)
+        slices.append(frozenset(cpus[start:end]))
+        start = end
+    return slices
+
+
+class CpuAllocator:
+    """Hands out disjoint CPU sets, each within one NUMA node where possible
+
+    A set is taken from the node with the fewest free CPUs that still holds it
+    (best fit), so large sets keep finding a whole node. Only sets larger than
+    every node's free CPUs are spread over several nodes.
+    """
+
+    def __init__(self, nodes):
+        self.nodes = [frozenset(node) for node in nodes]
+        self._free = [set(node) for node in self.nodes]
+
+    def allocate(self, count: int, prefer=None):
+        """Take `count` CPUs, the ones in prefer if they are all free, e.g. to give a resumed job its CPUs back"""
+        if prefer and len(prefer) == count and all(any(cpu in free for free in self._free) for cpu in prefer):
+            for free in self._free:
+                free.difference_update(prefer)
+            return frozenset(prefer)
+        fitting = [free for free in self._free if len(free) >= count]
+        if fitting:
+            cpus = sorted(min(fitting, key=len))[:count]
+        else:
+            cpus = []
+            for free in sorted(self._free, key=len, reverse=True):
+                cpus += sorted(free)[:count - len(cpus)]
+                if len(cpus) >= count:
+                    break
+        for free in self._free:
+            free.difference_update(cpus)
+        return frozenset(cpus)
+
+    def release(self, cpus):
+        for node, free in zip(self.nodes, self._free):
+            free.update(node & set(cpus))
+
+    @classmethod
+    def detect(cls):
+        """Allocator over the CPUs of this process, None where pinning is not supported"""
+        if not hasattr(os, "sched_getaffinity") or shutil.which("taskset") is None:
+            return None
+        return cls(numa_nodes())
+
+
+def output_pixels(width: int, height: int) -> int:
+    """Pixels per frame after the scale=1920:-2 applied to larger sources"""
+    if width > 1920 and height > 0:
+        height = round(height * 1920 / width)
+        width = 1920
+    return width * height
+
+
+def thread_budget(width: int, height: int, preset: int, total_cpus: int):
+    """Return (threads, lp level) an SVT-AV1 encode of this size and preset can use efficiently
+
+    A 1080p encode at a slow preset scales well to about 16 threads, smaller
+    frames and faster presets saturate fewer cores.
+    """
+    ideal = 16 * output_pixels(width, height) / FULL_HD_PIXELS
+    if preset <= 3:
+        ideal *= 1.25
+    elif preset >= 8:
+        ideal *= 0.5
+
+    for level, threads in sorted(LP_LEVEL_THREADS.items()):
+        if threads >= ideal:
+            break
+    # on few CPUs, the level must not start more threads than there are CPUs
+    threads = min(threads, total_cpus)
+    return threads, lp_level(threads)
+
+
+def lp_level(threads: int) -> int:
+    """Highest SVT-AV1 lp level that runs at most `threads` threads"""
+    return max((level for level, count in LP_LEVEL_THREADS.items() if count <= threads), default=1)
+
+
+class EncodeScheduler:
+    """Admit concurrent encodes as long as the sum of their thread budgets fits the CPUs
+
+    A job whose budget is larger than what is free waits until enough jobs
+    finished. A job is always admitted when nothing else runs. With a
+    CpuAllocator, every admitted job also gets its own set of CPUs.
+    """
+
+    def __init__(self, total_cpus: int, allocator: CpuAllocator = None):
+        self.total_cpus = total_cpus
+        self.allocator = allocator
+        self._used = 0
+        self._running = 0
+        self._condition = threading.Condition()
+        self._idle_cpu_seconds = 0.0
+        self._changed = time.monotonic()
+
+    def _account(self):
+        """Add the CPU time nobody reserved since the last change, called with the condition held"""
+        now = time.monotonic()
+        self._idle_cpu_seconds += max(0, self.total_cpus - self._used) * (now - self._changed)
+        self._changed = now
+
+    def idle_cpu_seconds(self) -> float:
+        """CPU seconds not reserved by any encode since the scheduler was created"""
+        with self._condition:
+            self._account()
+            return self._idle_cpu_seconds
+
+    def acquire(self, threads: int):
+        """Wait until the job fits, returns the CPUs it is pinned to (None without an allocator)"""
+        with self._condition:
+            while self._running and self._used + threads > self.total_cpus:
+                self._condition.wait()
+            self._account()
+            self._used += threads
+            self._running += 1
+            cpus = self.allocator.allocate(threads) if self.allocator is not None else None
+            logging.debug(f"Encode admitted with {threads} threads, {self._used}/{self.total_cpus} CPUs in use"
+                          + (f", pinned to {format_cpulist(cpus)}" if cpus else ""))
+            return cpus or None
+
+    def release(self, threads: int, cpus=None):
+        with self._condition:
+            if cpus and self.allocator is not None:
+                self.allocator.release(cpus)
+            self._account()
+            self._used -= threads
+            self._running -= 1
+            self._condition.notify_all()
+
+    def release_cpus(self, cpus):
+        """Free the CPUs of a finishing job ahead of release(), e.g. for a paused job that resumes first"""
+        with self._condition:
+            if cpus and self.allocator is not None:
+                self.allocator.release(cpus)
+
+    def suspend(self, threads: int, cpus=None):
+        """A running job was paused, its threads and CPUs are free for other jobs until unsuspend()"""
+        with self._condition:
+            if cpus and self.allocator is not None:
+                self.allocator.release(cpus)
+            self._account()
+            self._used -= threads
+            self._condition.notify_all()
+
+    def unsuspend(self, threads: int, cpus=None):
+        """Count a paused job again once it continues, even if that oversubscribes the CPUs for a while
+
+        Returns the CPUs the job continues on: the ones it had (cpus) if they are still
+        free, otherwise what is free now, None without an allocator or if nothing is free.
+        """
+        with self._condition:
+            self._account()
+            self._used += threads
+            if not cpus or self.allocator is None:
+                return None
+            return self.allocator.allocate(len(cpus), prefer=cpus) or None
+
+    @property
+    def running(self) -> int:
+        with self._condition:
+            return self._running
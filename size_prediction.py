@@ -0,0 +1,141 @@
+import json
+import logging
+import subprocess
+import tempfile
+import time
+from pathlib import Path
+from typing import Optional
+
+from chunked_encode import with_lp_level
+from config import Config
+from crop_detect import sample_positions
+from media_probe import MediaInfo, ProbeCache, file_fingerprint
+from process_runner import ANALYSIS, get_runner
+
+
+def sample_windows(duration: float, count: int, seconds: float):
+    """(start, length) of the sample encodes, spread evenly over the duration
+
+    Files too short for separate samples are sampled as a whole.
+    """
+    if duration <= 0 or duration <= count * seconds:
+        return [(0.0, duration or seconds)]
+    return [(max(0.0, round(t - seconds / 2, 3)), seconds) for t in sample_positions(duration, count)]
+
+
+class SizePrediction:
+    """Video size and encode time of the sample encodes of one file, compared with the source"""
+
+    def __init__(self, sampled_seconds: float, source_bytes: int, encoded_bytes: int, encode_seconds: float):
+        self.sampled_seconds = sampled_seconds
+        self.source_bytes = source_bytes  # video packets of the sampled windows in the source
+        self.encoded_bytes = encoded_bytes  # the same windows encoded with the real settings
+        self.encode_seconds = encode_seconds  # wall time of the single-threaded sample encodes
+
+    @property
+    def ratio(self) -> float:
+        return self.encoded_bytes / self.source_bytes if self.source_bytes else 1.0
+
+    @property
+    def saving_percent(self) -> float:
+        return 100 * (1 - self.ratio)
+
+    def predicted_video_bytes(self, duration: float) -> int:
+        return int(self.encoded_bytes / self.sampled_seconds * duration) if self.sampled_seconds else 0
+
+    def predicted_encode_seconds(self, duration: float) -> float:
+        return self.encode_seconds / self.sampled_seconds * duration if self.sampled_seconds else 0.0
+
+    def to_json(self) -> str:
+        return json.dumps(self.__dict__)
+
+    @classmethod
+    def from_json(cls, text: str):
+        return cls(**json.loads(text))
+
+
+class SizePredictor:
+    """Encode a few short samples with the real video settings to predict the saving of a full encode"""
+
+    def __init__(self, filepath: Path, config: Config, media_info: MediaInfo, video_cmd, cache: ProbeCache = None,
+                 command_prefix=None):
+        self.filepath = filepath
+        self.config = config
+        self.media_info = media_info
+        self.video_cmd = video_cmd
+        self.cache = cache
+        self.command_prefix = command_prefix or []
+
+    def _cache_params(self):
+        """Settings the prediction depends on, part of the cache key"""
+        return (f"{' '.join(self.video_cmd)}|{self.config.size_prediction_samples}:"
+                f"{self.config.size_prediction_sample_seconds}|packets")
+
+    def sample_command(self, start: float, seconds: float, encoded_path: Path):
+        # the samples run outside the EncodeScheduler, so they must not take the CPUs reserved for encodes
+        return [
+            *self.command_prefix,
+            "ffmpeg", "-hide_banner", "-nostats", "-y", "-threads", "1",
+            "-ss", f"{start:.3f}", "-t", f"{seconds:.3f}", "-i", str(self.filepath),
+            "-map", "0:v:0", *with_lp_level(self.video_cmd, 1), "-an", "-sn", "-dn", str(encoded_path),
+        ]
+
+    def source_bytes_command(self, windows):
+        return [
+            "ffprobe", "-v", "error", "-select_streams", "v:0",
+            "-read_intervals", ",".join(f"{start:.3f}%+{seconds:.3f}" for start, seconds in windows),
+            "-show_entries", "packet=pts_time,size", "-of", "csv=p=0", str(self.filepath),
+        ]
+
+    def _source_bytes(self, windows) -> int:
+        """Size of the source video packets inside the windows
+
+        ffprobe starts every interval at the keyframe before it, the packets before
+        the window are left out so the reference covers exactly what was encoded.
+        """
+        output = get_runner().run(self.source_bytes_command(windows), ANALYSIS).stdout
+        total = 0
+        for line in output.splitlines():
+            parts = line.strip().split(",")
+            try:
+                pts, size = float(parts[0]), int(parts[1])
+            except (IndexError, ValueError):
+                continue
+            if any(start <= pts < start + seconds for start, seconds in windows):
+                total += size
+        return total
+
+    def _encode_samples(self) -> SizePrediction:
+        sampled_seconds, encoded_bytes, encode_seconds = 0.0, 0, 0.0
+        windows = sample_windows(self.media_info.duration, self.config.size_prediction_samples,
+                                 self.config.size_prediction_sample_seconds)
+        with tempfile.TemporaryDirectory(prefix="recode-samples-") as workdir:
+            for i, (start, seconds) in enumerate(windows):
+                encoded_path = Path(workdir) / f"sample_{i}.mkv"
+                started = time.perf_counter()
+                get_runner().run(self.sample_command(start, seconds, encoded_path), ANALYSIS)
+                encode_seconds += time.perf_counter() - started
+                sampled_seconds += seconds
+                encoded_bytes += encoded_path.stat().st_size
+        return SizePrediction(sampled_seconds, self._source_bytes(windows), encoded_bytes, encode_seconds)
+
+    def predict(self) -> Optional[SizePrediction]:
+        """Return the prediction, or None if the samples could not be encoded"""
+        fingerprint = None
+        if self.cache is not None:
+            fingerprint = file_fingerprint(self.filepath)
+            cached = self.cache.get_samples(self.filepath, fingerprint, self._cache_params())
+            if cached is not None:
+                return SizePrediction.from_json(cached)
+
+        try:
+            prediction = self._encode_samples()
+        except (subprocess.CalledProcessError, subprocess.TimeoutExpired, OSError) as e:
+            # failed predictions are not cached, the file is encoded as usual
+            stderr = getattr(e, "stderr", "") or ""
+            logging.warning(f"Sample encode failed for {self.filepath}: {e} {stderr[-500:]}")
+            return None
+
+        if self.cache is not None:
+            self.cache.put_samples(self.filepath, fingerprint, self._cache_params(), prediction.to_json())
+        return prediction
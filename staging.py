@@ -0,0 +1,154 @@
+import concurrent.futures
+import hashlib
+import logging
+import os
+import shutil
+import threading
+from pathlib import Path
+from typing import Optional
+
+from resume import is_resumable
+
+
+class ScratchStaging:
+    """Local scratch copies of queued inputs, and background write-back of the encoded outputs
+
+    Inputs are copied ahead of their encode by a single prefetch thread, so only
+    one sequential read hits the source mount at a time. Every staged file
+    reserves twice its size (the input copy and an output of at most the same
+    size) from `budget_bytes` until its write-back finished.
+    """
+
+    def __init__(self, scratch_dir: Path, budget_bytes: int, prefetch_count: int, write_back_workers: int = 1):
+        self.scratch_dir = Path(scratch_dir)
+        self.scratch_dir.mkdir(parents=True, exist_ok=True)
+        self.budget_bytes = budget_bytes
+        self.prefetch_count = prefetch_count
+        self._lock = threading.Lock()
+        self._reserved = 0
+        self._staged = {}  # source path -> (copy future, reserved bytes)
+        self._copy_pool = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="prefetch")
+        self._write_back_pool = concurrent.futures.ThreadPoolExecutor(max_workers=write_back_workers,
+                                                                      thread_name_prefix="write-back")
+        self._write_backs = set()
+        self._clean_stale()
+
+    def _clean_stale(self):
+        """Remove scratch files of an earlier run, except chunk directories that can be resumed"""
+        for entry in self.scratch_dir.iterdir():
+            if entry.is_dir():
+                if not is_resumable(entry):
+                    shutil.rmtree(entry, ignore_errors=True)
+            else:
+                entry.unlink(missing_ok=True)
+
+    def _scratch_path(self, filepath: Path, kind: str) -> Path:
+        # files of different directories may share a name
+        digest = hashlib.sha1(str(filepath).encode()).hexdigest()[:12]
+        return self.scratch_dir / f"{digest}.{kind}{Path(filepath).suffix}"
+
+    def prefetch(self, filepath: Path) -> bool:
+        """Start copying an input to scratch, returns False if it does not fit the budget right now"""
+        with self._lock:
+            if filepath in self._staged:
+                return True
+            try:
+                reserve = 2 * os.stat(filepath).st_size
+                free = shutil.disk_usage(self.scratch_dir).free
+            except OSError:
+                return False
+            if self._reserved + reserve > self.budget_bytes or reserve > free:
+                return False
+            self._reserved += reserve
+            self._staged[filepath] = (self._copy_pool.submit(self._copy_in, filepath), reserve)
+        return True
+
+    def _copy_in(self, filepath: Path) -> Path:
+        path = self._scratch_path(filepath, "input")
+        partial = path.with_name(path.name + ".part")
+        try:
+            shutil.copyfile(filepath, partial)
+            os.replace(partial, path)
+        except BaseException:
+            partial.unlink(missing_ok=True)
+            raise
+        logging.info(f"Staged {filepath} to {path}")
+        return path
+
+    def staged_input(self, filepath: Path) -> Optional[Path]:
+        """Wait for the scratch copy of an input, None if it was not prefetched or the copy failed"""
+        with self._lock:
+            entry = self._staged.get(filepath)
+        if entry is None:
+            return None
+        try:
+            return entry[0].result()
+        except Exception as e:
+            logging.warning(f"Could not stage {filepath}, encoding from the source: {e}")
+            self.discard(filepath)
+            return None
+
+    def scratch_output(self, filepath: Path) -> Path:
+        return self._scratch_path(filepath, "output").with_suffix(".mkv")
+
+    def chunk_dir(self, filepath: Path) -> Path:
+        """Work directory of a chunked encode of the scratch output"""
+        output = self.scratch_output(filepath)
+        return output.with_name(output.name + ".chunks")
+
+    def release_input(self, filepath: Path):
+        """Delete the scratch copy of an input once its encode finished"""
+        self._scratch_path(filepath, "input").unlink(missing_ok=True)
+
+    def discard(self, filepath: Path):
+        """Delete the scratch files of a file and free its reservation
+
+        A chunk directory that can be resumed is kept for the next attempt, it is
+        only removed once the output was written back.
+        """
+        with self._lock:
+            entry = self._staged.pop(filepath, None)
+            if entry is not None:
+                self._reserved -= entry[1]
+        self.release_input(filepath)
+        output = self.scratch_output(filepath)
+        output.unlink(missing_ok=True)
+        chunks = self.chunk_dir(filepath)
+        if chunks.exists() and not is_resumable(chunks):
+            shutil.rmtree(chunks, ignore_errors=True)
+
+    def write_back(self, filepath: Path, write) -> concurrent.futures.Future:
+        """Run `write()` (copying the output back) on a write-back thread, returns its future"""
+        def run():
+            try:
+                result = write()
+                shutil.rmtree(self.chunk_dir(filepath), ignore_errors=True)
+                return result
+            finally:
+                self.discard(filepath)
+
+        future = self._write_back_pool.submit(run)
+        with self._lock:
+            self._write_backs.add(future)
+        future.add_done_callback(self._write_back_done)
+        return future
+
+    def _write_back_done(self, future):
+        with self._lock:
+            self._write_backs.discard(future)
+
+    def wait(self):
+        """Block until all pending write-backs are finished"""
+        with self._lock:
+            pending = set(self._write_backs)
+        concurrent.futures.wait(pending)
+
+    def close(self):
+        """Wait for the write-backs and remove the scratch copies that were never encoded"""
+        self.wait()
+        self._copy_pool.shutdown(wait=True)
+        self._write_back_pool.shutdown(wait=True)
+        with self._lock:
+            leftover = list(self._staged)
+        for filepath in leftover:
+            self.discard(filepath)
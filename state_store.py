@@ -0,0 +1,131 @@
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Optional
+
+from config import Config
+
+ENCODED = "encoded"
+UNTOUCHED = "untouched"
+FAILED = "failed"
+
+# Config attributes that influence the result of processing a file
+SETTINGS_FIELDS = [
+    "base_quality",
+    "cpu",
+    "audio_bitrate_stereo",
+    "audio_bitrate_threshold",
+    "audio_multichannel_vbr_level",
+    "audio_multichannel_aac_at_quality",
+    "keyint_seconds",
+    "crop_timestamps",
+    "crop_sample_count",
+    "crop_frames_per_sample",
+]
+
+# Only part of the settings while size prediction is enabled, state recorded before it was added stays valid
+SIZE_PREDICTION_FIELDS = [
+    "size_prediction_samples",
+    "size_prediction_sample_seconds",
+    "size_prediction_min_saving_percent",
+]
+
+# Metadata tags written by FileProcessor._build_metadata_commands
+SETTINGS_TAGS = ("video_settings", "audio_settings")
+
+
+def settings_key(config: Config) -> str:
+    """Short hash of the settings that would change the output of an encode"""
+    fields = SETTINGS_FIELDS + (SIZE_PREDICTION_FIELDS if config.size_prediction_enabled else [])
+    settings = {field: getattr(config, field) for field in fields}
+    encoded = json.dumps(settings, sort_keys=True, default=str).encode()
+    return hashlib.sha1(encoded).hexdigest()[:16]
+
+
+def has_settings_tags(format_tags: dict) -> bool:
+    """Check if a file carries the metadata tags of a previous encode by this script"""
+    keys = {k.lower() for k in format_tags}
+    return any(tag in keys for tag in SETTINGS_TAGS)
+
+
+class StateStore:
+    """SQLite backed record of the outcome of every processed file
+
+    A file is finished when its fingerprint (size, mtime) and the settings it was
+    processed with match the current ones. Everything else is queued again.
+    """
+
+    def __init__(self, db_path: Path, retry_failed: bool = False):
+        db_path = Path(db_path)
+        db_path.parent.mkdir(parents=True, exist_ok=True)
+        self.retry_failed = retry_failed
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(db_path), check_same_thread=False)
+        with self._lock, self._conn:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS files ("
+                "path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, outcome TEXT, "
+                "reason TEXT, settings TEXT, updated REAL)"
+            )
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS directories ("
+                "path TEXT PRIMARY KEY, mtime_ns INTEGER, settings TEXT, updated REAL)"
+            )
+
+    def record(self, filepath: Path, fingerprint, outcome: str, settings: str, reason: Optional[str] = None):
+        size, mtime_ns = fingerprint
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO files (path, size, mtime_ns, outcome, reason, settings, updated) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (str(filepath), size, mtime_ns, outcome, reason, settings, time.time())
+            )
+
+    def lookup(self, filepath: Path) -> Optional[dict]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT size, mtime_ns, outcome, reason, settings FROM files WHERE path = ?",
+                (str(filepath),)
+            ).fetchone()
+        if row is None:
+            return None
+        return {
+            "fingerprint": (row[0], row[1]),
+            "outcome": row[2],
+            "reason": row[3],
+            "settings": row[4],
+        }
+
+    def is_finished(self, filepath: Path, fingerprint, settings: str) -> bool:
+        """Check if the file was already handled with the current settings and did not change since"""
+        entry = self.lookup(filepath)
+        if entry is None:
+            return False
+        if entry["fingerprint"] != tuple(fingerprint) or entry["settings"] != settings:
+            return False
+        if entry["outcome"] == FAILED:
+            return not self.retry_failed
+        return True
+
+    def record_directory(self, directory: Path, mtime_ns: int, settings: str):
+        """Mark all video files of a directory as finished"""
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO directories (path, mtime_ns, settings, updated) VALUES (?, ?, ?, ?)",
+                (str(directory), mtime_ns, settings, time.time())
+            )
+
+    def is_directory_finished(self, directory: Path, mtime_ns: int, settings: str) -> bool:
+        """Check if a directory was finished and no entry was added, removed or renamed since"""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT mtime_ns, settings FROM directories WHERE path = ?", (str(directory),)
+            ).fetchone()
+        return row is not None and row[0] == mtime_ns and row[1] == settings
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,47 @@
+"""Tests for the single-pass audio bitrate estimation"""
+
+import subprocess
+
+from audio_bitrate import SAMPLED, estimate_audio_bitrates, parse_packets
+from media_probe import MediaInfo
+
+PROBE = {
+    "streams": [
+        {"index": 0, "codec_type": "video", "codec_name": "h264"},
+        {"index": 1, "codec_type": "audio", "codec_name": "ac3", "channels": 6},
+        {"index": 2, "codec_type": "audio", "codec_name": "aac", "channels": 2},
+    ],
+    "format": {"duration": "1000.0"},
+}
+
+
+def test_parse_packets_sums_per_stream():
+    output = (
+        "stream_index=1|duration_time=0.032000|size=1792\n"
+        "stream_index=2|duration_time=0.021333|size=400\n"
+        "stream_index=1|duration_time=0.032000|size=1792\n"
+        "stream_index=2|duration_time=N/A|size=400\n"
+    )
+    totals = parse_packets(output)
+    assert totals[1] == (3584, 0.064)
+    assert totals[2][0] == 800
+
+
+def test_estimates_all_streams_in_one_call(monkeypatch):
+    calls = []
+
+    class FakeRunner:
+        def run(self, cmd, kind):
+            calls.append(cmd)
+            # 1000 s at 448 kbit/s and 128 kbit/s
+            return subprocess.CompletedProcess(cmd, 0, f"stream_index=1|duration_time=1000|size={448000 * 1000 // 8}\n"
+                                                       f"stream_index=2|duration_time=1000|size={128000 * 1000 // 8}\n")
+
+    monkeypatch.setattr("audio_bitrate.get_runner", FakeRunner)
+    bitrates = estimate_audio_bitrates("movie.mkv", MediaInfo(PROBE))
+    assert bitrates == {0: 448, 1: 128}
+    assert len(calls) == 1
+    assert "-read_intervals" not in calls[0]
+
+    estimate_audio_bitrates("movie.mkv", MediaInfo(PROBE), SAMPLED, sample_windows=4, window_seconds=10)
+    assert "-read_intervals" in calls[1]
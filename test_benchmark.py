@@ -0,0 +1,24 @@
+from benchmark import compare
+
+
+def result(latency, spawns, fps, size):
+    return {
+        "analysis": {"cold": {"a.mkv": {"latency_s": latency, "ffprobe_spawns": spawns, "ffmpeg_spawns": 1}}},
+        "pipeline": [{"preset": 10, "crf": 30, "fps": fps, "output_bytes": size}],
+    }
+
+
+def test_compare_flags_regressions_beyond_threshold():
+    baseline = result(1.0, 1, 100.0, 1000)
+    assert compare(result(1.05, 1, 95.0, 1050), baseline, 10.0) == []
+
+    regressions = compare(result(2.0, 3, 50.0, 1000), baseline, 10.0)
+    assert len(regressions) == 3
+    assert any("latency" in r for r in regressions)
+    assert any("ffprobe spawns" in r for r in regressions)
+    assert any("fps" in r for r in regressions)
+
+
+def test_compare_ignores_runs_missing_from_baseline():
+    baseline = {"analysis": {"cold": {}}, "pipeline": []}
+    assert compare(result(1.0, 1, 100.0, 1000), baseline, 10.0) == []
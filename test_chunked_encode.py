@@ -0,0 +1,124 @@
+"""Tests for splitting long files into chunks and the chunked encode commands"""
+
+import os
+from pathlib import Path
+
+import file_processor
+from chunked_encode import ChunkedEncoder, chunk_targets, plan_chunks
+from config import Config
+from discovery import DirectoryWalker
+from encode_plan import EncodePlan
+from file_processor import FileProcessor
+from media_probe import file_fingerprint
+from resume import PartialOutputCleaner, is_resumable
+
+
+def test_chunks_start_at_keyframes_and_respect_min_length():
+    assert chunk_targets(7200, 300, 4) == [1800, 3600, 5400]
+    assert chunk_targets(500, 300, 4) == []
+
+    keyframes = [1798.5, 1799.9, 3601.2, 5399.0, 7100.0]
+    chunks = plan_chunks(keyframes, 7200, 300)
+    assert chunks == [(0.0, 1798.5), (1798.5, 3601.2), (3601.2, 5399.0), (5399.0, None)]
+    assert plan_chunks([10.0], 7200, 300) == []
+
+
+def test_long_files_below_the_chunked_duration_are_checkpointed(monkeypatch):
+    monkeypatch.setattr(file_processor, "find_keyframes", lambda filepath, targets: [t - 2.5 for t in targets])
+    config = Config()
+    processor = FileProcessor(Path("movie.mkv"), config)
+
+    chunks, parallel = processor._plan_chunks(3000)
+    assert parallel == 1 and [start for start, _ in chunks] == [0.0, 597.5, 1197.5, 1797.5, 2397.5]
+    chunks, parallel = processor._plan_chunks(7200)
+    assert parallel == config.chunked_parallel_segments and len(chunks) == 16
+    assert processor._plan_chunks(1200) == ([], 1)
+
+    config.checkpoint_min_duration = None
+    assert processor._plan_chunks(3000) == ([], 1)
+
+
+def test_mux_maps_encoded_video_and_source_streams():
+    plan = EncodePlan(
+        Path("movie.mkv"), Path("movie_compressed.mkv"),
+        ["-map", "0:v:0", "-map", "0:s?", "-map_metadata", "0"],
+        ["-c:v", "libsvtav1", "-crf", "26"],
+        ["-map", "0:a:0", "-c:a:0", "libopus", "-b:a:0", "160k"],
+        [], ["-metadata", "video_settings=-c:v libsvtav1 -crf 26"],
+        True, True, chunks=[(0.0, 600.0), (600.0, None)],
+    )
+    encoder = ChunkedEncoder(plan, 2)
+    segment = encoder.segment_command(Path("movie.mkv"), 600.0, None, Path("seg.mkv"))
+    assert segment[:4] == ["ffmpeg", "-y", "-ss", "600.000000"]
+    assert "-t" not in segment and "-an" in segment
+
+    # every segment gets the lp of its share of the plan's budget, not the one of a single encode
+    plan.video_cmd = ["-c:v", "libsvtav1", "-svtav1-params", "tune=2:lp=6:keyint=-2"]
+    plan.threads = 48
+    encoder = ChunkedEncoder(plan, 4)  # 2 chunks, so 2 segments run at once
+    segment = encoder.segment_command(Path("movie.mkv"), 600.0, None, Path("seg.mkv"))
+    assert segment[segment.index("-svtav1-params") + 1] == "tune=2:keyint=-2:lp=6"
+    plan.threads = 24
+    segment = encoder.segment_command(Path("movie.mkv"), 600.0, None, Path("seg.mkv"))
+    assert segment[segment.index("-svtav1-params") + 1] == "tune=2:keyint=-2:lp=4"
+    # a pinned segment runs as many threads as it has CPUs
+    segment = encoder.segment_command(Path("movie.mkv"), 600.0, None, Path("seg.mkv"), cpus=frozenset(range(8)))
+    assert segment[segment.index("-svtav1-params") + 1] == "tune=2:keyint=-2:lp=3"
+
+    mux = encoder.mux_command(Path("movie.mkv"), Path("video.mkv"), Path("out.mkv"))
+    assert mux[mux.index("-map") + 1] == "1:v:0"
+    assert "0:a:0" in mux and "0:s?" in mux
+    assert mux[mux.index("-c:v") + 1] == "copy"
+
+
+def test_interrupted_encode_resumes_missing_chunks(tmp_path, monkeypatch):
+    source = tmp_path / "movie.mkv"
+    source.write_bytes(b"source")
+    plan = EncodePlan(
+        source, tmp_path / "movie_compressed.mkv", ["-map", "0:v:0"], ["-c:v", "libsvtav1"], [], [], [],
+        True, False, duration=900, fingerprint=file_fingerprint(source),
+        chunks=[(0.0, 300.0), (300.0, 600.0), (600.0, None)],
+    )
+    workdir = tmp_path / "movie_compressed.mkv.chunks"
+    encoded = []
+    interrupt = [True]
+
+    def fake_run(self, cmd, name, duration):
+        output = Path(cmd[-1])
+        if output.name.startswith("segment_"):
+            if output.name == "segment_0002.mkv" and interrupt[0]:
+                raise KeyboardInterrupt  # killed while encoding the last chunk
+            encoded.append(output.name)
+        output.write_bytes(b"encoded")
+
+    monkeypatch.setattr(ChunkedEncoder, "_run", fake_run)
+    encoder = ChunkedEncoder(plan, 1)
+    try:
+        encoder.encode(source, plan.output, workdir)
+    except KeyboardInterrupt:
+        pass
+    assert encoded == ["segment_0000.mkv", "segment_0001.mkv"]
+    interrupt[0] = False
+
+    # the first two chunks were finished before the interruption
+    assert is_resumable(workdir)
+    assert PartialOutputCleaner("_compressed", {".mkv"})(tmp_path, os.listdir(tmp_path)) == []
+    ChunkedEncoder(plan, 1).encode(source, plan.output, workdir)
+    assert encoded == ["segment_0000.mkv", "segment_0001.mkv", "segment_0002.mkv"]
+    assert not workdir.exists()
+
+
+def test_stale_partial_outputs_are_removed(tmp_path):
+    source = tmp_path / "show.mp4"
+    source.write_bytes(b"source")
+    partial = tmp_path / "show_compressed.mkv"
+    partial.write_bytes(b"half")
+    orphaned = tmp_path / "sub" / "gone_compressed.mkv.chunks"
+    orphaned.mkdir(parents=True)
+    (orphaned / "segment_0000.mkv").write_bytes(b"x")
+
+    # every directory is cleaned while it is walked, before its files are yielded
+    cleaner = PartialOutputCleaner("_compressed", {".mp4", ".mkv"})
+    assert list(DirectoryWalker(tmp_path, {".mp4", ".mkv"}, clean_dir=cleaner)) == [source]
+    assert cleaner.removed == 2
+    assert source.exists() and not partial.exists() and not orphaned.exists()
@@ -0,0 +1,59 @@
+"""Tests for lease based coordination of several hosts on one tree"""
+
+import multiprocessing
+import os
+import time
+from pathlib import Path
+
+from coordination import LeaseManager
+
+FILES = [f"show/episode_{i:02d}.mkv" for i in range(40)]
+
+
+def _claim_all(root, host_id, result_queue):
+    manager = LeaseManager(Path(root) / ".leases", Path(root), host_id=host_id)
+    claimed = [name for name in FILES if manager.try_acquire(Path(root) / name)]
+    result_queue.put((host_id, claimed))  # leases are kept, like hosts that are still encoding
+
+
+def test_hosts_never_claim_the_same_file(tmp_path):
+    result_queue = multiprocessing.Queue()
+    hosts = [multiprocessing.Process(target=_claim_all, args=(str(tmp_path), f"host{i}", result_queue))
+             for i in range(4)]
+    for host in hosts:
+        host.start()
+    results = [result_queue.get(timeout=30) for _ in hosts]
+    for host in hosts:
+        host.join()
+
+    claimed = [name for _, names in results for name in names]
+    assert sorted(claimed) == sorted(FILES)
+
+
+def test_expired_lease_of_crashed_host_is_reclaimed(tmp_path):
+    movie = tmp_path / "movie.mkv"
+    crashed = LeaseManager(tmp_path / ".leases", tmp_path, host_id="crashed", ttl=60)
+    other = LeaseManager(tmp_path / ".leases", tmp_path, host_id="other", ttl=60)
+    assert crashed.try_acquire(movie)
+    assert not other.try_acquire(movie)
+
+    lease = crashed._lease_path(movie)
+    old = time.time() - 120
+    os.utime(lease, (old, old))
+    assert other.try_acquire(movie)
+    other.release(movie)
+    assert not lease.exists()
+
+
+def test_heartbeat_keeps_lease_alive(tmp_path):
+    movie = tmp_path / "movie.mkv"
+    manager = LeaseManager(tmp_path / ".leases", tmp_path, ttl=60, heartbeat_interval=0.05)
+    manager.try_acquire(movie)
+    lease = manager._lease_path(movie)
+    old = time.time() - 120
+    os.utime(lease, (old, old))
+    manager.start()
+    time.sleep(0.2)
+    assert time.time() - lease.stat().st_mtime < 60
+    manager.stop()
+    assert not lease.exists()
@@ -0,0 +1,23 @@
+"""Tests for crop sampling and aggregation"""
+
+from crop_detect import aggregate_crops, parse_crops, sample_positions
+
+
+def test_samples_follow_duration():
+    assert sample_positions(100, 4) == [20.0, 40.0, 60.0, 80.0]
+    # short clips are still sampled inside the clip
+    assert all(t < 30 for t in sample_positions(30, 6))
+    assert sample_positions(0, 6) == [0.0]
+
+
+def test_aggregate_uses_union_of_picture_areas():
+    output = (
+        "[Parsed_cropdetect_0 @ 0x1] x1:0 x2:1919 y1:140 y2:939 w:1920 h:800 x:0 y:140 crop=1920:800:0:140\n"
+        "[Parsed_cropdetect_0 @ 0x2] x1:0 x2:1919 y1:200 y2:879 w:1920 h:672 x:0 y:204 crop=1920:672:0:204\n"
+        "[Parsed_cropdetect_0 @ 0x3] crop=-1904:-1072:1912:1080\n"
+    )
+    crops = parse_crops(output)
+    assert len(crops) == 2  # the black frame is ignored
+    assert aggregate_crops(crops, 1920, 1080) == "crop=1920:800:0:140"
+    assert aggregate_crops([(1920, 1080, 0, 0)], 1920, 1080) is None
+    assert aggregate_crops([], 1920, 1080) is None
@@ -0,0 +1,60 @@
+"""Tests for hardlink and copy detection"""
+
+import os
+import shutil
+
+from config import Config
+from dedup import Deduplicator
+from file_processor import FileProcessor
+
+
+def test_duplicates_take_the_result_of_the_primary(tmp_path):
+    content = os.urandom(300_000)
+    primary = tmp_path / "show" / "episode.mp4"
+    primary.parent.mkdir()
+    primary.write_bytes(content)
+    hardlink = tmp_path / "hardlink.mp4"
+    os.link(primary, hardlink)
+    copy = tmp_path / "copy.mkv"
+    shutil.copyfile(primary, copy)
+    late_copy = tmp_path / "late.avi"
+    shutil.copyfile(primary, late_copy)
+    other = tmp_path / "other.mp4"
+    other.write_bytes(content[:-1] + b"\0" if content[-1] else content[:-1] + b"\1")  # same size
+
+    config = Config()
+    results = {}
+    dedup = Deduplicator(lambda path, result, error: results.update({path: (result, error)}))
+    claims = {path: dedup.claim(FileProcessor(path, config)) for path in (primary, hardlink, copy, other)}
+    assert claims == {primary: False, hardlink: True, copy: True, other: False}
+
+    # the primary is encoded and replaced like FileProcessor.execute does
+    dedup.seal(primary)
+    encoded = primary.with_suffix(".mkv")
+    encoded.write_bytes(b"encoded")
+    primary.unlink()
+    dedup.finish(primary, encoded, None)
+    # found after the primary was finished, still matched by the hash taken before the encode
+    assert dedup.claim(FileProcessor(late_copy, config))
+    dedup.close()
+
+    assert results[tmp_path / "hardlink.mp4"] == (tmp_path / "hardlink.mkv", None)
+    assert not hardlink.exists()
+    assert os.stat(tmp_path / "hardlink.mkv").st_ino == os.stat(encoded).st_ino
+    assert results[copy] == (copy, None) and copy.read_bytes() == b"encoded"
+    assert os.stat(copy).st_ino != os.stat(encoded).st_ino  # copies stay separate files
+    assert (tmp_path / "late.mkv").read_bytes() == b"encoded" and not late_copy.exists()
+    assert other not in results and dedup.duplicates == 3
+
+
+def test_duplicates_of_a_failed_file_are_not_encoded_again(tmp_path):
+    first, second = tmp_path / "a.mp4", tmp_path / "b.mp4"
+    first.write_bytes(b"video" * 1000)
+    shutil.copyfile(first, second)
+    results = {}
+    dedup = Deduplicator(lambda path, result, error: results.update({path: (result, error)}))
+    assert not dedup.claim(FileProcessor(first, Config()))
+    assert dedup.claim(FileProcessor(second, Config()))
+    dedup.finish(first, None, Exception("broken"))
+    dedup.close()
+    assert results[second][1] is not None and second.exists()
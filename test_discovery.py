@@ -0,0 +1,46 @@
+"""Tests for the streaming directory walker"""
+
+from pathlib import Path
+
+from discovery import DirectoryTracker, DirectoryWalker
+
+VIDEO_EXTS = {".mp4", ".mkv"}
+
+
+def _make_tree(root: Path):
+    for name in ["a.mkv", "notes.txt", "Movies/m1.mp4", "Movies/._m1.mp4", "Movies/Extras/e1.mkv",
+                 "Series/S01/e01.MKV", "Series/S01/e02.mkv", "Series/cover.jpg"]:
+        path = root / name
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(b"")
+
+
+def test_walker_finds_video_files(tmp_path):
+    _make_tree(tmp_path)
+    found = {p.relative_to(tmp_path).as_posix() for p in DirectoryWalker(tmp_path, VIDEO_EXTS)}
+    assert found == {"a.mkv", "Movies/m1.mp4", "Movies/Extras/e1.mkv", "Series/S01/e01.MKV", "Series/S01/e02.mkv"}
+
+    parallel = {p.relative_to(tmp_path).as_posix() for p in DirectoryWalker(tmp_path, VIDEO_EXTS, parallel_walkers=3)}
+    assert parallel == found
+
+
+def test_include_exclude_globs(tmp_path):
+    _make_tree(tmp_path)
+    walker = DirectoryWalker(tmp_path, VIDEO_EXTS, include=["Movies/*"], exclude=["*/Extras"])
+    assert [p.name for p in walker] == ["m1.mp4"]
+
+
+def test_finished_directories_are_pruned(tmp_path):
+    _make_tree(tmp_path)
+    finished = {}
+    tracker = DirectoryTracker(lambda directory, mtime_ns: finished.__setitem__(directory, mtime_ns))
+    files = list(DirectoryWalker(tmp_path, VIDEO_EXTS, on_dir_listed=tracker.dir_listed))
+    for path in files:
+        # one failure keeps Series/S01 unfinished
+        tracker.file_done(path, path.name != "e02.mkv")
+    assert tmp_path / "Movies" in finished
+    assert tmp_path / "Series" / "S01" not in finished
+
+    walker = DirectoryWalker(tmp_path, VIDEO_EXTS,
+                             is_dir_finished=lambda directory, mtime_ns: finished.get(directory) == mtime_ns)
+    assert {p.name for p in walker} == {"e01.MKV", "e02.mkv"}
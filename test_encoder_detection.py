@@ -2,10 +2,43 @@
 """Test script to verify AAC encoder detection works correctly"""
 
 from pathlib import Path
+from capabilities import FFmpegCapabilities, _parse_codec_list
 from config import Config
 from file_processor import FileProcessor
 import tempfile
 
+ENCODERS_OUTPUT = """Encoders:
+ V..... = Video
+ A..... = Audio
+ ------
+ V....D libsvtav1            SVT-AV1(Scalable Video Technology for AV1) encoder (codec av1)
+ A....D aac                  AAC (Advanced Audio Coding)
+ A....D libfdk_aac           Fraunhofer FDK AAC (codec aac)
+ A....D libopus              libopus Opus (codec opus)
+"""
+
+FILTERS_OUTPUT = """Filters:
+  T.. = Timeline support
+  | = Source or sink filter
+ T.C crop              V->V       Crop the input video.
+ T.. cropdetect        V->V       Auto-detect crop size.
+ ..C scale             V->V       Scale the input video size and/or convert the image format.
+"""
+
+
+def test_capability_parsing():
+    """Test parsing of the encoder/filter lists and the requirement check"""
+    encoders = _parse_codec_list(ENCODERS_OUTPUT)
+    filters = _parse_codec_list(FILTERS_OUTPUT)
+    assert encoders == {"libsvtav1", "aac", "libfdk_aac", "libopus"}
+    assert filters == {"crop", "cropdetect", "scale"}
+
+    capabilities = FFmpegCapabilities("/usr/bin/ffmpeg", "7.1", encoders, filters)
+    assert capabilities.missing_requirements() == []
+    capabilities.encoders.discard("libfdk_aac")
+    assert capabilities.missing_requirements() == ["libfdk_aac or aac_at"]
+
+
 def test_encoder_detection():
     """Test the encoder detection functionality"""
     config = Config()
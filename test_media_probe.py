@@ -0,0 +1,52 @@
+"""Tests for the single-pass ffprobe result and its on-disk cache"""
+
+from media_probe import MediaInfo, ProbeCache, file_fingerprint, probe_media
+
+SAMPLE_PROBE = {
+    "streams": [
+        {"index": 0, "codec_type": "video", "codec_name": "h264", "width": 1920, "height": 1080},
+        {"index": 1, "codec_type": "audio", "codec_name": "ac3", "channels": 6, "bit_rate": "448000"},
+        {"index": 2, "codec_type": "audio", "codec_name": "aac", "channels": 2},
+        {"index": 3, "codec_type": "subtitle", "codec_name": "subrip", "tags": {"DISPOSITION_DEFAULT": "1"}},
+        {"index": 4, "codec_type": "video", "codec_name": "mjpeg", "disposition": {"attached_pic": 1}},
+    ],
+    "format": {"duration": "5400.5", "size": "123456", "tags": {"video_settings": "-c:v copy"}},
+}
+
+
+def test_media_info_parsing():
+    info = MediaInfo(SAMPLE_PROBE)
+    assert info.video.codec_name == "h264"
+    assert (info.video.width, info.video.height) == (1920, 1080)
+    assert len(info.video_streams) == 1
+    assert [s.channels for s in info.audio_streams] == [6, 2]
+    assert [s.bit_rate for s in info.audio_streams] == [448000, 0]
+    assert info.subtitle_streams[0].tags["DISPOSITION_DEFAULT"] == "1"
+    assert info.duration == 5400.5
+    assert info.format_tags["video_settings"] == "-c:v copy"
+
+
+def test_probe_cache_hit_and_invalidation(tmp_path, monkeypatch):
+    media = tmp_path / "movie.mkv"
+    media.write_bytes(b"x" * 10)
+    cache = ProbeCache(tmp_path / "cache.sqlite")
+
+    calls = []
+
+    def fake_ffprobe(filepath):
+        calls.append(filepath)
+        return MediaInfo(SAMPLE_PROBE)
+
+    monkeypatch.setattr("media_probe.run_ffprobe", fake_ffprobe)
+
+    probe_media(media, cache)
+    info = probe_media(media, cache)
+    assert len(calls) == 1
+    assert info.video.codec_name == "h264"
+
+    # a changed file must be probed again
+    media.write_bytes(b"x" * 20)
+    assert cache.get(media, file_fingerprint(media)) is None
+    probe_media(media, cache)
+    assert len(calls) == 2
+    cache.close()
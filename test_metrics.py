@@ -0,0 +1,46 @@
+"""Tests for the per-file metrics report"""
+
+import json
+import time
+
+from metrics import FileMetrics, MetricsReport
+
+
+def test_report_records_and_summary(tmp_path):
+    report = MetricsReport(tmp_path / "run.jsonl")
+
+    encoded = FileMetrics(tmp_path / "movie.mp4")
+    with encoded.stage("probe"):
+        time.sleep(0.01)
+    encoded.add_stage("encode", 1800.0)
+    encoded.add_child_cpu("encode", 20000.0)
+    encoded.set(outcome="encoded", input_size=4_000_000_000, output_size=1_500_000_000, duration=3600.0)
+    report.write(encoded)
+
+    untouched = FileMetrics(tmp_path / "clip.mkv")
+    untouched.set(outcome="untouched", input_size=100, output_size=100, duration=60.0)
+    report.write(untouched)
+
+    lines = (tmp_path / "run.jsonl").read_text().splitlines()
+    record = json.loads(lines[0])
+    assert len(lines) == 2
+    assert record["saved_bytes"] == 2_500_000_000
+    assert record["saved_percent"] == 62.5
+    assert record["encode_speed"] == 2.0
+    assert record["stages"]["encode"]["child_cpu_s"] == 20000.0
+    assert record["stages"]["probe"]["wall_s"] >= 0.01
+
+    summary = report.summary()
+    assert "encoded 1, saved 2.50 GB" in summary
+    stage_lines = summary.splitlines()[3:]
+    assert [line.split()[0] for line in stage_lines] == ["encode", "probe"]  # slowest stage first
+    report.close()
+
+
+def test_summary_of_stages_that_took_no_time(tmp_path):
+    report = MetricsReport(tmp_path / "run.jsonl")
+    metrics = FileMetrics(tmp_path / "movie.mkv")
+    metrics.add_stage("replace", 0.0)
+    report.write(metrics)
+    assert f"slowest 0.0s ({tmp_path / 'movie.mkv'})" in report.summary()
+    report.close()
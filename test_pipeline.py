@@ -0,0 +1,227 @@
+"""Tests for the two-stage analysis/encode pipeline"""
+
+import sys
+import threading
+import time
+from pathlib import Path
+
+import process_runner
+from config import Config
+from encode_plan import EncodePlan
+from file_processor import FileProcessor
+from pipeline import Pipeline
+from process_runner import ProcessRunner
+from state_store import StateStore
+from job_order import estimate_cost, makespan_by_policy
+from scheduler import (LP_LEVEL_THREADS, CpuAllocator, EncodeScheduler, format_cpulist, numa_nodes, parse_cpulist,
+                       split_cpus, thread_budget)
+
+
+class FakeProcessor:
+    def __init__(self, name, needs_encode, log):
+        self.filepath = Path(name)
+        self.needs_encode = needs_encode
+        self.log = log
+
+    def analyze(self):
+        time.sleep(0.01)
+        if not self.needs_encode:
+            return None
+        return EncodePlan(self.filepath, self.filepath.with_suffix(".tmp.mkv"), [], ["-c:v", "copy"], [], [], [],
+                          False, True, duration=60)
+
+    def execute(self, plan):
+        self.log.append((threading.current_thread().name, plan))
+        if self.filepath.name == "broken.mkv":
+            raise Exception("ffmpeg failed")
+        return self.filepath.with_suffix(".mkv")
+
+
+def test_only_plans_reach_the_encode_stage():
+    config = Config()
+    config.encode_scheduler = "fixed"
+    config.max_parallel_encodes = 2
+    config.max_parallel_analyses = 4
+    config.encode_queue_size = 1
+
+    encoded = []
+    results = {}
+    processors = [FakeProcessor(f"{i}.mp4", i % 2 == 0, encoded) for i in range(10)]
+    processors.append(FakeProcessor("broken.mkv", True, encoded))
+
+    def on_result(filepath, result, error, cost):
+        results[filepath] = error or result
+
+    Pipeline(config, on_result=on_result).run(processors)
+
+    assert len(results) == 11
+    assert len(encoded) == 6
+    assert all(name.startswith("encode-") for name, _ in encoded)
+    assert all(isinstance(plan, EncodePlan) for _, plan in encoded)
+    assert results[Path("1.mp4")] == Path("1.mp4")
+    assert results[Path("2.mp4")] == Path("2.mkv")
+    assert isinstance(results[Path("broken.mkv")], Exception)
+
+
+def test_scheduler_admits_jobs_within_cpu_budget():
+    scheduler = EncodeScheduler(16)
+    scheduler.acquire(8)
+    scheduler.acquire(8)
+    admitted = threading.Event()
+
+    def third_job():
+        scheduler.acquire(2)
+        admitted.set()
+
+    threading.Thread(target=third_job, daemon=True).start()
+    assert not admitted.wait(0.05)
+    scheduler.release(8)
+    assert admitted.wait(1)
+    assert scheduler.running == 2
+
+
+def test_thread_budget_follows_resolution():
+    dvd_threads, _ = thread_budget(720, 576, 2, 48)
+    hd_threads, hd_level = thread_budget(1920, 1080, 2, 48)
+    uhd_threads, _ = thread_budget(3840, 2160, 2, 48)
+    assert dvd_threads < hd_threads
+    assert uhd_threads == hd_threads  # 4K is scaled to 1080p
+    assert LP_LEVEL_THREADS[hd_level] == hd_threads
+    assert thread_budget(1920, 1080, 2, 4) == (4, 2)  # the level of the 4 threads, not of the 16 wanted
+
+
+def _plan(name, hours, width=1920, height=1080, codec="h264"):
+    return EncodePlan(Path(name), Path(name + ".out"), [], ["-c:v", "libsvtav1"], [], [], [], True, False,
+                      duration=hours * 3600, width=width, height=height, source_codec=codec, threads=1)
+
+
+def test_longest_first_minimizes_makespan():
+    plans = [_plan("a", 1), _plan("b", 1), _plan("c", 1), _plan("z", 3)]
+    makespans = makespan_by_policy(plans, 2)
+    # the long file found last leaves one slot alone for hours when encoded by path
+    assert makespans["path"] == 4
+    assert makespans["longest"] == 3
+    # fixed slots: every job takes one slot, the plans keep their own budgets
+    for plan in plans:
+        plan.threads = 8
+    assert makespan_by_policy(plans, 2, job_threads=1) == makespans
+    assert all(plan.threads == 8 for plan in plans)
+    assert estimate_cost(_plan("uhd", 1, 3840, 2160, "hevc")) == 1.3
+
+
+def test_encodes_start_in_queue_order():
+    config = Config()
+    config.encode_cpus = 16
+    config.pin_encode_cpus = False
+    config.encode_order = "longest"
+    hours = [98, 84, 61, 58, 49, 33, 16, 64, 9, 98, 18, 73]
+    config.encode_queue_size = len(hours)
+    started = []
+
+    class OrderedProcessor(FakeProcessor):
+        def execute(self, plan):
+            started.append(plan.duration / 3600)
+            time.sleep(0.3 if len(started) == 1 else 0.01)  # the others are queued meanwhile
+            return self.filepath
+
+    planned = []
+    for i, duration in enumerate(hours):
+        plan = _plan(f"{i}.mkv", duration)
+        plan.threads = 16  # one encode at a time
+        planned.append((OrderedProcessor(plan.source, True, []), plan))
+    Pipeline(config).run_plans(planned)
+
+    assert started == [hours[0]] + sorted(hours[1:], reverse=True)
+
+
+def test_cpu_sets_are_disjoint_and_numa_aligned(tmp_path):
+    assert parse_cpulist("0-3,8,10-11\n") == {0, 1, 2, 3, 8, 10, 11}
+    assert format_cpulist({0, 1, 2, 3, 8, 10, 11}) == "0-3,8,10-11"
+    for node, cpulist in enumerate(["0-23", "24-47"]):
+        (tmp_path / f"node{node}").mkdir()
+        (tmp_path / f"node{node}" / "cpulist").write_text(cpulist)
+    nodes = numa_nodes(allowed=set(range(4, 48)), node_dir=tmp_path)
+    assert nodes == [frozenset(range(4, 24)), frozenset(range(24, 48))]
+
+    scheduler = EncodeScheduler(44, CpuAllocator(nodes))
+    first = scheduler.acquire(16)
+    second = scheduler.acquire(16)
+    third = scheduler.acquire(8)
+    assert len(first) == 16 and len(second) == 16 and len(third) == 8
+    assert not first & second and not second & third and not first & third
+    # every set fits one node
+    assert all(any(cpus <= node for node in nodes) for cpus in (first, second, third))
+
+    scheduler.release(16, first)
+    assert scheduler.acquire(16) == first
+
+    assert split_cpus(frozenset(range(8)), 3) == [frozenset({0, 1, 2}), frozenset({3, 4, 5}), frozenset({6, 7})]
+
+
+def test_stop_ends_the_run_without_waiting_for_the_queue():
+    config = Config()
+    config.encode_scheduler = "fixed"
+    config.max_parallel_encodes = 1
+    config.max_parallel_analyses = 2
+    config.encode_queue_size = 1
+
+    started, killed = threading.Event(), threading.Event()
+
+    class KilledProcessor(FakeProcessor):
+        def execute(self, plan):
+            self.log.append(plan)
+            started.set()
+            killed.wait(5)  # the running ffmpeg, killed by shutdown_runner
+            raise Exception("ffmpeg killed")
+
+    encoded, results = [], {}
+    processors = [KilledProcessor(f"{i}.mp4", True, encoded) for i in range(200)]
+    pipeline = Pipeline(config, on_result=lambda filepath, result, error, cost: results.update({filepath: error}))
+    runner = threading.Thread(target=pipeline.run, args=(processors,))
+    runner.start()
+    assert started.wait(5)
+    pipeline.gate.set_limit(0)  # e.g. paused from the control file
+    pipeline.stop()
+    killed.set()
+    runner.join(5)
+
+    assert not runner.is_alive()
+    # only the interrupted encode ran, and it is not reported as failed
+    assert len(encoded) == 1
+    assert results == {}
+
+
+def test_files_interrupted_by_a_stop_are_processed_again(tmp_path, monkeypatch):
+    runner = ProcessRunner()
+    monkeypatch.setattr(process_runner, "_runner", runner)
+    started = threading.Event()
+
+    def encode(self, plan, input_path=None, output_path=None):
+        started.set()
+        runner.stream([sys.executable, "-c", "import time; time.sleep(30)"])  # the ffmpeg killed by the stop
+
+    monkeypatch.setattr(FileProcessor, "_execute_compression", encode)
+    config = Config()
+    config.encode_scheduler = "fixed"
+    source = tmp_path / "movie.mp4"
+    source.write_bytes(b"video")
+    state_store = StateStore(tmp_path / "state.sqlite")
+    processor = FileProcessor(source, config, state_store=state_store)
+    plan = EncodePlan(source, tmp_path / "movie_compressed.mkv", [], ["-c:v", "libsvtav1"], [], [], [],
+                      True, False, duration=60)
+
+    results = {}
+    pipeline = Pipeline(config, on_result=lambda filepath, result, error, cost: results.update({filepath: error}))
+    thread = threading.Thread(target=pipeline.run_plans, args=([(processor, plan)],))
+    thread.start()
+    assert started.wait(5)
+    time.sleep(0.2)
+    # what main.stop_on_signals does on SIGTERM
+    pipeline.stop()
+    runner.shutdown()
+    thread.join(10)
+
+    assert not thread.is_alive() and results == {}
+    assert state_store.lookup(source) is None
+    assert not FileProcessor(source, config, state_store=state_store).should_skip()
+    state_store.close()
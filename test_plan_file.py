@@ -0,0 +1,99 @@
+"""Tests for writing and executing plan files"""
+
+from pathlib import Path
+
+import file_processor
+from chunked_encode import ChunkedEncoder
+from config import Config
+from encode_plan import EncodePlan
+from file_processor import FileProcessor
+from media_probe import file_fingerprint
+from pipeline import Pipeline
+from plan_file import (TRANSCODE, UNTOUCHED, plan_entry, plan_is_current, read_plan_file, select_plans,
+                       write_plan_file)
+
+
+def make_plan(source, chunks=None):
+    return EncodePlan(
+        source, source.with_name(source.stem + "_compressed.mkv"),
+        ["-map", "0:v:0", "-map", "0:s?", "-map_metadata", "0"], ["-c:v", "libsvtav1", "-crf", "26"],
+        ["-map", "0:a:0", "-c:a:0", "libopus", "-b:a:0", "160k", "-map", "0:a:1", "-c:a:1", "copy"],
+        [], [], True, True, duration=3600, width=1920, height=1080, source_codec="h264",
+        fingerprint=file_fingerprint(source), chunks=chunks,
+    )
+
+
+def test_plan_file_round_trip(tmp_path, monkeypatch):
+    sources = []
+    for name in ("b.mkv", "a.mp4", "c.mkv"):
+        path = tmp_path / name
+        path.write_bytes(b"video")
+        sources.append(path)
+    plans = [make_plan(sources[0]), make_plan(sources[1], chunks=[(0.0, 1800.0), (1800.0, None)])]
+
+    entries = [plan_entry(plan, {"input_size": 5, "predicted_saving_percent": 40.0}) for plan in plans]
+    entries.append({"path": str(sources[2]), "decision": UNTOUCHED})
+    assert entries[0]["audio"] == ["libopus", "copy"]
+    assert len(entries[1]["commands"]) == 4  # two segments, concat, mux
+    write_plan_file(tmp_path / "plan.json", entries, "abc")
+
+    settings, loaded = read_plan_file(tmp_path / "plan.json")
+    assert settings == "abc"
+    assert [plan.source for plan in loaded] == [sources[1], sources[0]]
+    assert loaded[0].chunks == [(0.0, 1800.0), (1800.0, None)]
+    assert loaded[1].build_command() == plans[0].build_command()
+    assert all(entry["decision"] in (TRANSCODE, UNTOUCHED) for entry in entries)
+
+    # the plan file shows the commands the encode of the plan runs
+    plans[1].video_cmd = ["-c:v", "libsvtav1", "-svtav1-params", "tune=2:lp=6"]
+    plans[1].threads, plans[1].parallel_segments = 24, 2
+    executed = []
+
+    def fake_run(self, cmd, name, duration):
+        executed.append(cmd)
+        Path(cmd[-1]).write_bytes(b"encoded")
+
+    monkeypatch.setattr(ChunkedEncoder, "_run", fake_run)
+    monkeypatch.setattr(file_processor, "run_ffmpeg", lambda cmd, *args, **kwargs: executed.append(cmd))
+    for plan in plans:
+        executed.clear()
+        FileProcessor(plan.source, Config())._execute_compression(plan)
+        assert sorted(executed) == sorted(plan_entry(plan)["commands"])
+    assert "lp=4" in " ".join(plan_entry(plans[1])["commands"][0])
+
+    assert select_plans(loaded, ["*.mkv"]) == [loaded[1]]
+    assert select_plans(loaded, limit=1) == [loaded[0]]
+
+    assert plan_is_current(loaded[1])
+    sources[0].write_bytes(b"replaced by another run")
+    assert not plan_is_current(loaded[1])
+
+
+class PlannedProcessor:
+    def __init__(self, plan, encoded):
+        self.filepath = plan.source
+        self.encoded = encoded
+
+    def analyze(self):
+        raise AssertionError("plans from a plan file are not analyzed again")
+
+    def execute(self, plan):
+        self.encoded.append(plan.source)
+        return plan.output
+
+
+def test_run_plans_encodes_without_analysis(tmp_path):
+    config = Config()
+    config.encode_scheduler = "fixed"
+    config.max_parallel_encodes = 1
+    plans = []
+    for name in ("a.mkv", "b.mkv", "c.mkv"):
+        (tmp_path / name).write_bytes(b"video")
+        plans.append(make_plan(tmp_path / name))
+
+    encoded, results = [], {}
+    pipeline = Pipeline(config, on_result=lambda path, result, error, cost: results.update({path: result}))
+    pipeline.run_plans((PlannedProcessor(plan, encoded), plan) for plan in plans)
+
+    assert sorted(encoded) == [plan.source for plan in plans]
+    assert results[plans[0].source] == plans[0].output
@@ -0,0 +1,101 @@
+"""Tests for the asyncio process runner"""
+
+import os
+import subprocess
+import sys
+import threading
+import time
+
+import pytest
+
+from metrics import FileMetrics
+from process_runner import ANALYSIS, PROBE, ProcessRunner
+
+SLEEP = [sys.executable, "-c", "import time; time.sleep(30)"]
+
+
+def test_output_errors_and_stats():
+    runner = ProcessRunner()
+    try:
+        completed = runner.run([sys.executable, "-c", "print('out'); import sys; print('err', file=sys.stderr)"])
+        assert completed.stdout == "out\n" and completed.stderr == "err\n"
+        with pytest.raises(subprocess.CalledProcessError) as info:
+            runner.run([sys.executable, "-c", "import sys; print('broken', file=sys.stderr); sys.exit(3)"])
+        assert info.value.returncode == 3 and info.value.stderr == "broken\n"
+
+        lines = []
+        returncode = runner.stream([sys.executable, "-c", "print('a'); print('b')"], ANALYSIS, lines.append)
+        assert returncode == 0 and lines == ["a\n", "b\n"]
+
+        stats = runner.stats()
+        assert stats[PROBE]["spawns"] == 2 and stats[PROBE]["failed"] == 1
+        assert stats[ANALYSIS]["spawns"] == 1
+    finally:
+        runner.shutdown()
+
+
+@pytest.mark.skipif(not hasattr(os, "wait4"), reason="needs os.wait4")
+def test_child_cpu_is_added_to_the_current_stage():
+    runner = ProcessRunner()
+    metrics = FileMetrics("movie.mkv")
+    # the CPU time of a grandchild the process waited for counts too
+    burn = "import time; end = time.process_time() + 0.3\nwhile time.process_time() < end: pass"
+    try:
+        with metrics.stage("cropdetect"):
+            parent = f"import subprocess, sys; subprocess.run([sys.executable, '-c', {burn!r}])"
+            runner.run([sys.executable, "-c", parent])
+        runner.run([sys.executable, "-c", burn])  # outside of any stage
+    finally:
+        runner.shutdown()
+    assert metrics.stages["cropdetect"]["child_cpu_s"] >= 0.3
+    assert metrics.stages["cropdetect"]["cpu_s"] < 0.3
+    assert list(metrics.stages) == ["cropdetect"]
+
+
+def test_timeout_kills_the_process():
+    runner = ProcessRunner(timeouts={PROBE: 0.5})
+    try:
+        started = time.monotonic()
+        with pytest.raises(subprocess.TimeoutExpired):
+            runner.run(SLEEP)
+        assert time.monotonic() - started < 10
+        assert runner.stats()[PROBE]["timeouts"] == 1
+    finally:
+        runner.shutdown()
+
+
+def test_probes_are_limited_by_their_semaphore():
+    runner = ProcessRunner(limits={PROBE: 2})
+    script = [sys.executable, "-c", "import time; print(time.monotonic()); time.sleep(0.3)"]
+    starts = []
+    threads = [threading.Thread(target=lambda: starts.append(float(runner.run(script).stdout))) for _ in range(4)]
+    try:
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        runner.shutdown()
+    starts.sort()
+    # the third probe only starts once one of the first two finished
+    assert starts[2] - starts[0] >= 0.25
+
+
+def test_shutdown_kills_running_processes():
+    runner = ProcessRunner()
+    errors = []
+
+    def run():
+        try:
+            runner.stream(SLEEP)
+        except BaseException as e:
+            errors.append(e)
+
+    thread = threading.Thread(target=run)
+    thread.start()
+    time.sleep(0.5)
+    started = time.monotonic()
+    runner.shutdown()
+    thread.join(timeout=10)
+    assert not thread.is_alive() and time.monotonic() - started < 10
+    assert len(errors) == 1
@@ -0,0 +1,56 @@
+"""Tests for streaming ffmpeg progress parsing"""
+
+import subprocess
+import sys
+
+import pytest
+
+from progress import EncodeMonitor, _with_progress_output, run_ffmpeg
+
+# prints two -progress blocks on stdout and a lot of stderr, like ffmpeg does
+FAKE_FFMPEG = """
+import sys
+for i in range(1000):
+    print(f"stderr line {i}", file=sys.stderr)
+print("frame=240\\nfps=24.0\\nbitrate=1500.0kbits/s\\nout_time_us=10000000\\nspeed=0.5x\\nprogress=continue", flush=True)
+print("frame=480\\nfps=30.0\\nbitrate=1400.0kbits/s\\nout_time_us=20000000\\nspeed=1.0x\\nprogress=end", flush=True)
+sys.exit(int(sys.argv[1]))
+"""
+
+
+class RecordingListener:
+    def __init__(self):
+        self.events = []
+
+    def on_start(self, state):
+        self.events.append(("start", state.name))
+
+    def on_update(self, state):
+        self.events.append(("update", state.frame, state.fps, state.out_time, state.speed, state.eta))
+
+    def on_finish(self, state):
+        self.events.append(("finish", state.name))
+
+
+def test_progress_blocks_are_reported_while_running():
+    listener = RecordingListener()
+    monitor = EncodeMonitor(listener)
+    run_ffmpeg([sys.executable, "-c", FAKE_FFMPEG, "0"], monitor, name="movie.mkv", duration=40)
+    assert listener.events == [
+        ("start", "movie.mkv"),
+        ("update", 240, 24.0, 10.0, 0.5, 60.0),
+        ("update", 480, 30.0, 20.0, 1.0, 20.0),
+        ("finish", "movie.mkv"),
+    ]
+    assert monitor.total_fps() == 0
+
+
+def test_failure_keeps_only_the_stderr_tail():
+    with pytest.raises(subprocess.CalledProcessError) as info:
+        run_ffmpeg([sys.executable, "-c", FAKE_FFMPEG, "1"], stderr_lines=5)
+    assert info.value.stderr.splitlines() == [f"stderr line {i}" for i in range(995, 1000)]
+
+
+def test_progress_option_is_added_after_the_binary():
+    cmd = ["nice", "-n", "19", "ffmpeg", "-y", "-i", "in.mkv", "out.mkv"]
+    assert _with_progress_output(cmd)[:6] == ["nice", "-n", "19", "ffmpeg", "-progress", "pipe:1"]
@@ -0,0 +1,178 @@
+"""Tests for the runtime encode limit, pausing and throttling"""
+
+import datetime
+import os
+import sys
+import threading
+import time
+
+import pytest
+
+import runtime_control
+from process_runner import ENCODE, ProcessRunner
+from runtime_control import EncodeGate, RuntimeController, ThrottlePolicy, current_job, write_control
+from scheduler import CpuAllocator, EncodeScheduler
+
+
+def _state(pid):
+    with open(f"/proc/{pid}/stat") as f:
+        return f.read().rsplit(")", 1)[1].split()[0]
+
+
+def _wait_for(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.02)
+
+
+def test_lowering_the_limit_pauses_the_newest_encodes():
+    gate = EncodeGate(2)
+    first, second = gate.enter("first"), gate.enter("second")
+    gate.set_limit(1)
+    assert not first.paused and second.paused
+
+    # paused encodes are resumed before a new one may start
+    entered = []
+    waiting = threading.Thread(target=lambda: entered.append(gate.enter("third")))
+    waiting.start()
+    gate.leave(first)
+    assert not second.paused
+    time.sleep(0.1)
+    assert not entered
+    gate.leave(second)
+    waiting.join(timeout=5)
+    assert entered and gate.status()["running"] == ["third"]
+
+
+def test_paused_encodes_give_their_cpus_back(monkeypatch):
+    signals = []
+    monkeypatch.setattr(runtime_control, "_signal_group", lambda pid, sig: signals.append((pid, sig)))
+    scheduler = EncodeScheduler(16)
+    gate = EncodeGate(None, on_pause=lambda job: scheduler.suspend(job.threads),
+                      on_resume=lambda job: scheduler.unsuspend(job.threads))
+
+    def start(name, threads):
+        # like Pipeline._encode_worker: the gate is entered once the scheduler admitted the encode
+        scheduler.acquire(threads)
+        job = gate.enter(name, threads)
+        job.add_process(threads)
+        return job
+
+    def finish(job):
+        gate.leave(job)
+        scheduler.release(job.threads)
+
+    first = start("first", 8)
+    started = []
+    big = threading.Thread(target=lambda: started.append(start("big", 16)), daemon=True)
+    big.start()
+    _wait_for(lambda: big.is_alive())
+    last = start("last", 8)
+
+    # the big encode waits for CPUs outside the gate, so it is never resumed while a paused one holds them
+    gate.set_limit(1)
+    assert last.paused and signals
+    assert gate.status()["running"] == ["first"]
+    finish(first)
+    assert not last.paused
+    finish(last)
+    big.join(timeout=5)
+    assert started and gate.status()["running"] == ["big"]
+
+
+def test_paused_encodes_give_their_pinned_cpus_back(monkeypatch):
+    monkeypatch.setattr(runtime_control, "_signal_group", lambda pid, sig: None)
+    moved = {}
+    monkeypatch.setattr(runtime_control, "_set_affinity", lambda pid, cpus: moved.update({pid: cpus}))
+    scheduler = EncodeScheduler(16, CpuAllocator([range(16)]))
+    # wired like in Pipeline
+    gate = EncodeGate(None, on_pause=lambda job: scheduler.suspend(job.threads, job.cpus),
+                      on_resume=lambda job: job.set_cpus(scheduler.unsuspend(job.threads, job.cpus)),
+                      on_leave=lambda job: scheduler.release_cpus(job.cpus))
+    first = gate.enter("first", 8, scheduler.acquire(8))
+    second = gate.enter("second", 8, scheduler.acquire(8))
+    second.add_process(2)
+    gate.set_limit(1)
+    assert second.paused
+    # the next encode gets the CPUs of the paused one, not a partial set
+    third_cpus = scheduler.acquire(8)
+    assert third_cpus == second.cpus and len(third_cpus) == 8
+
+    gate.leave(first)
+    scheduler.release(8)
+    # resumed on the CPUs of the job that left, its processes are moved there
+    assert not second.paused
+    assert second.cpus == first.cpus and not second.cpus & third_cpus
+    assert moved == {2: first.cpus}
+
+
+def test_encodes_without_processes_are_paused_last(monkeypatch):
+    monkeypatch.setattr(runtime_control, "_signal_group", lambda pid, sig: None)
+    gate = EncodeGate()
+    older, newer = gate.enter("older"), gate.enter("newer")
+    older.add_process(1)
+    gate.set_limit(1)
+    assert older.paused and not newer.paused
+
+
+@pytest.mark.skipif(not os.path.isdir("/proc"), reason="needs /proc")
+def test_paused_jobs_stop_their_processes():
+    runner = ProcessRunner()
+    gate = EncodeGate()
+    job = gate.enter("movie.mkv")
+    pids = []
+
+    def encode():
+        current_job.set(job)
+        try:
+            runner.stream([sys.executable, "-c", "import time; time.sleep(30)"], ENCODE, on_start=pids.append)
+        except Exception:
+            pass  # cancelled by the shutdown at the end of the test
+
+    try:
+        threading.Thread(target=encode, daemon=True).start()
+        _wait_for(lambda: pids)
+        gate.set_limit(0)
+        _wait_for(lambda: _state(pids[0]) == "T")
+        gate.set_limit(None)
+        _wait_for(lambda: _state(pids[0]) != "T")
+    finally:
+        runner.shutdown()
+
+
+def test_throttle_steps_down_under_pressure_and_back_up(monkeypatch):
+    policy = ThrottlePolicy(8, min_available_memory_percent=10)
+    status = {"running": ["a", "b", "c"], "paused": [], "running_threads": 6}
+    monkeypatch.setattr(runtime_control, "_memory_available_percent", lambda: 5.0)
+    assert policy.evaluate(status)[0] == 2
+    status = {"running": ["a", "b"], "paused": ["c"], "running_threads": 4}
+    assert policy.evaluate(status)[0] == 1
+
+    monkeypatch.setattr(runtime_control, "_memory_available_percent", lambda: 50.0)
+    status = {"running": ["a"], "paused": ["b", "c"], "running_threads": 2}
+    assert policy.evaluate(status) == (2, "")
+    assert policy.evaluate(status)[0] == 3
+    assert policy.evaluate(status)[0] is None
+
+
+def test_schedule_windows_over_midnight():
+    policy = ThrottlePolicy(8, schedule=[("22:00", "06:00", 1)])
+    status = {"running": [], "paused": [], "running_threads": 0}
+    assert policy.evaluate(status, datetime.datetime(2024, 1, 1, 23, 30))[0] == 1
+    assert policy.evaluate(status, datetime.datetime(2024, 1, 1, 5, 0))[0] == 1
+    assert policy.evaluate(status, datetime.datetime(2024, 1, 1, 12, 0))[0] is None
+
+
+def test_control_file(tmp_path):
+    gate = EncodeGate(2)
+    controller = RuntimeController(gate, tmp_path / "control.json")
+    write_control(tmp_path / "control.json", max_encodes=4)
+    controller.apply()
+    assert gate.limit == 4
+    write_control(tmp_path / "control.json", paused=True)
+    controller.apply()
+    assert gate.limit == 0 and (tmp_path / "status.json").exists()
+    write_control(tmp_path / "control.json", paused=False, max_encodes=None)
+    controller.apply()
+    assert gate.limit == 2
@@ -0,0 +1,30 @@
+"""Runs the scale harness on a small tree with the fake ffmpeg/ffprobe"""
+
+import os
+import shutil
+
+import pytest
+
+from scale_harness import harness_config, make_tree, run_pipeline, write_fake_tools
+
+
+@pytest.mark.skipif(os.name != "posix" or not shutil.which("nice"), reason="needs executable scripts and nice")
+def test_pipeline_over_placeholder_files(tmp_path, monkeypatch):
+    write_fake_tools(tmp_path / "bin")
+    monkeypatch.setenv("PATH", str(tmp_path / "bin") + os.pathsep + os.environ.get("PATH", ""))
+    make_tree(tmp_path / "tree", files=12, files_per_dir=5)
+    config = harness_config(tmp_path / "tree", tmp_path / "cache")
+    config.encode_cpus = 16
+    config.pin_encode_cpus = False
+    config.coordination_enabled = True
+
+    results = run_pipeline(config, tmp_path)
+
+    assert results["files"] == 12 and results["failed"] == 0 and results["duplicates"] == 0
+    # probe, cropdetect, audio packet read, keyframe lookup, three checkpointed segments, concat and mux
+    # per file, plus the capability detection
+    assert 9 <= results["spawns_per_file"] <= 9 + 3 / 12
+    assert results["scheduler_idle_percent"] is not None
+    assert sorted(p.suffix for p in (tmp_path / "tree").rglob("*.*")) == [".mkv"] * 12
+    assert results["peak_rss_mb"] > 0
+    assert not list((tmp_path / "cache" / "leases").rglob("*.lease"))  # every lease was released
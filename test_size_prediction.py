@@ -0,0 +1,62 @@
+import subprocess
+
+import size_prediction
+from config import Config
+from media_probe import MediaInfo, ProbeCache
+from size_prediction import SizePrediction, SizePredictor, sample_windows
+from test_media_probe import SAMPLE_PROBE
+
+
+def test_sample_windows():
+    assert sample_windows(30, 4, 10) == [(0.0, 30)]
+    windows = sample_windows(1000, 4, 10)
+    assert [start for start, _ in windows] == [195.0, 395.0, 595.0, 795.0]
+    assert all(seconds == 10 for _, seconds in windows)
+
+
+def test_prediction_extrapolates_size_and_time():
+    prediction = SizePrediction(sampled_seconds=40, source_bytes=4000, encoded_bytes=1000, encode_seconds=20)
+    assert prediction.saving_percent == 75
+    assert prediction.predicted_video_bytes(400) == 10000
+    assert prediction.predicted_encode_seconds(400) == 200
+    assert SizePrediction.from_json(prediction.to_json()).__dict__ == prediction.__dict__
+
+
+def test_cached_prediction_skips_sampling(tmp_path, monkeypatch):
+    video = tmp_path / "movie.mkv"
+    video.write_bytes(b"data")
+    cache = ProbeCache(tmp_path / "cache.sqlite")
+    predictor = SizePredictor(video, Config(), MediaInfo(SAMPLE_PROBE), ["-c:v", "libsvtav1"], cache)
+    calls = []
+    monkeypatch.setattr(predictor, "_encode_samples", lambda: calls.append(1) or SizePrediction(10, 100, 75, 5))
+
+    assert predictor.predict().saving_percent == 25
+    assert predictor.predict().saving_percent == 25
+    assert len(calls) == 1
+
+    # different video settings are sampled again
+    other = SizePredictor(video, Config(), MediaInfo(SAMPLE_PROBE), ["-c:v", "libx265"], cache)
+    monkeypatch.setattr(other, "_encode_samples", lambda: calls.append(1) or SizePrediction(10, 100, 50, 5))
+    assert other.predict().saving_percent == 50
+    assert len(calls) == 2
+    cache.close()
+
+
+def test_source_bytes_cover_only_the_windows(tmp_path, monkeypatch):
+    # ffprobe starts each interval at the keyframe before it
+    packets = "95.0,5000\n99.9,100\n100.0,200\n109.9,300\n110.0,400\n300.0,50\n"
+
+    class FakeRunner:
+        def run(self, cmd, kind):
+            assert cmd[cmd.index("-read_intervals") + 1] == "100.000%+10.000,300.000%+10.000"
+            return subprocess.CompletedProcess(cmd, 0, packets, "")
+
+    monkeypatch.setattr(size_prediction, "get_runner", lambda: FakeRunner())
+    predictor = SizePredictor(tmp_path / "movie.mkv", Config(), MediaInfo(SAMPLE_PROBE),
+                              ["-c:v", "libsvtav1", "-svtav1-params", "tune=2:lp=6"])
+    assert predictor._source_bytes([(100.0, 10.0), (300.0, 10.0)]) == 550
+
+    # the samples run single-threaded next to the scheduled encodes
+    cmd = predictor.sample_command(100.0, 10.0, tmp_path / "sample.mkv")
+    assert cmd[cmd.index("-svtav1-params") + 1] == "tune=2:lp=1"
+    assert cmd[cmd.index("-threads") + 1] == "1" and "-c:v" in cmd and "copy" not in cmd
@@ -0,0 +1,112 @@
+"""Tests for scratch staging of inputs and background write-back"""
+
+from pathlib import Path
+
+import pytest
+
+from chunked_encode import ChunkedEncoder
+from config import Config
+from encode_plan import EncodePlan
+from file_processor import FileProcessor
+from media_probe import file_fingerprint
+from pipeline import Pipeline
+from resume import is_resumable
+from staging import ScratchStaging
+
+
+def test_prefetch_respects_budget(tmp_path):
+    sources = []
+    for name in ("a.mkv", "b.mkv"):
+        path = tmp_path / name
+        path.write_bytes(b"x" * 1000)
+        sources.append(path)
+    staging = ScratchStaging(tmp_path / "scratch", budget_bytes=3000, prefetch_count=2)
+
+    assert staging.prefetch(sources[0])
+    assert not staging.prefetch(sources[1])  # two files need 4000 bytes
+    staged = staging.staged_input(sources[0])
+    assert staged.read_bytes() == sources[0].read_bytes()
+    assert staging.staged_input(sources[1]) is None
+
+    staging.write_back(sources[0], lambda: "done").result()
+    assert not staged.exists()
+    assert staging.prefetch(sources[1])  # the reservation was freed
+    staging.close()
+    assert list((tmp_path / "scratch").iterdir()) == []
+
+
+class StagedProcessor:
+    def __init__(self, filepath, staging):
+        self.filepath = filepath
+        self.staging = staging
+
+    def analyze(self):
+        return EncodePlan(self.filepath, self.filepath.with_suffix(".tmp.mkv"), [], ["-c:v", "copy"], [], [], [],
+                          False, True, duration=60)
+
+    def execute(self, plan):
+        staged = self.staging.staged_input(self.filepath) or self.filepath  # not prefetched in time
+        output = self.staging.scratch_output(self.filepath)
+        output.write_bytes(staged.read_bytes()[::-1])
+
+        def write():
+            final = self.filepath.with_suffix(".mkv")
+            final.write_bytes(output.read_bytes())
+            return final
+        return self.staging.write_back(self.filepath, write)
+
+
+def test_pipeline_reports_after_write_back(tmp_path):
+    config = Config()
+    config.encode_scheduler = "fixed"
+    config.max_parallel_encodes = 1
+    staging = ScratchStaging(tmp_path / "scratch", budget_bytes=10 ** 6, prefetch_count=2)
+    sources = []
+    for i in range(4):
+        path = tmp_path / f"{i}.mp4"
+        path.write_bytes(f"video {i}".encode())
+        sources.append(path)
+
+    results = {}
+    Pipeline(config, on_result=lambda filepath, result, error, cost: results.update({filepath: result}),
+             staging=staging).run([StagedProcessor(p, staging) for p in sources])
+    staging.close()
+
+    assert len(results) == 4
+    for i, path in enumerate(sources):
+        assert results[path].read_bytes() == f"video {i}".encode()[::-1]
+
+
+def test_interrupted_staged_encode_resumes_its_segments(tmp_path, monkeypatch):
+    source = tmp_path / "movie.mp4"
+    source.write_bytes(b"source")
+    plan = EncodePlan(source, tmp_path / "movie_compressed.mkv", ["-map", "0:v:0"], ["-c:v", "libsvtav1"], [], [],
+                      [], True, False, duration=900, fingerprint=file_fingerprint(source),
+                      chunks=[(0.0, 300.0), (300.0, 600.0), (600.0, None)])
+    encoded, interrupt = [], [True]
+
+    def fake_run(self, cmd, name, duration):
+        output = Path(cmd[-1])
+        if output.name.startswith("segment_"):
+            if output.name == "segment_0002.mkv" and interrupt[0]:
+                raise Exception("ffmpeg killed")  # e.g. docker stop while encoding the last chunk
+            encoded.append(output.name)
+        output.write_bytes(b"encoded")
+
+    monkeypatch.setattr(ChunkedEncoder, "_run", fake_run)
+    staging = ScratchStaging(tmp_path / "scratch", budget_bytes=10 ** 6, prefetch_count=1)
+    staging.prefetch(source)
+    with pytest.raises(Exception):
+        FileProcessor(source, Config(), staging=staging).execute(plan)
+    staging.close()
+    assert is_resumable(staging.chunk_dir(source))
+
+    # the next run keeps the segments on scratch and only encodes the missing one
+    interrupt[0] = False
+    staging = ScratchStaging(tmp_path / "scratch", budget_bytes=10 ** 6, prefetch_count=1)
+    staging.prefetch(source)
+    final = FileProcessor(source, Config(), staging=staging).execute(plan).result()
+    staging.close()
+    assert encoded == ["segment_0000.mkv", "segment_0001.mkv", "segment_0002.mkv"]
+    assert final == tmp_path / "movie.mkv" and final.read_bytes() == b"encoded"
+    assert list((tmp_path / "scratch").iterdir()) == []
@@ -0,0 +1,38 @@
+"""Tests for the persistent job-state database"""
+
+from config import Config
+from state_store import ENCODED, FAILED, StateStore, has_settings_tags, settings_key
+
+
+def test_finished_until_file_or_settings_change(tmp_path):
+    store = StateStore(tmp_path / "state.sqlite")
+    path = tmp_path / "movie.mkv"
+    config = Config()
+    key = settings_key(config)
+
+    store.record(path, (100, 1), ENCODED, key)
+    assert store.is_finished(path, (100, 1), key)
+    assert not store.is_finished(path, (100, 2), key)
+
+    config.base_quality += 1
+    assert not store.is_finished(path, (100, 1), settings_key(config))
+    store.close()
+
+
+def test_failed_files_are_retried_on_request(tmp_path):
+    path = tmp_path / "broken.mkv"
+    store = StateStore(tmp_path / "state.sqlite")
+    store.record(path, (1, 1), FAILED, "k", "ffmpeg exited with 1")
+    assert store.is_finished(path, (1, 1), "k")
+    assert store.lookup(path)["reason"] == "ffmpeg exited with 1"
+    store.close()
+
+    store = StateStore(tmp_path / "state.sqlite", retry_failed=True)
+    assert not store.is_finished(path, (1, 1), "k")
+    store.close()
+
+
+def test_settings_tags_of_previous_outputs():
+    assert has_settings_tags({"VIDEO_SETTINGS": "-c:v libsvtav1"})
+    assert has_settings_tags({"audio_settings": ""})
+    assert not has_settings_tags({"encoder": "Lavf60"})